@@ -1,10 +1,19 @@
+from datetime import datetime
 import logging
 
+from django.conf import settings
 from django.contrib import admin
+from django.contrib.admin import helpers
+from django.contrib.admin.views.main import ChangeList
 from django.contrib.auth.models import User
+from django.db.models import Count
+from django.shortcuts import render_to_response
+from django.template import RequestContext
 from django.utils.translation import ugettext_lazy as _
-from forms import ArticleAdminForm
-from models import Tag, Article, ArticleStatus, Attachment
+from forms import ApplyTagsForm, ArticleAdminForm, SetStatusForm
+from models import Tag, Article, ArticleStatus, ArticleTask, Attachment
+from search import filter_articles
+from tasks import dispatch
 
 log = logging.getLogger('articles.admin')
 
@@ -12,19 +21,57 @@ class TagAdmin(admin.ModelAdmin):
     list_display = ('name', 'article_count')
 
     def article_count(self, obj):
-        return obj.article_set.count()
+        return obj.article_count
     article_count.short_description = _('Applied To')
+    article_count.admin_order_field = 'article_count'
+
+    def queryset(self, request):
+        """Counts the articles for each tag in the same query"""
+
+        qs = super(TagAdmin, self).queryset(request)
+        return qs.annotate(article_count=Count('article', distinct=True))
 
 class ArticleStatusAdmin(admin.ModelAdmin):
     list_display = ('name', 'is_live')
     list_filter = ('is_live',)
     search_fields = ('name',)
 
+class ArticleTaskAdmin(admin.ModelAdmin):
+    list_display = ('name', 'arguments', 'status', 'priority', 'attempts', 'run_after', 'claimed_by')
+    list_filter = ('status', 'name')
+    readonly_fields = ('key', 'claimed_by', 'claimed_at', 'last_error', 'created')
+
+    def retry(self, request, queryset):
+        """Puts failed tasks back in the queue"""
+
+        count = queryset.filter(status=ArticleTask.FAILED).update(
+                status=ArticleTask.PENDING, attempts=0, run_after=datetime.now())
+        self.message_user(request, _('Queued %(count)s tasks again.') % {'count': count})
+    retry.short_description = _('Retry selected failed tasks')
+
+    actions = [retry]
+
 class AttachmentInline(admin.TabularInline):
     model = Attachment
     extra = 5
     max_num = 15
 
+class ArticleChangeList(ChangeList):
+    """Looks up searches in the article search index instead of scanning every article"""
+
+    def get_query_set(self, *args, **kwargs):
+        search_fields, self.search_fields = self.search_fields, ()
+        try:
+            qs = super(ArticleChangeList, self).get_query_set(*args, **kwargs)
+        finally:
+            # the search box is only displayed when there are search fields
+            self.search_fields = search_fields
+
+        if self.query:
+            qs = filter_articles(qs, self.query)
+
+        return qs
+
 class ArticleAdmin(admin.ModelAdmin):
     list_display = ('title', 'tag_count', 'status', 'author', 'publish_date',
                     'expiration_date', 'is_active')
@@ -63,50 +110,83 @@ class ArticleAdmin(admin.ModelAdmin):
     prepopulated_fields = {'slug': ('title',)}
 
     def tag_count(self, obj):
-        return str(obj.tags.count())
+        return str(obj.tag_count)
     tag_count.short_description = _('Tags')
+    tag_count.admin_order_field = 'tag_count'
 
     def mark_active(self, request, queryset):
-        queryset.update(is_active=True)
+        ids = list(queryset.values_list('id', flat=True))
+        Article.objects.filter(id__in=ids).update(is_active=True)
+        Article.objects.refresh_visibility(ids)
     mark_active.short_description = _('Mark select articles as active')
 
     def mark_inactive(self, request, queryset):
-        queryset.update(is_active=False)
+        ids = list(queryset.values_list('id', flat=True))
+        Article.objects.filter(id__in=ids).update(is_active=False)
+        Article.objects.refresh_visibility(ids)
     mark_inactive.short_description = _('Mark select articles as inactive')
 
-    def get_actions(self, request):
-        actions = super(ArticleAdmin, self).get_actions(request)
-
-        def dynamic_status(name, status):
-            def status_func(self, request, queryset):
-                queryset.update(status=status)
-
-            status_func.__name__ = name
-            status_func.short_description = _('Set status of selected to "%s"' % status)
-            return status_func
+    def bulk_action_form(self, request, form_class, action, title):
+        """
+        Returns a bound intermediate form for a bulk action once it has been
+        submitted, or the page asking for its parameters otherwise.
+        """
 
-        for status in ArticleStatus.objects.all():
-            name = 'mark_status_%i' % status.id
-            actions[name] = (dynamic_status(name, status), name, _('Set status of selected to "%s"' % status))
+        if 'apply' in request.POST:
+            form = form_class(request.POST)
+            if form.is_valid():
+                return form, None
+        else:
+            form = form_class()
+
+        response = render_to_response('admin/articles/article/bulk_action.html', {
+            'title': title,
+            'form': form,
+            'action': action,
+            'selected': request.POST.getlist(helpers.ACTION_CHECKBOX_NAME),
+            'action_checkbox_name': helpers.ACTION_CHECKBOX_NAME,
+            'opts': self.model._meta,
+        }, context_instance=RequestContext(request))
+
+        return None, response
+
+    def apply_tags(self, request, queryset):
+        form, response = self.bulk_action_form(request, ApplyTagsForm, 'apply_tags', _('Apply tags'))
+        if form is None:
+            return response
+
+        tags = form.cleaned_data['tags']
+        ids = list(queryset.values_list('id', flat=True))
+        log.debug('Applying Tags %s to Articles %s' % (tags, ids))
+
+        if dispatch('add_tags', ids, [t.pk for t in tags]):
+            message = _('Queued %(tags)s to be applied to %(count)s articles.')
+        else:
+            message = _('Applied %(tags)s to %(count)s articles.')
 
-        def dynamic_tag(name, tag):
-            def status_func(self, request, queryset):
-                for article in queryset.iterator():
-                    log.debug('Dynamic tagging: applying Tag "%s" to Article "%s"' % (tag, article))
-                    article.tags.add(tag)
-                    article.save()
+        self.message_user(request, message % {
+            'tags': ', '.join(t.name for t in tags),
+            'count': len(ids),
+        })
+    apply_tags.short_description = _('Apply tags to selected articles')
 
-            status_func.__name__ = name
-            status_func.short_description = _('Apply tag "%s" to selected articles' % tag)
-            return status_func
+    def set_status(self, request, queryset):
+        form, response = self.bulk_action_form(request, SetStatusForm, 'set_status', _('Set status'))
+        if form is None:
+            return response
 
-        for tag in Tag.objects.all():
-            name = 'apply_tag_%s' % tag.pk
-            actions[name] = (dynamic_tag(name, tag), name, _('Apply Tag: %s' % (tag.slug,)))
+        status = form.cleaned_data['status']
+        ids = list(queryset.values_list('id', flat=True))
+        Article.objects.filter(id__in=ids).update(status=status)
+        Article.objects.refresh_visibility(ids)
 
-        return actions
+        self.message_user(request, _('Set the status of %(count)s articles to "%(status)s".') % {
+            'status': status,
+            'count': len(ids),
+        })
+    set_status.short_description = _('Set status of selected articles')
 
-    actions = [mark_active, mark_inactive]
+    actions = [mark_active, mark_inactive, apply_tags, set_status]
 
     def save_model(self, request, obj, form, change):
         """Set the article's author based on the logged in user and make sure at least one site is selected"""
@@ -118,19 +198,39 @@ class ArticleAdmin(admin.ModelAdmin):
 
         obj.save()
 
-        # this requires an Article object already
-        obj.do_auto_tag('default')
-        form.cleaned_data['tags'] += list(obj.tags.all())
+        if obj.auto_tag:
+            # keep whatever auto-tagging matched; anything else that was
+            # dropped from the form gets removed
+            tags = form.cleaned_data['tags']
+            tags.extend(t for t in obj.matching_tags(obj.tags.all()) if t not in tags)
+
+    def save_related(self, request, form, formsets, change):
+        """Selects the current site once the form's sites are saved, if none were picked"""
+
+        super(ArticleAdmin, self).save_related(request, form, formsets, change)
+
+        # saving the form's empty selection undoes the default the article
+        # picked for itself; adding it refreshes the article's visibility
+        if not form.instance.sites.exists():
+            form.instance.sites.add(settings.SITE_ID)
+
+    def get_changelist(self, request, **kwargs):
+        return ArticleChangeList
 
     def queryset(self, request):
         """Limit the list of articles to article posted by this user unless they're a superuser"""
 
         if request.user.is_superuser:
-            return self.model._default_manager.all()
+            qs = self.model._default_manager.all()
         else:
-            return self.model._default_manager.filter(author=request.user)
+            qs = self.model._default_manager.filter(author=request.user)
+
+        # count the tags and pull in the status and author in one query
+        qs = qs.annotate(tag_count=Count('tags', distinct=True))
+        return qs.select_related('status', 'author')
 
 admin.site.register(Tag, TagAdmin)
 admin.site.register(Article, ArticleAdmin)
 admin.site.register(ArticleStatus, ArticleStatusAdmin)
+admin.site.register(ArticleTask, ArticleTaskAdmin)
 
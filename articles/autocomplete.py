@@ -0,0 +1,248 @@
+"""
+A process-local prefix index of tag names for the tag auto-completion view.
+
+Tags are kept in a list sorted by their cleaned names, so finding every tag
+that starts with some prefix is a pair of binary searches.  Matches are ranked
+by the number of articles using each tag; short prefixes that match a large
+chunk of the index are answered from a second list sorted by popularity.
+
+Each change to a tag, or to the number of articles using some tags, is written
+to a numbered log in the shared cache and applied to the index in place.
+Every process applies the changes from the log in order, the next time it's
+asked for suggestions, and only rebuilds the whole index when it fell too far
+behind, the log entries it needs are gone, or the index gets old.
+"""
+
+from bisect import bisect_left, insort
+import heapq
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Count
+
+from models import Tag
+
+TAG_INDEX_TIMEOUT = getattr(settings, 'ARTICLES_TAG_INDEX_TIMEOUT', 3600)
+VERSION_KEY = 'tag_index_version'
+CHANGE_KEY = 'tag_index_change:%s'
+
+# further behind than this, rebuilding is quicker than catching up
+MAX_CHANGES = 500
+
+# how many distinct searches to remember between changes
+MAX_REMEMBERED = 5000
+
+# with more matches than this, walking the tags from most to least popular
+# finds the best ones sooner than sorting every match
+POPULAR_SCAN_THRESHOLD = 1000
+
+log = logging.getLogger('articles.autocomplete')
+
+class TagIndex(object):
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._keys = []
+        self._popular = []
+        self._tags = {}
+        self._results = {}
+        self._version = None
+        self._built = 0
+
+    def load(self, rows, version=None):
+        """Replaces the index with ``(id, name, slug, popularity)`` rows"""
+
+        tags = {}
+        for pk, name, slug, popularity in rows:
+            tags[pk] = (unicode(slug or Tag.clean_tag(name)), name, popularity)
+
+        keys = sorted((key, pk) for pk, (key, name, popularity) in tags.items())
+        popular = sorted((-popularity, key, pk) for pk, (key, name, popularity) in tags.items())
+
+        self._lock.acquire()
+        try:
+            self._tags = tags
+            self._keys = keys
+            self._popular = popular
+            self._results = {}
+            self._version = version
+            self._built = time.time()
+        finally:
+            self._lock.release()
+
+        log.debug('Loaded %s tags into the index' % len(keys))
+
+    def build(self, version=None):
+        """Loads every tag along with the number of articles using it"""
+
+        if version is None:
+            version = self.current_version()
+
+        rows = Tag.objects.annotate(popularity=Count('article')).values_list(
+                'id', 'name', 'slug', 'popularity').order_by()
+        self.load(rows, version)
+
+    def current_version(self):
+        """The number of the latest change in the shared log"""
+
+        version = cache.get(VERSION_KEY)
+        if version is None:
+            # start well past any number that was in use before it was evicted
+            cache.add(VERSION_KEY, int(time.time() * 1000), TAG_INDEX_TIMEOUT)
+            version = cache.get(VERSION_KEY)
+
+        return version
+
+    def ensure_fresh(self):
+        """Catches up with changes made by other processes, or rebuilds the index"""
+
+        version = self.current_version()
+        if self._version is not None and time.time() - self._built <= TAG_INDEX_TIMEOUT and \
+                self.catch_up(version):
+            return version
+
+        log.debug('Rebuilding tag index for version %r' % (version,))
+        self.build(version)
+        return version
+
+    def catch_up(self, version):
+        """Applies the logged changes up to ``version``; returns whether it could"""
+
+        self._lock.acquire()
+        try:
+            behind = version - self._version
+            if behind < 0 or behind > MAX_CHANGES:
+                return False
+
+            keys = [CHANGE_KEY % n for n in range(self._version + 1, version + 1)]
+            changes = cache.get_many(keys)
+            if len(changes) < len(keys):
+                return False
+
+            for key in keys:
+                self.apply(changes[key])
+            self._version = version
+            return True
+        finally:
+            self._lock.release()
+
+    def publish(self, change):
+        """Logs a change for the other processes, and applies it here"""
+
+        try:
+            version = cache.incr(VERSION_KEY)
+        except ValueError:
+            self.current_version()
+            version = cache.incr(VERSION_KEY)
+        cache.set(CHANGE_KEY % version, change, TAG_INDEX_TIMEOUT)
+
+        # each change is applied once, in order; if another process logged
+        # one in between, both are picked up when this one catches up
+        self._lock.acquire()
+        try:
+            if self._version == version - 1:
+                self.apply(change)
+                self._version = version
+        finally:
+            self._lock.release()
+
+    def apply(self, change):
+        """
+        Applies one logged change: ``('set', id, key, name)``, ``('remove',
+        id)``, ``('counts', {id: popularity})`` or ``('adjust', {id: amount})``.
+        """
+
+        self._lock.acquire()
+        try:
+            if change[0] == 'set':
+                op, pk, key, name = change
+                old_key, old_name, popularity = self.drop(pk)
+                self.place(pk, key, name, popularity)
+            elif change[0] == 'remove':
+                self.drop(change[1])
+            else:
+                for pk, amount in change[1].items():
+                    key, name, popularity = self.drop(pk)
+                    if key is not None:
+                        if change[0] == 'adjust':
+                            amount = max(0, popularity + amount)
+                        self.place(pk, key, name, amount)
+            self._results = {}
+        finally:
+            self._lock.release()
+
+    def place(self, pk, key, name, popularity):
+        self._tags[pk] = (key, name, popularity)
+        insort(self._keys, (key, pk))
+        insort(self._popular, (-popularity, key, pk))
+
+    def drop(self, pk):
+        key, name, popularity = self._tags.pop(pk, (None, None, 0))
+        if key is not None:
+            self._keys.remove((key, pk))
+            self._popular.remove((-popularity, key, pk))
+
+        return key, name, popularity
+
+    def add(self, tag):
+        """Adds or updates a single tag"""
+
+        self.publish(('set', tag.pk, unicode(tag.cleaned), tag.name))
+
+    def remove(self, tag):
+        """Drops a single tag"""
+
+        self.publish(('remove', tag.pk))
+
+    def adjust(self, amounts):
+        """Changes how many articles use some tags, by ``{id: amount}``"""
+
+        amounts = dict((pk, n) for pk, n in amounts.items() if n)
+        if amounts:
+            self.publish(('adjust', amounts))
+
+    def set_counts(self, counts):
+        """Sets how many articles use some tags, as ``{id: popularity}``"""
+
+        if counts:
+            self.publish(('counts', dict(counts)))
+
+    def search(self, prefix, limit=10):
+        """Returns the names of the most popular tags starting with ``prefix``"""
+
+        key = unicode(Tag.clean_tag(prefix))
+        remembered = self._results.get((key, limit))
+        if remembered is not None:
+            return remembered
+
+        self._lock.acquire()
+        try:
+            start = bisect_left(self._keys, (key,))
+            end = bisect_left(self._keys, (key + u'\uffff',))
+
+            tags = self._tags
+            if end - start > POPULAR_SCAN_THRESHOLD:
+                best = []
+                for negative, k, pk in self._popular:
+                    if k.startswith(key):
+                        best.append(pk)
+                        if len(best) == limit:
+                            break
+            else:
+                best = [pk for k, pk in heapq.nsmallest(limit, self._keys[start:end],
+                                                        key=lambda k: (-tags[k[1]][2], k[0]))]
+
+            names = [tags[pk][1] for pk in best]
+
+            if len(self._results) >= MAX_REMEMBERED:
+                self._results = {}
+            self._results[(key, limit)] = names
+        finally:
+            self._lock.release()
+
+        return names
+
+tag_index = TagIndex()
@@ -0,0 +1,322 @@
+"""
+One place for everything the articles app keeps in the cache.
+
+Values live in namespaces (``feeds``, ``tag_cloud``, ``queries`` and so on),
+and every namespace has a version that's part of its keys.  Bumping the
+version makes everything cached in the namespace unreachable at once, without
+having to know which keys were used.
+
+``get_or_set`` protects expensive values from stampedes.  Each value is kept
+for a little while after it goes stale; the first process to notice takes a
+lock and recomputes it while everybody else keeps serving the stale copy.
+When there's nothing to serve, only the process holding the lock computes the
+value and the others wait briefly for it to show up.
+
+Small values that are read on nearly every request (author names, statuses,
+the tag cloud and the archive list) are also kept in a bounded, process-local
+LRU tier with ``local=True``, along with the namespace versions themselves.
+Every bump also changes a shared stamp.  Each process compares the stamp with
+the one it last saw once per request (and at least every second otherwise),
+and drops its local tier when it has changed, so invalidations show up
+everywhere almost at once while most lookups never leave the process.
+
+Hits, misses and time spent recomputing are counted per namespace in each
+process; see ``stats``.
+"""
+
+from collections import defaultdict, OrderedDict
+from hashlib import sha1
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.signals import request_started
+
+# how long values are served after they go stale while one process refreshes them
+STALE_TIMEOUT = getattr(settings, 'ARTICLES_CACHE_STALE_TIMEOUT', 60)
+
+# how long a process may take to recompute a value before another one tries
+LOCK_TIMEOUT = getattr(settings, 'ARTICLES_CACHE_LOCK_TIMEOUT', 30)
+
+# how long to wait for another process to compute a value that isn't cached
+LOCK_WAIT = 2.0
+LOCK_POLL = 0.05
+
+# versions outlive anything cached under them
+VERSION_TIMEOUT = 2592000
+
+# the process-local tier
+LOCAL_SIZE = getattr(settings, 'ARTICLES_LOCAL_CACHE_SIZE', 1000)
+LOCAL_TIMEOUT = getattr(settings, 'ARTICLES_LOCAL_CACHE_TIMEOUT', 60)
+STAMP_INTERVAL = 1.0
+STAMP_KEY = 'articles:stamp'
+
+PREFIX = 'articles'
+MAX_KEY_LENGTH = 200
+
+log = logging.getLogger('articles.caching')
+
+_stats = defaultdict(lambda: defaultdict(float))
+_stats_lock = threading.Lock()
+
+def count(namespace, name, amount=1):
+    _stats_lock.acquire()
+    try:
+        _stats[namespace][name] += amount
+    finally:
+        _stats_lock.release()
+
+def stats():
+    """
+    Returns the counters of each namespace for this process: ``hits``,
+    ``stale`` (stale values served), ``misses``, ``waits`` (misses answered by
+    another process), ``recomputes`` and ``recompute_time`` in seconds.
+    """
+
+    _stats_lock.acquire()
+    try:
+        return dict((namespace, dict(counters)) for namespace, counters in _stats.items())
+    finally:
+        _stats_lock.release()
+
+def reset_stats():
+    _stats_lock.acquire()
+    try:
+        _stats.clear()
+    finally:
+        _stats_lock.release()
+
+class LocalCache(object):
+    """A bounded, least recently used cache that only this process can see"""
+
+    def __init__(self, size=LOCAL_SIZE, timeout=LOCAL_TIMEOUT):
+        self.size = size
+        self.timeout = timeout
+        self._lock = threading.RLock()
+        self._entries = OrderedDict()
+        self._versions = {}
+        self._stamp = None
+        self._checked = 0
+
+    def check(self):
+        """Drops everything if a namespace was bumped since the last check"""
+
+        now = time.time()
+        if now - self._checked < STAMP_INTERVAL:
+            return
+
+        stamp = cache.get(STAMP_KEY)
+        if stamp is None:
+            cache.add(STAMP_KEY, '%.6f' % now, VERSION_TIMEOUT)
+            stamp = cache.get(STAMP_KEY)
+
+        if stamp != self._stamp:
+            if self._stamp is not None:
+                log.debug('Shared stamp changed to %s; clearing local cache' % stamp)
+                self.clear()
+            self._stamp = stamp
+        self._checked = now
+
+    def recheck(self, **kwargs):
+        """Makes the next lookup check the stamp; called as each request starts"""
+
+        self._checked = 0
+
+    def get(self, key):
+        self.check()
+
+        self._lock.acquire()
+        try:
+            item = self._entries.pop(key, None)
+            if item is None or item[0] <= time.time():
+                return None
+
+            # most recently used entries go to the end
+            self._entries[key] = item
+            return item[1]
+        finally:
+            self._lock.release()
+
+    def set(self, key, value):
+        self._lock.acquire()
+        try:
+            self._entries.pop(key, None)
+            self._entries[key] = (time.time() + self.timeout, value)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+        finally:
+            self._lock.release()
+
+    def get_version(self, namespace):
+        self.check()
+        return self._versions.get(namespace)
+
+    def set_version(self, namespace, version):
+        self._versions[namespace] = version
+
+    def clear(self, stamp=None):
+        self._lock.acquire()
+        try:
+            self._entries.clear()
+            self._versions = {}
+            self._stamp = stamp
+        finally:
+            self._lock.release()
+
+local_cache = LocalCache()
+request_started.connect(local_cache.recheck)
+
+def version_key(namespace):
+    return '%s:version:%s' % (PREFIX, namespace)
+
+def get_version(namespace):
+    """The current version of a namespace"""
+
+    version = local_cache.get_version(namespace)
+    if version is not None:
+        return version
+
+    key = version_key(namespace)
+    version = cache.get(key)
+    if version is None:
+        # a timestamp never repeats a version that was evicted
+        cache.add(key, '%.6f' % time.time(), VERSION_TIMEOUT)
+        version = cache.get(key)
+
+    local_cache.set_version(namespace, version)
+    return version
+
+def bump(*namespaces):
+    """Invalidates everything cached in some namespaces, in every process"""
+
+    version = '%.6f' % time.time()
+    log.debug('Bumping %s to version %s' % (', '.join(namespaces), version))
+
+    versions = dict((version_key(namespace), version) for namespace in namespaces)
+    versions[STAMP_KEY] = version
+    cache.set_many(versions, VERSION_TIMEOUT)
+    local_cache.clear(version)
+
+def make_key(namespace, key, version=None):
+    """The cache key for ``key`` in the current version of ``namespace``"""
+
+    if version is None:
+        version = get_version(namespace)
+
+    if isinstance(key, unicode):
+        key = key.encode('utf-8')
+    key = str(key)
+
+    # memcached doesn't like long keys or whitespace
+    full = '%s:%s:%s:%s' % (PREFIX, namespace, version, key)
+    if len(full) > MAX_KEY_LENGTH or len(key.split()) != 1:
+        full = '%s:%s:%s:%s' % (PREFIX, namespace, version, sha1(key).hexdigest())
+
+    return full
+
+def get(namespace, key, default=None):
+    """Returns a cached value, fresh or stale"""
+
+    entry = cache.get(make_key(namespace, key))
+    if entry is None:
+        return default
+
+    return entry[1]
+
+def set(namespace, key, value, timeout, stale=STALE_TIMEOUT):
+    """Caches a value for ``timeout`` seconds, and keeps it ``stale`` seconds longer"""
+
+    store(make_key(namespace, key), value, timeout, stale)
+
+def delete(namespace, key):
+    cache.delete(make_key(namespace, key))
+
+def store(full_key, value, timeout, stale):
+    """Caches a value; returns its ``(fresh_until, value)`` entry"""
+
+    entry = (time.time() + timeout, value)
+    if timeout > 0:
+        cache.set(full_key, entry, timeout + stale)
+
+    return entry
+
+def recompute(namespace, full_key, compute, timeout, stale):
+    start = time.time()
+    value = compute()
+    duration = time.time() - start
+
+    count(namespace, 'recomputes')
+    count(namespace, 'recompute_time', duration)
+    log.debug('Recomputed %s in %.3f seconds' % (full_key, duration))
+
+    if callable(timeout):
+        timeout = timeout(value)
+    if callable(stale):
+        stale = stale(value)
+
+    return store(full_key, value, timeout, stale)
+
+def fetch(namespace, full_key, compute, timeout, stale):
+    """Looks up an entry in the shared cache, recomputing it at most once at a time"""
+
+    lock_key = full_key + ':lock'
+
+    entry = cache.get(full_key)
+    if entry is not None:
+        if time.time() < entry[0]:
+            count(namespace, 'hits')
+            return entry
+
+        count(namespace, 'stale')
+        if not cache.add(lock_key, True, LOCK_TIMEOUT):
+            # somebody else is refreshing it
+            return entry
+
+        try:
+            return recompute(namespace, full_key, compute, timeout, stale)
+        finally:
+            cache.delete(lock_key)
+
+    count(namespace, 'misses')
+    if not cache.add(lock_key, True, LOCK_TIMEOUT):
+        waited = 0
+        while waited < LOCK_WAIT:
+            time.sleep(LOCK_POLL)
+            waited += LOCK_POLL
+
+            entry = cache.get(full_key)
+            if entry is not None:
+                count(namespace, 'waits')
+                return entry
+
+        log.debug('Gave up waiting for %s' % full_key)
+        return recompute(namespace, full_key, compute, timeout, stale)
+
+    try:
+        return recompute(namespace, full_key, compute, timeout, stale)
+    finally:
+        cache.delete(lock_key)
+
+def get_or_set(namespace, key, compute, timeout, stale=STALE_TIMEOUT, local=False):
+    """
+    Returns the cached value for ``key``, calling ``compute`` to produce it
+    when it's missing or stale.  ``timeout`` and ``stale`` are in seconds, or
+    functions that work them out from the computed value.  Values with a
+    timeout of zero aren't cached.  With ``local``, fresh values are also kept
+    in this process.
+    """
+
+    full_key = make_key(namespace, key)
+    if local:
+        entry = local_cache.get(full_key)
+        if entry is not None and time.time() < entry[0]:
+            count(namespace, 'local_hits')
+            return entry[1]
+
+    entry = fetch(namespace, full_key, compute, timeout, stale)
+    if local and time.time() < entry[0]:
+        local_cache.set(full_key, entry)
+
+    return entry[1]
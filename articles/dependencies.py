@@ -0,0 +1,261 @@
+"""
+Works out which public pages an article change affects.
+
+An article appears on its own page, on the pages of the articles next to it
+and of the articles that recommend it or follow up on it, on a page of the
+archive and of its author, month and tag listings, and in the latest and tag
+feeds.  Given what an article looked like before and after a change,
+``affected_urls`` finds the pages that may now look different:
+
+* its own page, whatever changed;
+* if its title or date changed, or it came or went, the pages next to it, and
+  in each listing the page it's on, along with every later page when the
+  articles after it shift to other pages;
+* the feeds, when it's among the articles they include.
+
+The archive of months in the sidebar is on every page, so when a month gains
+its first article or loses its last one, everything is affected and ``None``
+is returned instead.
+
+When anything listens to ``articles.signals.pages_affected``, the listeners
+send it with the affected URLs whenever an article, its tags or sites, or a
+tag change, and when scheduled articles are published or expire.  Use it to
+purge cached pages or regenerate static ones.
+"""
+
+from collections import namedtuple
+from datetime import datetime
+import logging
+
+from django.conf import settings
+from django.core.paginator import Paginator
+
+from models import Article, ArticleStatus, ArticleVisibility, DEFAULT_DB, published_in
+import permalinks
+
+ARTICLE_PAGINATION = getattr(settings, 'ARTICLE_PAGINATION', 20)
+
+# the number of articles in the latest and tag feeds
+LATEST_FEED_SIZE = 15
+TAG_FEED_SIZE = 10
+
+log = logging.getLogger('articles.dependencies')
+
+Snapshot = namedtuple('Snapshot', 'visible url title publish_date author tags')
+
+def page_count(count):
+    """The number of pages a listing of ``count`` articles is split into"""
+
+    return Paginator(xrange(count), ARTICLE_PAGINATION, orphans=int(ARTICLE_PAGINATION / 4)).num_pages
+
+def page_number(position, count):
+    """The page of a listing of ``count`` articles showing the one at ``position``"""
+
+    return min(position // ARTICLE_PAGINATION + 1, page_count(count))
+
+def page_url(name, page, **kwargs):
+    if page == 1:
+        return permalinks.build(name, **kwargs)
+
+    return permalinks.build(name + '_page', page=page, **kwargs)
+
+def listing_urls(name, count, first=1, **kwargs):
+    """The URLs of the pages of a listing, starting with page ``first``"""
+
+    urls = permalinks.PageURLs(name, **kwargs)
+    return [urls.url(page) for page in range(first, page_count(count) + 1)]
+
+def feed_urls(slug=None):
+    if slug is None:
+        return [permalinks.build('articles_rss_feed_latest'), permalinks.build('articles_atom_feed_latest')]
+
+    return [permalinks.tag_rss_url(slug=slug), permalinks.tag_atom_url(slug=slug)]
+
+def article_url(year, slug):
+    return permalinks.article_url(year=year, slug=slug)
+
+def snapshots(article_ids, using=DEFAULT_DB, now=None):
+    """
+    Describes how articles currently appear on this site, keyed by ID.  An
+    article is visible under the same conditions that give it visibility rows.
+    """
+
+    article_ids = list(article_ids)
+    if not article_ids:
+        return {}
+
+    now = now or datetime.now()
+    articles = Article.objects.using(using).filter(id__in=article_ids)
+
+    tags = dict((pk, []) for pk in article_ids)
+    for pk, slug in Article.tags.through.objects.using(using).filter(
+            article__in=article_ids).values_list('article', 'tag__slug'):
+        tags[pk].append(slug)
+
+    on_site = set(Article.sites.through.objects.using(using).filter(
+            article__in=article_ids, site=settings.SITE_ID).values_list('article', flat=True))
+
+    result = {}
+    live = ArticleStatus.objects.live_ids(using)
+    for pk, slug, title, publish_date, expiration_date, is_active, status, author in articles.values_list(
+            'id', 'slug', 'title', 'publish_date', 'expiration_date', 'is_active',
+            'status', 'author__username'):
+        visible = (is_active and status in live and pk in on_site and publish_date <= now
+                   and (expiration_date is None or expiration_date > now))
+        result[pk] = Snapshot(bool(visible), article_url(publish_date.year, slug), title,
+                              publish_date, author, tuple(sorted(tags[pk])))
+
+    return result
+
+class Listing(object):
+    """One of the paginated lists of visible articles"""
+
+    def __init__(self, name, rows, **kwargs):
+        self.name = name
+        self.rows = rows
+        self.kwargs = kwargs
+
+    def position(self, snapshot):
+        """How many other articles come before this one"""
+
+        d = snapshot.publish_date
+        return (self.rows.filter(publish_date__gt=d).count() +
+                self.rows.filter(publish_date=d, article__title__lt=snapshot.title).count())
+
+    def urls(self, count, first=1):
+        return listing_urls(self.name, count, first, **self.kwargs)
+
+def listings(snapshot, pk, using=DEFAULT_DB):
+    """The listings an article belongs to, with the other articles in each"""
+
+    rows = ArticleVisibility.objects.using(using).filter(site=settings.SITE_ID).exclude(article=pk)
+    year, month = snapshot.publish_date.year, snapshot.publish_date.month
+
+    found = {
+        ('archive',): Listing('articles_archive', rows),
+        ('author', snapshot.author): Listing('articles_by_author', rows.filter(article__author__username=snapshot.author), username=snapshot.author),
+        ('month', year, month): Listing('articles_in_month', rows.filter(**published_in(year, month)), year=year, month=month),
+    }
+    for slug in snapshot.tags:
+        found[('tag', slug)] = Listing('articles_display_tag', rows.filter(article__tags__slug=slug), tag=slug)
+
+    return found
+
+def displayed(snapshot):
+    """What listings and neighbouring pages show about an article"""
+
+    return (snapshot.url, snapshot.title, snapshot.publish_date, snapshot.author)
+
+def article_affected_urls(pk, before, after, using=DEFAULT_DB):
+    """The pages affected by one article going from ``before`` to ``after``"""
+
+    # the article's own page may have changed in ways snapshots don't show
+    urls = set(s.url for s in (before, after) if s)
+    if before == after:
+        return urls
+
+    was = before if before and before.visible else None
+    now = after if after and after.visible else None
+
+    if not (was or now):
+        return urls
+
+    changed = not (was and now) or displayed(was) != displayed(now)
+
+    before_listings = was and listings(was, pk, using) or {}
+    after_listings = now and listings(now, pk, using) or {}
+
+    for key in set(before_listings) | set(after_listings):
+        listing = after_listings.get(key) or before_listings[key]
+
+        positions = []
+        if key in before_listings:
+            positions.append(listing.position(was))
+        if key in after_listings:
+            positions.append(listing.position(now))
+
+        moved = len(set(positions)) > 1 or len(positions) == 1
+        if not (changed or moved):
+            continue
+
+        count = listing.rows.count()
+        if key[0] == 'month' and count == 0 and len(positions) == 1:
+            # a month is appearing in or disappearing from the sidebar
+            log.debug('Month %s-%s is new or gone; everything is affected' % key[1:])
+            return None
+
+        if moved:
+            # the articles after this one shift to other pages
+            first = page_number(min(positions), count + 1)
+            urls.update(listing.urls(count + 1, first))
+        else:
+            urls.add(page_url(listing.name, page_number(positions[0], count + 1), **listing.kwargs))
+
+        if key[0] == 'archive' and min(positions) < LATEST_FEED_SIZE:
+            urls.update(feed_urls())
+        elif key[0] == 'tag' and min(positions) < TAG_FEED_SIZE:
+            urls.update(feed_urls(key[1]))
+
+    if changed:
+        urls.update(neighbour_urls(pk, [s for s in (was, now) if s], using))
+
+    return urls
+
+def neighbour_urls(pk, states, using=DEFAULT_DB):
+    """The pages that link to an article by its title"""
+
+    urls = set()
+    rows = ArticleVisibility.objects.using(using).filter(site=settings.SITE_ID).exclude(article=pk)
+    fields = ('publish_date', 'article__slug')
+
+    for state in states:
+        d = state.publish_date
+        for row in (rows.filter(publish_date__lt=d).order_by('-publish_date').values_list(*fields)[:1],
+                    rows.filter(publish_date__gt=d).order_by('publish_date').values_list(*fields)[:1]):
+            urls.update(article_url(publish_date.year, slug) for publish_date, slug in row)
+
+    linked = Article.objects.using(using).filter(visibility__site=settings.SITE_ID)
+    for qs in (linked.filter(recommendations__related=pk),
+               linked.filter(followup_for=pk),
+               linked.filter(followups=pk)):
+        urls.update(article_url(publish_date.year, slug) for publish_date, slug in qs.values_list('publish_date', 'slug'))
+
+    return urls
+
+def affected_urls(before, after, using=DEFAULT_DB):
+    """
+    Returns the URLs of the pages that may look different now that the
+    articles described by ``before`` look like ``after``.  Both are
+    dictionaries of snapshots keyed by article ID; articles missing from one
+    of them didn't or don't exist.  Returns ``None`` when every page is
+    affected.
+    """
+
+    urls = set()
+    for pk in set(before) | set(after):
+        found = article_affected_urls(pk, before.get(pk), after.get(pk), using)
+        if found is None:
+            return None
+        urls |= found
+
+    return urls
+
+def tag_affected_urls(old_slug, new_slug, article_ids, using=DEFAULT_DB):
+    """
+    Returns the URLs affected by a tag being renamed or deleted (when
+    ``new_slug`` is ``None``): every page of its listing, its feeds, and the
+    pages of its articles, which list their tags.
+    """
+
+    visible = ArticleVisibility.objects.using(using).filter(site=settings.SITE_ID, article__in=list(article_ids))
+    count = visible.count()
+
+    urls = set()
+    for slug in set([old_slug, new_slug]) - set([None]):
+        urls.update(listing_urls('articles_display_tag', count, tag=slug))
+        urls.update(feed_urls(slug))
+
+    urls.update(article_url(publish_date.year, slug) for publish_date, slug in
+                visible.values_list('article__publish_date', 'article__slug'))
+
+    return urls
@@ -0,0 +1,274 @@
+"""
+Renders every public article page to static files.
+
+Each page is requested through the regular views (with an anonymous user) and
+written to ``<path>/index.html`` under the output directory, or to the path
+itself for feeds, so a web server can serve the directory as is.  With nginx,
+for instance::
+
+    location / {
+        root /var/www/articles;
+        try_files $uri $uri/index.html @django;
+    }
+
+A manifest in the output directory remembers a fingerprint of every article
+that was exported.  The next export compares them with the current articles
+and only renders the pages that changed (see ``changed_site_urls``), removing
+any that no longer exist.
+"""
+
+from collections import defaultdict
+from hashlib import sha1
+from multiprocessing import Pool
+import logging
+import os
+import urllib
+
+from django.db import connections
+from django.test.client import Client
+from django.utils import simplejson as json
+
+from dependencies import article_url, feed_urls, listing_urls
+from models import Article
+
+MANIFEST = '.articles-export.json'
+
+log = logging.getLogger('articles.export')
+
+def article_states():
+    """
+    Describes every article that appears in the public listings as
+    ``(id, state)`` pairs, in the order they're listed.  The fingerprint changes whenever anything
+    that's displayed about the article does.
+    """
+
+    tags = defaultdict(list)
+    through = Article.tags.through.objects.filter(article__in=Article.objects.visible())
+    for article_id, slug in through.values_list('article', 'tag__slug').order_by('tag__slug'):
+        tags[article_id].append(slug)
+
+    states = []
+    rows = Article.objects.visible().values_list('id', 'slug', 'title', 'publish_date',
+            'author__username', 'login_required', 'rendered_content', 'description')
+    for pk, slug, title, publish_date, author, login_required, content, description in rows.iterator():
+        fingerprint = sha1(repr((slug, title, publish_date, author, login_required,
+                                 content, description, tags[pk])).encode('utf-8')).hexdigest()
+        states.append((pk, {
+            'fingerprint': fingerprint,
+            'url': None if login_required else article_url(publish_date.year, slug),
+            'author': author,
+            'month': [publish_date.year, publish_date.month],
+            'tags': tags[pk],
+        }))
+
+    return states
+
+def site_urls(states):
+    """Every public URL for the articles described by ``states``"""
+
+    authors = defaultdict(int)
+    months = defaultdict(int)
+    tags = defaultdict(int)
+    urls = set()
+
+    for pk, state in states:
+        if state['url']:
+            urls.add(state['url'])
+
+        authors[state['author']] += 1
+        months[tuple(state['month'])] += 1
+        for tag in state['tags']:
+            tags[tag] += 1
+
+    urls.update(listing_urls('articles_archive', len(states)))
+    urls.update(feed_urls())
+
+    for username, count in authors.items():
+        urls.update(listing_urls('articles_by_author', count, username=username))
+
+    for (year, month), count in months.items():
+        urls.update(listing_urls('articles_in_month', count, year=year, month=month))
+
+    for slug, count in tags.items():
+        urls.update(listing_urls('articles_display_tag', count, tag=slug))
+        urls.update(feed_urls(slug))
+
+    return urls
+
+def changed_site_urls(old_states, new_states):
+    """
+    Works out which pages may look different now that the articles described
+    by ``old_states`` have become ``new_states``.  Returns ``None`` when
+    everything needs to be rendered again.
+
+    This isn't ``dependencies.affected_urls``: that one follows a single
+    change as it happens, placing the article among the other articles as
+    they are in the database right now.  Between two exports any number of
+    articles may have changed, and the manifest is all that's left of how
+    they were, so here the listings are worked out from the states alone,
+    and changes the snapshots don't show, like new content, count too.
+    """
+
+    old = dict(old_states)
+    new = dict(new_states)
+
+    # the archive in the sidebar of every listing shows the months
+    if set(tuple(s['month']) for s in old.values()) != set(tuple(s['month']) for s in new.values()):
+        return None
+
+    changed = set(pk for pk in set(old) | set(new)
+                  if old.get(pk, {}).get('fingerprint') != new.get(pk, {}).get('fingerprint'))
+    if not changed:
+        return set()
+
+    # detail pages link to the next and previous articles
+    neighbours = set()
+    for states in (old_states, new_states):
+        ids = [pk for pk, state in states]
+        for i, pk in enumerate(ids):
+            if pk in changed:
+                neighbours.update(ids[max(0, i - 1):i + 2])
+
+    # as well as related articles and follow-ups
+    neighbours.update(Article.objects.filter(recommendations__related__in=changed).values_list('id', flat=True))
+    neighbours.update(Article.objects.filter(followup_for__in=changed).values_list('id', flat=True))
+    neighbours.update(Article.objects.filter(followups__in=changed).values_list('id', flat=True))
+
+    touched = [state for states in (old, new) for pk, state in states.items() if pk in changed]
+    urls = set(states[pk]['url'] for states in (old, new)
+               for pk in neighbours | changed if pk in states and states[pk]['url'])
+
+    urls.update(site_urls([(None, state) for state in touched]))
+    urls.update(listing_urls('articles_archive', max(len(old), len(new))))
+
+    return urls
+
+def output_path(output, url):
+    """Where the page for ``url`` is written"""
+
+    path = os.path.join(output, *urllib.unquote(url).strip('/').split('/'))
+    if url.endswith('/'):
+        path = os.path.join(path, 'index.html')
+
+    return path
+
+_client = None
+
+def render_page(args):
+    """Renders one page to its file; returns the URL and response status"""
+
+    global _client
+    url, output = args
+
+    if _client is None:
+        _client = Client()
+
+    response = _client.get(url)
+    if response.status_code != 200:
+        log.warn('Not exporting %s: status %s' % (url, response.status_code))
+        return url, response.status_code
+
+    path = output_path(output, url)
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory):
+        try:
+            os.makedirs(directory)
+        except OSError:
+            # another process beat us to it
+            pass
+
+    # replace the file in one step so it's never served half-written
+    temp = '%s.%s.tmp' % (path, os.getpid())
+    f = open(temp, 'wb')
+    try:
+        f.write(response.content)
+    finally:
+        f.close()
+    os.rename(temp, path)
+
+    return url, response.status_code
+
+def render_pages(urls, output, processes=1):
+    """Renders pages, using a pool of processes if there's more than one"""
+
+    jobs = [(url, output) for url in sorted(urls)]
+    if processes > 1:
+        # each process needs its own database connection
+        for connection in connections.all():
+            connection.close()
+
+        pool = Pool(processes)
+        try:
+            results = pool.map(render_page, jobs, chunksize=20)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = map(render_page, jobs)
+
+    return [url for url, status in results if status == 200]
+
+def remove_pages(urls, output):
+    for url in urls:
+        path = output_path(output, url)
+        if os.path.exists(path):
+            log.debug('Removing %s' % path)
+            os.remove(path)
+
+def load_manifest(output):
+    try:
+        f = open(os.path.join(output, MANIFEST))
+    except IOError:
+        return None
+
+    try:
+        manifest = json.load(f)
+    finally:
+        f.close()
+
+    manifest['articles'] = [(int(pk), state) for pk, state in manifest['articles']]
+    return manifest
+
+def save_manifest(output, states, urls):
+    f = open(os.path.join(output, MANIFEST), 'w')
+    try:
+        json.dump({'articles': states, 'urls': sorted(urls)}, f)
+    finally:
+        f.close()
+
+def export(output, processes=1, full=False):
+    """
+    Exports the public pages to the ``output`` directory.  Unless ``full`` is
+    set, only the pages affected by changes since the last export are
+    rendered.  Returns the URLs that were rendered and removed.
+    """
+
+    if not os.path.isdir(output):
+        os.makedirs(output)
+
+    states = article_states()
+    urls = site_urls(states)
+
+    manifest = load_manifest(output)
+    previous = set(manifest['urls']) if manifest else set()
+
+    affected = None
+    if manifest and not full:
+        affected = changed_site_urls(manifest['articles'], states)
+
+    if affected is None:
+        wanted = urls
+    else:
+        # along with any pages that weren't exported before
+        wanted = (affected & urls) | (urls - previous)
+
+    log.debug('Rendering %s of %s pages' % (len(wanted), len(urls)))
+    rendered = set(render_pages(wanted, output, processes))
+
+    # drop pages that no longer exist or can't be exported any more
+    removed = (previous - urls) | (previous & wanted - rendered)
+    remove_pages(removed, output)
+
+    save_manifest(output, states, (previous & urls - wanted) | rendered)
+
+    return rendered, removed
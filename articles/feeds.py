@@ -1,10 +1,10 @@
 from django.conf import settings
 from django.contrib.syndication.views import Feed, FeedDoesNotExist
 from django.contrib.sites.models import Site
-from django.core.cache import cache
 from django.core.urlresolvers import reverse
 from django.utils.feedgenerator import Atom1Feed
 
+from articles import caching
 from articles.models import Article, Tag
 
 # default to 24 hours for feed caching
@@ -28,14 +28,8 @@ class LatestEntries(Feed, SiteMixin):
         return reverse('articles_archive')
 
     def items(self):
-        key = 'latest_articles'
-        articles = cache.get(key)
-
-        if articles is None:
-            articles = list(Article.objects.live().order_by('-publish_date')[:15])
-            cache.set(key, articles, FEED_TIMEOUT)
-
-        return articles
+        return caching.get_or_set('feeds', 'latest:%s' % settings.SITE_ID,
+                lambda: list(Article.objects.visible()[:15]), FEED_TIMEOUT)
 
     def item_author_name(self, item):
         return item.author.username
@@ -47,7 +41,7 @@ class TagFeed(Feed, SiteMixin):
 
     def get_object(self, request, slug):
         try:
-            return Tag.objects.get(slug__iexact=slug)
+            return Tag.objects.get_by_slug(slug)
         except Tag.DoesNotExist:
             raise FeedDoesNotExist
 
@@ -64,20 +58,14 @@ class TagFeed(Feed, SiteMixin):
         return self.item_set(obj)[:10]
 
     def item_set(self, obj):
-        key = 'articles_for_%s' % obj.name
-        articles = cache.get(key)
-
-        if articles is None:
-            articles = list(obj.article_set.live().order_by('-publish_date'))
-            cache.set(key, articles, FEED_TIMEOUT)
-
-        return articles
+        return caching.get_or_set('feeds', 'tag_%s:%s' % (obj.pk, settings.SITE_ID),
+                lambda: list(obj.article_set.visible()), FEED_TIMEOUT)
 
     def item_author_name(self, item):
         return item.author.username
 
     def item_author_link(self, item):
-        return reverse('articles_by_author', args=[item.author.username])
+        return item.get_author_url()
 
     def item_pubdate(self, item):
         return item.publish_date
@@ -1,25 +1,86 @@
 import logging
 
 from django import forms
+from django.db.models import signals
+from django.utils.datastructures import SortedDict
+from django.utils.functional import lazy
 from django.utils.translation import ugettext_lazy as _
-from models import Article, Tag
+from models import Article, ArticleStatus, Tag
+from search import deferred_indexing
 
 log = logging.getLogger('articles.forms')
 
 def tag(name):
     """Returns a Tag object for the given name"""
 
-    slug = Tag.clean_tag(name)
+    return tags([name])[0]
 
-    log.debug('Looking for Tag with slug "%s"...' % (slug,))
-    t, created = Tag.objects.get_or_create(slug=slug, defaults={'name': name})
-    log.debug('Found Tag %s. Name: %s Slug: %s Created: %s' % (t.pk, t.name, t.slug, created))
+def tags(names):
+    """
+    Returns Tag objects for the given names, in the same order, creating any
+    that do not exist yet.  Existing tags are found with a single query and new
+    tags are inserted in bulk.
+    """
 
-    if not t.name:
-        t.name = name
-        t.save()
+    wanted = SortedDict()
+    for name in names:
+        wanted.setdefault(Tag.clean_tag(name), name)
 
-    return t
+    log.debug('Looking for Tags with slugs %s...' % (wanted.keys(),))
+    found = dict((t.slug, t) for t in Tag.objects.filter(slug__in=wanted.keys()))
+
+    missing = [Tag(name=name, slug=slug) for slug, name in wanted.items() if slug not in found]
+    if len(missing):
+        log.debug('Creating Tags: %s' % (missing,))
+        Tag.objects.bulk_create(missing)
+
+        # bulk_create doesn't hand back primary keys everywhere
+        created = Tag.objects.filter(slug__in=[t.slug for t in missing])
+        for t in created:
+            found[t.slug] = t
+
+            # let the auto-tagging listener know about the new tag
+            signals.post_save.send(sender=Tag, instance=t, created=True, raw=False, using=t._state.db)
+
+    for slug, t in found.items():
+        if not t.name:
+            t.name = wanted[slug]
+            t.save()
+
+    return [found[slug] for slug in wanted]
+
+class TagAutocompleteMedia:
+    css = {
+        'all': ('articles/css/jquery.autocomplete.css',),
+    }
+    js = (
+        'articles/js/jquery-1.4.1.min.js',
+        'articles/js/jquery.bgiframe.min.js',
+        'articles/js/jquery.autocomplete.pack.js',
+        'articles/js/tag_autocomplete.js',
+    )
+
+class ApplyTagsForm(forms.Form):
+    """Intermediate form for the "apply tags" admin action"""
+
+    tags = forms.CharField(widget=forms.TextInput(attrs={'size': 100}),
+                           help_text=_('Tags to apply to the selected articles'))
+
+    def clean_tags(self):
+        """Turns the string of tags into a list"""
+
+        names = [t.strip() for t in self.cleaned_data['tags'].split() if len(t.strip())]
+        if not len(names):
+            raise forms.ValidationError(_('Please enter at least one tag.'))
+
+        return tags(names)
+
+    Media = TagAutocompleteMedia
+
+class SetStatusForm(forms.Form):
+    """Intermediate form for the "set status" admin action"""
+
+    status = forms.ModelChoiceField(queryset=ArticleStatus.objects.all())
 
 class ArticleAdminForm(forms.ModelForm):
     tags = forms.CharField(initial='', required=False,
@@ -31,8 +92,10 @@ class ArticleAdminForm(forms.ModelForm):
 
         instance = kwargs.get('instance', None)
         if instance:
+            # only look up the tag names if they're actually displayed
+            names = lambda: u' '.join(instance.tags.values_list('name', flat=True))
             init = kwargs.get('initial', {})
-            init['tags'] = ' '.join([t.name for t in instance.tags.all()])
+            init['tags'] = lazy(names, unicode)()
             kwargs['initial'] = init
 
         super(ArticleAdminForm, self).__init__(*args, **kwargs)
@@ -40,29 +103,57 @@ class ArticleAdminForm(forms.ModelForm):
     def clean_tags(self):
         """Turns the string of tags into a list"""
 
-        tags = [tag(t.strip()) for t in self.cleaned_data['tags'].split() if len(t.strip())]
+        names = [t.strip() for t in self.cleaned_data['tags'].split() if len(t.strip())]
+        tag_list = tags(names)
 
-        log.debug('Tagging Article %s with: %s' % (self.cleaned_data['title'], tags))
-        self.cleaned_data['tags'] = tags
+        log.debug('Tagging Article %s with: %s' % (self.cleaned_data['title'], tag_list))
+        self.cleaned_data['tags'] = tag_list
         return self.cleaned_data['tags']
 
-    def save(self, *args, **kwargs):
-        """Remove any old tags that may have been set that we no longer need"""
-        if self.instance.pk:
-            self.instance.tags.clear()
-        return super(ArticleAdminForm, self).save(*args, **kwargs)
+    def save(self, commit=True):
+        """
+        Saves the article, applying only the tag changes instead of clearing
+        and re-adding every tag.
+        """
+
+        instance = super(ArticleAdminForm, self).save(commit=False)
+        save_m2m = self.save_m2m
+
+        def save_all_m2m():
+            tag_list = self.cleaned_data.pop('tags', None)
+            try:
+                save_m2m()
+            finally:
+                if tag_list is not None:
+                    self.cleaned_data['tags'] = tag_list
+
+            if tag_list is not None:
+                self.save_tags(instance, tag_list)
+
+        self.save_m2m = save_all_m2m
+
+        if commit:
+            instance.save()
+            self.save_m2m()
+
+        return instance
+
+    def save_tags(self, instance, tag_list):
+        """Adds and removes tags so the article ends up with ``tag_list``"""
+
+        current = set(instance.tags.values_list('id', flat=True))
+        wanted = set(t.pk for t in tag_list)
+
+        with deferred_indexing():
+            added = wanted - current
+            if len(added):
+                instance.tags.add(*added)
+
+            removed = current - wanted
+            if len(removed):
+                instance.tags.remove(*removed)
 
     class Meta:
         model = Article
 
-    class Media:
-        css = {
-            'all': ('articles/css/jquery.autocomplete.css',),
-        }
-        js = (
-            'articles/js/jquery-1.4.1.min.js',
-            'articles/js/jquery.bgiframe.min.js',
-            'articles/js/jquery.autocomplete.pack.js',
-            'articles/js/tag_autocomplete.js',
-        )
-
+    Media = TagAutocompleteMedia
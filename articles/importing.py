@@ -0,0 +1,246 @@
+"""
+Imports articles in bulk.
+
+Saving an article runs every stage of ``Article.save`` and each of the
+listeners that follow it, with several queries apiece.  That's fine for an
+editor saving one article, but far too slow for moving a whole site over or
+taking in a large batch from elsewhere.  ``bulk_import`` applies the same
+fix-ups to a chunk of articles at a time instead:
+
+* markup is rendered by a pool of processes;
+* slugs are made unique with one query per year and chunk rather than one
+  per attempt;
+* auto-tagging looks each article's words up in an index of the tag names,
+  and only tries the patterns of the tags whose words all appear;
+* the articles and their tag and site rows are inserted with ``bulk_create``;
+* the visibility rows, search index and caches are updated once per chunk.
+
+Only one chunk of articles is held in memory at a time, so the input can be a
+generator reading from a file or another database.  No ``pre_save`` or
+``post_save`` signals are sent for imported articles; anything listening to
+``articles.signals.pages_affected`` is told that every page was affected.
+"""
+
+from collections import Counter, defaultdict
+from datetime import datetime
+from itertools import islice
+import logging
+import re
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import transaction
+from django.db.models import Q
+from django.template.defaultfilters import slugify
+
+from autocomplete import tag_index
+import caching
+from models import Article, Tag, DEFAULT_DB, published_in
+from related import mark_stale
+from rendering import render_all, start_pool, stop_pool
+from search import index_articles
+from signals import pages_affected
+
+# how many slugs to look for in one query; SQLite refuses statements with
+# more than 999 parameters
+SLUG_BATCH = 400
+
+WORD_RE = re.compile(r'\w+', re.U)
+
+log = logging.getLogger('articles.importing')
+
+class TagMatcher(object):
+    """
+    Finds the tags whose names appear as whole words in an article, the way
+    ``Article.matching_tags`` does, without trying every tag on every article.
+    Every word of a tag's name has to be one of the article's words for the
+    tag to match, so tags are indexed by the first word of their names.
+    """
+
+    def __init__(self, tags=()):
+        self.index = defaultdict(list)
+        self.known = set()
+        self.add(tags)
+
+    def add(self, tags):
+        for tag in tags:
+            if tag.pk in self.known:
+                continue
+
+            self.known.add(tag.pk)
+            words = WORD_RE.findall(tag.name.lower())
+            pattern = re.compile(r'\b%s\b' % re.escape(tag.name), re.I | re.U)
+            self.index[words[0] if words else None].append((tag, set(words), pattern))
+
+    def match(self, article):
+        to_search = (article.content, article.title, article.description, article.keywords)
+        words = set(WORD_RE.findall(' '.join(to_search).lower()))
+
+        matches = []
+        for word in list(words) + [None]:
+            for tag, needed, pattern in self.index.get(word, ()):
+                if needed <= words and any(pattern.search(text) for text in to_search):
+                    matches.append(tag)
+
+        return matches
+
+def group_by_year(articles):
+    by_year = defaultdict(list)
+    for article in articles:
+        # like get_unique_slug, there's nothing to do without a date
+        if type(article.publish_date) is datetime:
+            by_year[article.publish_date.year].append(article)
+
+    return by_year
+
+def allocate_slugs(articles, using=DEFAULT_DB):
+    """Gives each article a slug that's unique among the articles of its year"""
+
+    for article in articles:
+        if not len(article.slug.strip()):
+            article.slug = slugify(article.title)
+
+    for year, group in group_by_year(articles).items():
+        existing = Article.objects.using(using).filter(**published_in(year))
+        bases = sorted(set(a.slug for a in group))
+
+        taken = set()
+        for i in range(0, len(bases), SLUG_BATCH):
+            q = Q()
+            for base in bases[i:i + SLUG_BATCH]:
+                q |= Q(slug=base) | Q(slug__startswith=base + '-')
+            taken.update(existing.filter(q).values_list('slug', flat=True))
+
+        for article in group:
+            slug, counter = article.slug, 1
+            while slug in taken:
+                slug = '%s-%s' % (article.slug, counter)
+                counter += 1
+
+            taken.add(slug)
+            article.slug = slug
+
+def prepare(item, tag_names):
+    """Turns one item of the input into an unsaved article, its tags and sites"""
+
+    if isinstance(item, Article):
+        return item, [], None
+
+    fields = dict(item)
+    tags = list(fields.pop('tags', []))
+    sites = fields.pop('sites', None)
+
+    for tag in tags:
+        if not isinstance(tag, Tag):
+            tag_names.add(tag)
+
+    return Article(**fields), tags, sites
+
+def import_chunk(items, matcher, pool=None, using=DEFAULT_DB):
+    """Creates the articles of one chunk; returns their IDs"""
+
+    tag_names = set()
+    prepared = [prepare(item, tag_names) for item in items]
+
+    if tag_names:
+        from forms import tags as resolve_tags
+        named = dict((t.slug, t) for t in resolve_tags(sorted(tag_names)))
+        matcher.add(named.values())
+    else:
+        named = {}
+
+    articles = [article for article, tags, sites in prepared]
+    render_all(articles, pool)
+
+    users = User.objects.using(using).in_bulk(set(a.author_id for a in articles))
+    for article in articles:
+        article.author = users[article.author_id]
+
+    # the same stages, in the same order, as saving a new article
+    for article, tags, sites in prepared:
+        article.do_addthis_button(using)
+        article.do_meta_description(using)
+
+        tags = [t if isinstance(t, Tag) else named[Tag.clean_tag(t)] for t in tags]
+        if article.auto_tag:
+            tags.extend(t for t in matcher.match(article) if t not in tags)
+        article._pending['tags'] = tags
+
+        article.do_tags_to_keywords(using)
+
+    allocate_slugs(articles, using)
+    Article.objects.using(using).bulk_create(articles)
+
+    # bulk_create doesn't hand back primary keys everywhere
+    ids = {}
+    for year, group in group_by_year(articles).items():
+        slugs = [a.slug for a in group]
+        for i in range(0, len(slugs), SLUG_BATCH):
+            found = Article.objects.using(using).filter(slug__in=slugs[i:i + SLUG_BATCH], **published_in(year))
+            ids.update(((slug, year), pk) for pk, slug in found.values_list('id', 'slug'))
+
+    tag_rows = []
+    site_rows = []
+    for article, tags, sites in prepared:
+        article.id = ids[(article.slug, article.publish_date.year)]
+        article._state.adding = False
+        article._state.db = using
+
+        tag_rows.extend(Article.tags.through(article_id=article.id, tag_id=t.pk)
+                        for t in article._pending.pop('tags'))
+        site_rows.extend(Article.sites.through(article_id=article.id, site_id=getattr(site, 'pk', site))
+                         for site in (sites or [settings.SITE_ID]))
+
+    Article.tags.through.objects.using(using).bulk_create(tag_rows)
+    tag_index.adjust(Counter(row.tag_id for row in tag_rows))
+    Article.sites.through.objects.using(using).bulk_create(site_rows)
+
+    article_ids = [a.id for a in articles]
+    Article.objects.refresh_visibility(article_ids, using)
+    index_articles(articles, using)
+    mark_stale(article_ids)
+
+    # let the scheduler know about anything that publishes or expires later
+    now = datetime.now()
+    upcoming = [when for a in articles for when in (a.publish_date, a.expiration_date)
+                if isinstance(when, datetime) and when > now]
+    if upcoming:
+        Article.objects.note_transition(min(upcoming))
+
+    return article_ids
+
+def bulk_import(articles, chunk_size=500, processes=1, using=DEFAULT_DB):
+    """
+    Creates articles from an iterable of dictionaries of field values, or of
+    unsaved ``Article`` instances.  A dictionary may also have ``tags`` (tag
+    objects or names; missing tags are created) and ``sites`` (site objects or
+    IDs; the current site by default).  Articles are prepared like
+    ``Article.save`` would, ``chunk_size`` at a time, with markup rendered by
+    ``processes`` processes.  Each chunk is committed on its own.
+
+    Returns the number of articles created.
+    """
+
+    matcher = TagMatcher(Tag.objects.using(using).all())
+
+    pool = start_pool(processes)
+    articles = iter(articles)
+    count = 0
+    try:
+        while True:
+            chunk = list(islice(articles, chunk_size))
+            if not chunk:
+                break
+
+            with transaction.commit_on_success(using=using):
+                count += len(import_chunk(chunk, matcher, pool, using))
+            log.debug('Imported %s articles' % count)
+    finally:
+        stop_pool(pool)
+
+    if count:
+        caching.bump('feeds', 'archives', 'tag_cloud', 'queries')
+        if pages_affected.receivers:
+            pages_affected.send(sender=Article, urls=None)
+
+    return count
@@ -1,9 +1,17 @@
 import logging
 
-from django.db.models import signals, Q
+from django.contrib.auth.models import User
+from django.db.models import signals
 
+from autocomplete import tag_index
+import caching
+from dependencies import affected_urls, snapshots, tag_affected_urls
 from decorators import logtime
-from models import Article, Tag
+from models import Article, ArticleStatus, ArticleVisibility, Tag, LOOKUP_LINK_TITLE, display_name, expire_cached_queries
+from related import curate, mark_stale, uncurate
+from search import INDEXED_FIELDS, index_articles
+from signals import articles_transitioned, pages_affected
+import tasks
 
 log = logging.getLogger('articles.listeners')
 
@@ -11,24 +19,297 @@ log = logging.getLogger('articles.listeners')
 def apply_new_tag(sender, instance, created, using='default', **kwargs):
     """Applies new tags to existing articles that are marked for auto-tagging"""
 
-    # attempt to find all articles that contain the new tag
-    # TODO: make sure this is standard enough... seems that both MySQL and
-    # PostgreSQL support it...
-    tag = r'[[:<:]]%s[[:>:]]' % instance.name
-
-    log.debug('Searching for auto-tag Articles using regex: %s' % (tag,))
-    applicable_articles = Article.objects.filter(
-        Q(auto_tag=True),
-        Q(content__iregex=tag) |
-        Q(title__iregex=tag) |
-        Q(description__iregex=tag) |
-        Q(keywords__iregex=tag)
-    )
-
-    log.debug('Found %s matches' % len(applicable_articles))
-    for article in applicable_articles:
-        log.debug('Applying Tag "%s" (%s) to Article "%s" (%s)' % (instance, instance.pk, article.title, article.pk))
-        article.tags.add(instance)
-        article.save()
+    tasks.dispatch('apply_new_tag', instance.pk, using=using)
 
 signals.post_save.connect(apply_new_tag, sender=Tag)
+
+def refresh_site_visibility(sender, instance, action, reverse, pk_set, using='default', **kwargs):
+    """Keeps visibility rows in sync when the sites for an article change"""
+
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+
+    if not reverse:
+        Article.objects.refresh_visibility([instance.pk], using)
+    elif action == 'post_clear':
+        # the articles are already gone from this site
+        ArticleVisibility.objects.using(using).filter(site=instance).delete()
+    else:
+        Article.objects.refresh_visibility(pk_set, using)
+
+    expire_cached_queries()
+
+signals.m2m_changed.connect(refresh_site_visibility, sender=Article.sites.through)
+
+def expire_statuses(sender, instance, **kwargs):
+    """The default status or the live ones may have changed"""
+
+    caching.bump('statuses', 'queries')
+
+# before visibility is refreshed with the new live statuses
+signals.post_save.connect(expire_statuses, sender=ArticleStatus)
+signals.post_delete.connect(expire_statuses, sender=ArticleStatus)
+
+def refresh_status_visibility(sender, instance, created, using='default', **kwargs):
+    """Articles come and go when a status is marked live or not live"""
+
+    if created:
+        return
+
+    ids = Article.objects.using(using).filter(status=instance).values_list('id', flat=True)
+    Article.objects.refresh_visibility(ids, using)
+
+signals.post_save.connect(refresh_status_visibility, sender=ArticleStatus)
+
+def expire_listing_caches(sender, published, expired, **kwargs):
+    """Clears cached listings when articles are published or retired"""
+
+    log.debug('Clearing cached listings')
+    caching.bump('feeds', 'archives', 'tag_cloud', 'queries')
+
+articles_transitioned.connect(expire_listing_caches)
+
+def expire_names(sender, instance, created, **kwargs):
+    """Forgets cached names when somebody's name changes, but not when they just log in"""
+
+    cached = caching.get('names', instance.pk)
+    if cached is not None and cached != display_name(instance):
+        caching.bump('names')
+
+signals.post_save.connect(expire_names, sender=User)
+
+def track_relation_changes(sender, instance, action, reverse, **kwargs):
+    """The next save of an article redoes whatever depends on its tags or sites"""
+
+    if not reverse and action.startswith('post_'):
+        field = 'tags' if sender is Article.tags.through else 'sites'
+        instance.mark_changed(field)
+
+signals.m2m_changed.connect(track_relation_changes, sender=Article.tags.through)
+signals.m2m_changed.connect(track_relation_changes, sender=Article.sites.through)
+
+def queue_link_titles(sender, instance, raw=False, using='default', **kwargs):
+    """Looks up the titles of linked pages in the background, before anybody asks"""
+
+    if tasks.ASYNC_TASKS and LOOKUP_LINK_TITLE and not raw and instance.fields_saved(['rendered_content']):
+        tasks.enqueue('lookup_link_titles', [instance.pk], using=using)
+
+signals.post_save.connect(queue_link_titles, sender=Article)
+
+def expire_article_queries(sender, instance, **kwargs):
+    """Cached query results, feeds and archives may include the article that just changed"""
+
+    if kwargs.get('signal') is signals.post_delete:
+        caching.bump('queries', 'feeds', 'archives', 'tag_cloud')
+    elif instance.fields_saved(instance.VISIBILITY_FIELDS + instance.LISTED_FIELDS):
+        caching.bump('queries', 'feeds', 'archives')
+    else:
+        expire_cached_queries()
+
+signals.post_save.connect(expire_article_queries, sender=Article)
+signals.post_delete.connect(expire_article_queries, sender=Article)
+
+def expire_tag_listings(sender, instance, action, **kwargs):
+    """Tag feeds and the tag cloud count the articles with each tag"""
+
+    if action in ('post_add', 'post_remove', 'post_clear'):
+        caching.bump('feeds', 'tag_cloud')
+
+signals.m2m_changed.connect(expire_tag_listings, sender=Article.tags.through)
+
+def expire_tags(sender, instance, **kwargs):
+    """Tags are cached by slug"""
+
+    caching.bump('tags')
+
+signals.post_save.connect(expire_tags, sender=Tag)
+signals.post_delete.connect(expire_tags, sender=Tag)
+
+def index_tag(sender, instance, **kwargs):
+    """Keeps the tag auto-completion index current"""
+
+    tag_index.add(instance)
+
+def unindex_tag(sender, instance, **kwargs):
+    tag_index.remove(instance)
+
+signals.post_save.connect(index_tag, sender=Tag)
+signals.post_delete.connect(unindex_tag, sender=Tag)
+
+def recount_tags(sender, instance, action, reverse, pk_set, **kwargs):
+    """Tags are suggested by how many articles use them"""
+
+    amount = 1 if action == 'post_add' else -1
+    if reverse:
+        # the articles of one tag changed
+        if action == 'post_clear':
+            tag_index.set_counts({instance.pk: 0})
+        elif action in ('post_add', 'post_remove'):
+            tag_index.adjust({instance.pk: amount * len(pk_set)})
+    elif action == 'pre_clear':
+        remember_article_tags(sender, instance)
+    elif action == 'post_clear':
+        recount_article_tags(sender, instance)
+    elif action in ('post_add', 'post_remove'):
+        tag_index.adjust(dict((pk, amount) for pk in pk_set))
+
+def remember_article_tags(sender, instance, **kwargs):
+    instance._index_tag_ids = list(instance.tags.values_list('id', flat=True))
+
+def recount_article_tags(sender, instance, **kwargs):
+    tag_index.adjust(dict((pk, -1) for pk in instance.__dict__.pop('_index_tag_ids', [])))
+
+signals.m2m_changed.connect(recount_tags, sender=Article.tags.through)
+signals.pre_delete.connect(remember_article_tags, sender=Article)
+signals.post_delete.connect(recount_article_tags, sender=Article)
+
+def index_article(sender, instance, raw=False, using='default', **kwargs):
+    """Keeps an article's entry in the search index current"""
+
+    if not raw and instance.fields_saved(INDEXED_FIELDS):
+        index_articles([instance], using)
+
+def index_article_tags(sender, instance, action, reverse, pk_set, using='default', **kwargs):
+    """Articles are searchable by their tags too"""
+
+    if reverse and action == 'pre_clear':
+        # remember which articles are about to lose the tag
+        instance._cleared_article_ids = list(instance.article_set.using(using).values_list('id', flat=True))
+        return
+
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+
+    if not reverse:
+        index_articles([instance], using)
+    else:
+        if action == 'post_clear':
+            pk_set = getattr(instance, '_cleared_article_ids', [])
+        index_articles(Article.objects.using(using).filter(id__in=pk_set), using)
+
+def index_renamed_tag(sender, instance, created, raw=False, using='default', **kwargs):
+    """Articles using a tag need to be found by its new name"""
+
+    if not created and not raw:
+        index_articles(instance.article_set.using(using).all(), using)
+
+signals.post_save.connect(index_article, sender=Article)
+signals.m2m_changed.connect(index_article_tags, sender=Article.tags.through)
+signals.post_save.connect(index_renamed_tag, sender=Tag)
+
+def refresh_related(sender, instance, raw=False, **kwargs):
+    """Related articles are recomputed for articles whose words change"""
+
+    if not raw and instance.fields_saved(INDEXED_FIELDS):
+        mark_stale([instance.pk])
+
+def refresh_related_tags(sender, instance, action, reverse, pk_set, **kwargs):
+    """Shared tags are part of what makes articles related"""
+
+    if action in ('post_add', 'post_remove'):
+        mark_stale(pk_set if reverse else [instance.pk])
+    elif action == 'post_clear' and not reverse:
+        mark_stale([instance.pk])
+
+def copy_curated_related(sender, instance, action, reverse, pk_set, using='default', **kwargs):
+    """Hand-picked related articles are displayed right away"""
+
+    if action == 'pre_clear':
+        instance._cleared_related_ids = list(instance.related_articles.using(using).values_list('id', flat=True))
+    elif action == 'post_add':
+        curate(instance.pk, pk_set, using)
+    elif action == 'post_remove':
+        uncurate(instance.pk, pk_set, using)
+    elif action == 'post_clear':
+        uncurate(instance.pk, getattr(instance, '_cleared_related_ids', []), using)
+
+signals.post_save.connect(refresh_related, sender=Article)
+signals.m2m_changed.connect(refresh_related_tags, sender=Article.tags.through)
+signals.m2m_changed.connect(copy_curated_related, sender=Article.related_articles.through)
+
+def remember_pages(instance, article_ids, using='default'):
+    """Notes how articles look before they change, if anyone wants to know"""
+
+    if pages_affected.receivers:
+        instance._page_snapshots = snapshots(article_ids, using)
+
+def send_pages_affected(instance, article_ids, using='default'):
+    """Lets listeners know which pages changed along with some articles"""
+
+    if pages_affected.receivers:
+        before = instance.__dict__.pop('_page_snapshots', {})
+        urls = affected_urls(before, snapshots(article_ids, using), using)
+        if urls is None or urls:
+            log.debug('Pages affected: %s' % (urls,))
+            pages_affected.send(sender=Article, urls=urls)
+
+def remember_article_pages(sender, instance, raw=False, using='default', **kwargs):
+    if instance.pk and not raw:
+        remember_pages(instance, [instance.pk], using)
+
+def send_article_pages(sender, instance, raw=False, using='default', **kwargs):
+    if not raw:
+        send_pages_affected(instance, [instance.pk], using)
+
+def track_listing_pages(sender, instance, action, reverse, pk_set, using='default', **kwargs):
+    """Tags and sites decide which listings an article is in"""
+
+    if not pages_affected.receivers:
+        return
+
+    if not reverse:
+        article_ids = [instance.pk]
+    elif action.endswith('_clear'):
+        article_ids = getattr(instance, '_page_article_ids', None)
+        if article_ids is None:
+            article_ids = instance._page_article_ids = list(instance.article_set.values_list('id', flat=True))
+    else:
+        article_ids = pk_set
+
+    if action.startswith('pre_'):
+        remember_pages(instance, article_ids, using)
+    else:
+        instance.__dict__.pop('_page_article_ids', None)
+        send_pages_affected(instance, article_ids, using)
+
+def send_transition_pages(sender, published, expired, **kwargs):
+    if pages_affected.receivers:
+        after = snapshots(list(published) + list(expired))
+        before = dict((pk, s._replace(visible=pk in expired)) for pk, s in after.items())
+        urls = affected_urls(before, after)
+        if urls is None or urls:
+            pages_affected.send(sender=Article, urls=urls)
+
+def remember_tag_pages(sender, instance, raw=False, using='default', **kwargs):
+    if pages_affected.receivers and instance.pk and not raw:
+        try:
+            old = Tag.objects.using(using).get(pk=instance.pk)
+        except Tag.DoesNotExist:
+            return
+        instance._page_tag = (old.slug, old.name)
+        instance._page_article_ids = list(instance.article_set.using(using).values_list('id', flat=True))
+
+def send_tag_pages(sender, instance, using='default', **kwargs):
+    """Renamed and deleted tags affect their listings and their articles"""
+
+    old = instance.__dict__.pop('_page_tag', None)
+    article_ids = instance.__dict__.pop('_page_article_ids', [])
+    if not pages_affected.receivers or old is None:
+        return
+
+    old_slug, old_name = old
+    new_slug = None if kwargs.get('signal') is signals.post_delete else instance.slug
+    if (old_slug, old_name) != (new_slug, instance.name):
+        pages_affected.send(sender=Tag, urls=tag_affected_urls(old_slug, new_slug, article_ids, using))
+
+signals.pre_save.connect(remember_article_pages, sender=Article)
+signals.post_save.connect(send_article_pages, sender=Article)
+signals.pre_delete.connect(remember_article_pages, sender=Article)
+signals.post_delete.connect(send_article_pages, sender=Article)
+signals.m2m_changed.connect(track_listing_pages, sender=Article.tags.through)
+signals.m2m_changed.connect(track_listing_pages, sender=Article.sites.through)
+articles_transitioned.connect(send_transition_pages)
+signals.pre_save.connect(remember_tag_pages, sender=Tag)
+signals.post_save.connect(send_tag_pages, sender=Tag)
+signals.pre_delete.connect(remember_tag_pages, sender=Tag)
+signals.post_delete.connect(send_tag_pages, sender=Tag)
@@ -0,0 +1,31 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from articles.models import DEFAULT_DB
+from articles.related import RELATED_COUNT, rebuild, update_stale
+
+class Command(BaseCommand):
+    help = """Finds the most similar articles for each article"""
+
+    option_list = BaseCommand.option_list + (
+        make_option('--stale', action='store_true', dest='stale', default=False, help='Only update articles affected by changes since the last run'),
+        make_option('--count', dest='count', default=RELATED_COUNT, type='int', help='Number of related articles to keep for each article'),
+        make_option('--batch-size', dest='batch_size', default=500, type='int', help='Number of articles to store at a time'),
+        make_option('--database', dest='database', default=DEFAULT_DB, help='Database to use'),
+    )
+
+    def log(self, message, level=2):
+        if self.verbosity >= level:
+            print message
+
+    def handle(self, *args, **options):
+        self.verbosity = int(options.get('verbosity', 1))
+        kwargs = dict(using=options['database'], batch_size=options['batch_size'], count=options['count'])
+
+        if options['stale']:
+            count = update_stale(**kwargs)
+        else:
+            count = rebuild(**kwargs)
+
+        self.log('Updated related articles for %s articles' % count, 1)
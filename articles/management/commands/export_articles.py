@@ -0,0 +1,34 @@
+from multiprocessing import cpu_count
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from articles.export import export
+
+class Command(BaseCommand):
+    args = '<directory>'
+    help = """Renders every public article page to static files"""
+
+    option_list = BaseCommand.option_list + (
+        make_option('--full', action='store_true', dest='full', default=False, help='Render every page, not just the ones that changed'),
+        make_option('--processes', dest='processes', default=cpu_count(), type='int', help='Number of processes to render pages with'),
+    )
+
+    def log(self, message, level=2):
+        if self.verbosity >= level:
+            print message
+
+    def handle(self, *args, **options):
+        self.verbosity = int(options.get('verbosity', 1))
+
+        if len(args) != 1:
+            raise CommandError('Please specify the directory to export to')
+
+        rendered, removed = export(args[0], options['processes'], options['full'])
+
+        for url in sorted(rendered):
+            self.log('Rendered %s' % url)
+        for url in sorted(removed):
+            self.log('Removed %s' % url)
+
+        self.log('Rendered %s pages and removed %s' % (len(rendered), len(removed)), 1)
@@ -0,0 +1,37 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from articles.models import Article, DEFAULT_DB
+from articles.search import get_backend
+
+class Command(BaseCommand):
+    help = """Indexes every article for searching"""
+
+    option_list = BaseCommand.option_list + (
+        make_option('--chunk-size', dest='chunk_size', default=200, type='int', help='Number of articles to index at a time'),
+        make_option('--database', dest='database', default=DEFAULT_DB, help='Database to index'),
+    )
+
+    def log(self, message, level=2):
+        if self.verbosity >= level:
+            print message
+
+    def handle(self, *args, **options):
+        self.verbosity = int(options.get('verbosity', 1))
+        using = options['database']
+        backend = get_backend(using)
+
+        if hasattr(backend, 'install'):
+            backend.install()
+
+        ids = list(Article.objects.using(using).values_list('id', flat=True).order_by('id'))
+        size = options['chunk_size']
+
+        for start in range(0, len(ids), size):
+            chunk = ids[start:start + size]
+            self.log('Indexing articles %s through %s' % (chunk[0], chunk[-1]))
+            articles = Article.objects.using(using).filter(id__in=chunk).prefetch_related('tags')
+            backend.index(articles)
+
+        self.log('Indexed %s articles' % len(ids), 1)
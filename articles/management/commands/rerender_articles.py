@@ -0,0 +1,46 @@
+from datetime import datetime
+from multiprocessing import cpu_count
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from articles.models import Article, DEFAULT_DB, MARKUP_OPTIONS
+from articles.rendering import rerender
+
+class Command(BaseCommand):
+    help = """Renders the markup of articles again, after the renderers or markup options change"""
+
+    option_list = BaseCommand.option_list + (
+        make_option('--markup', action='append', dest='markup', default=[], choices=[m for m, name in MARKUP_OPTIONS], help='Only articles using this markup; may be given more than once'),
+        make_option('--since', dest='since', default=None, help='Only articles published on or after this date (YYYY-MM-DD)'),
+        make_option('--dry-run', action='store_true', dest='dry_run', default=False, help='Report which articles would change without writing anything'),
+        make_option('--chunk-size', dest='chunk_size', default=500, type='int', help='Number of articles to render at a time'),
+        make_option('--processes', dest='processes', default=cpu_count(), type='int', help='Number of processes to render with'),
+        make_option('--database', dest='database', default=DEFAULT_DB, help='Database to update'),
+    )
+
+    def log(self, message, level=2):
+        if self.verbosity >= level:
+            print message
+
+    def handle(self, *args, **options):
+        self.verbosity = int(options.get('verbosity', 1))
+
+        articles = Article.objects.using(options['database']).all()
+        if options['markup']:
+            articles = articles.filter(markup__in=options['markup'])
+
+        if options['since']:
+            try:
+                since = datetime.strptime(options['since'], '%Y-%m-%d')
+            except ValueError:
+                raise CommandError('Please give --since as YYYY-MM-DD')
+            articles = articles.filter(publish_date__gte=since)
+
+        checked, changed = rerender(articles, options['chunk_size'], options['processes'], options['dry_run'])
+
+        for pk in changed:
+            self.log('%s article %s' % ('Would update' if options['dry_run'] else 'Updated', pk))
+
+        self.log('%s articles checked; %s %s' % (checked, len(changed),
+                 'would change' if options['dry_run'] else 'changed'), 1)
@@ -0,0 +1,62 @@
+from datetime import datetime, timedelta
+from optparse import make_option
+import time
+
+from django.core.management.base import BaseCommand
+from django.db.models import Q
+
+from articles.models import Article
+from articles.rendering import rerender
+
+class Command(BaseCommand):
+    help = """Publishes scheduled articles and retires expired ones as their time comes, and renders articles that have no rendered content"""
+
+    option_list = BaseCommand.option_list + (
+        make_option('--daemon', action='store_true', dest='daemon', default=False, help='Keep running, waking up at each publish or expiration boundary'),
+        make_option('--max-sleep', dest='max_sleep', default=300, type='int', help='Longest time, in seconds, to sleep between checks when running as a daemon'),
+        make_option('--render-interval', dest='render_interval', default=86400, type='int', help='Time, in seconds, between looking for unrendered articles when running as a daemon'),
+    )
+
+    def log(self, message, level=2):
+        if self.verbosity >= level:
+            print message
+
+    def handle(self, *args, **options):
+        self.verbosity = int(options.get('verbosity', 1))
+        max_sleep = options['max_sleep']
+        since = rendered_at = None
+
+        while True:
+            now = datetime.now()
+            published, expired = Article.objects.process_transitions(since, now)
+            self.log('Published %s and expired %s articles' % (len(published), len(expired)))
+            since = now
+
+            # the scan reads every article, so it only runs at startup and
+            # then once in a long while
+            if rendered_at is None or now - rendered_at >= timedelta(seconds=options['render_interval']):
+                self.render()
+                rendered_at = now
+
+            if not options['daemon']:
+                break
+
+            # sleep until the next boundary, but check in every now and then
+            # in case something new was scheduled
+            delay = max_sleep
+            upcoming = Article.objects.next_transition(now)
+            if upcoming is not None:
+                remaining = upcoming - datetime.now()
+                delay = min(delay, remaining.days * 86400 + remaining.seconds + 1)
+
+            self.log('Next boundary: %s; sleeping %s seconds' % (upcoming, delay))
+            time.sleep(max(delay, 0))
+
+    def render(self):
+        """Renders the articles with no rendered content"""
+
+        # articles loaded with no rendered content aren't saved on the spot
+        unrendered = Article.objects.filter(Q(rendered_content='') | Q(rendered_content__isnull=True))
+        checked, rendered = rerender(unrendered)
+        if rendered:
+            self.log('Rendered %s articles' % len(rendered))
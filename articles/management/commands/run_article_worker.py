@@ -0,0 +1,36 @@
+from optparse import make_option
+import time
+
+from django.core.management.base import BaseCommand
+
+from articles import tasks
+from articles.models import DEFAULT_DB
+
+class Command(BaseCommand):
+    help = """Runs the background tasks queued by the articles application"""
+
+    option_list = BaseCommand.option_list + (
+        make_option('--daemon', action='store_true', dest='daemon', default=False, help='Keep running, waiting for new tasks when the queue is empty'),
+        make_option('--interval', dest='interval', default=5, type='int', help='How long, in seconds, to wait for new tasks when running as a daemon'),
+        make_option('--batch-size', dest='batch_size', default=10, type='int', help='How many tasks to claim at a time'),
+        make_option('--database', dest='database', default=DEFAULT_DB, help='The database holding the queue'),
+    )
+
+    def log(self, message, level=2):
+        if self.verbosity >= level:
+            print message
+
+    def handle(self, *args, **options):
+        self.verbosity = int(options.get('verbosity', 1))
+        worker = tasks.worker_name()
+
+        while True:
+            done, failed = tasks.work(worker, options['batch_size'], options['database'])
+            self.log('%s ran %s tasks; %s failed' % (worker, done, failed))
+
+            if not options['daemon']:
+                break
+
+            # go straight on to the next batch while there's work to do
+            if not (done or failed):
+                time.sleep(options['interval'])
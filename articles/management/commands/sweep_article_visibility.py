@@ -0,0 +1,36 @@
+from datetime import datetime
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from articles.models import Article, ArticleVisibility, DEFAULT_DB
+
+class Command(BaseCommand):
+    help = """Prunes expired article visibility rows and optionally rebuilds all of them"""
+
+    option_list = BaseCommand.option_list + (
+        make_option('--rebuild', action='store_true', dest='rebuild', default=False, help='Rebuild the visibility rows for every article'),
+        make_option('--chunk-size', dest='chunk_size', default=500, type='int', help='Number of articles to rebuild at a time'),
+        make_option('--database', dest='database', default=DEFAULT_DB, help='Database to sweep'),
+    )
+
+    def log(self, message, level=2):
+        if self.verbosity >= level:
+            print message
+
+    def handle(self, *args, **options):
+        self.verbosity = int(options.get('verbosity', 1))
+        using = options['database']
+
+        expired = ArticleVisibility.objects.using(using).filter(expiration_date__lt=datetime.now())
+        self.log('Pruning %s expired visibility rows' % expired.count())
+        expired.delete()
+
+        if options['rebuild']:
+            ids = list(Article.objects.using(using).values_list('id', flat=True).order_by('id'))
+            size = options['chunk_size']
+
+            for start in range(0, len(ids), size):
+                chunk = ids[start:start + size]
+                self.log('Rebuilding visibility for articles %s through %s' % (chunk[0], chunk[-1]))
+                Article.objects.refresh_visibility(chunk, using)
@@ -1,12 +1,15 @@
+from collections import Counter, namedtuple
 from hashlib import sha1
 from datetime import datetime
 import logging
 import mimetypes
 import re
+import time
 import urllib
 
-from django.db import models
-from django.db.models import Q
+from django.db import models, router
+from django.db.models import Q, Min
+from django.db.models.sql.datastructures import EmptyResultSet
 from django.contrib.auth.models import User
 from django.contrib.markup.templatetags import markup
 from django.contrib.sites.models import Site
@@ -16,13 +19,26 @@ from django.template.defaultfilters import slugify, striptags
 from django.utils.translation import ugettext_lazy as _
 from django.utils.text import truncate_html_words
 
-from decorators import logtime, once_per_instance
+from decorators import logtime
+import caching
+import permalinks
+from signals import articles_transitioned
 
 WORD_LIMIT = getattr(settings, 'ARTICLES_TEASER_LIMIT', 75)
 AUTO_TAG = getattr(settings, 'ARTICLES_AUTO_TAG', True)
 DEFAULT_DB = getattr(settings, 'ARTICLES_DEFAULT_DB', 'default')
 LOOKUP_LINK_TITLE = getattr(settings, 'ARTICLES_LOOKUP_LINK_TITLE', True)
 
+# cache keys used to coordinate publish and expiration transitions
+TRANSITION_KEY = 'article_transition_window'
+TRANSITION_LOCK_KEY = 'article_transition_lock'
+TRANSITION_TIMEOUT = 86400
+
+# round the current time down to this many seconds in queries so that they
+# can be cached; 0 disables the rounding
+TIME_QUANTUM = getattr(settings, 'ARTICLES_TIME_QUANTUM', 0)
+QUERY_CACHE_TIMEOUT = getattr(settings, 'ARTICLES_QUERY_CACHE_TIMEOUT', 300)
+
 MARKUP_HTML = 'h'
 MARKUP_MARKDOWN = 'm'
 MARKUP_REST = 'r'
@@ -46,36 +62,133 @@ TAG_RE = re.compile('[^a-z0-9\-_\+\:\.]?', re.I)
 
 log = logging.getLogger('articles.models')
 
+def display_name(user):
+    """A user's full name, or their username if it hasn't been entered"""
+
+    if len(user.get_full_name().strip()):
+        log.debug('Using full name')
+        return user.get_full_name()
+
+    log.debug('Using username')
+    return user.username
+
 def get_name(user):
     """
     Provides a way to fall back to a user's username if their full name has not
     been entered.
     """
 
-    key = 'username_for_%s' % user.id
+    return caching.get_or_set('names', user.id, lambda: display_name(user), 86400, local=True)
+User.get_name = get_name
 
-    log.debug('Looking for "%s" in cache (%s)' % (key, user))
-    name = cache.get(key)
-    if not name:
-        log.debug('Name not found')
+def published_in(year, month=None, field='publish_date'):
+    """
+    Returns the filter arguments that select what was published in a year, or
+    in one month of it.  Unlike ``__year`` and ``__month`` lookups, a range
+    like this can be answered from an index on the date.
+    """
 
-        if len(user.get_full_name().strip()):
-            log.debug('Using full name')
-            name = user.get_full_name()
-        else:
-            log.debug('Using username')
-            name = user.username
+    year = int(year)
+    if month is None:
+        start, end = datetime(year, 1, 1), datetime(year + 1, 1, 1)
+    else:
+        month = int(month)
+        start = datetime(year, month, 1)
+        end = datetime(year + month // 12, month % 12 + 1, 1)
 
-        log.debug('Caching %s as "%s" for a while' % (key, name))
-        cache.set(key, name, 86400)
+    return {field + '__gte': start, field + '__lt': end}
 
-    return name
-User.get_name = get_name
+def render_markup(markup_type, content):
+    """Turns content written in one of the ``MARKUP_OPTIONS`` into HTML"""
+
+    if markup_type == MARKUP_MARKDOWN:
+        return markup.markdown(content)
+    elif markup_type == MARKUP_REST:
+        return markup.restructuredtext(content)
+    elif markup_type == MARKUP_TEXTILE:
+        return markup.textile(content)
+
+    return content
+
+def cached_results(key, evaluate, timeout=QUERY_CACHE_TIMEOUT, local=False):
+    """
+    Caches the results of ``evaluate`` under ``key`` like ``cached_query``
+    does, for results that depend on which articles are live.
+    """
+
+    limited = []
+
+    def expires(results):
+        boundary = Article.objects.boundary_after(Article.objects.current_time())
+        if boundary is None:
+            return timeout
+
+        # stale results must not be served once the boundary passes either
+        limited.append(True)
+        remaining = boundary - datetime.now()
+        return max(0, min(timeout, remaining.days * 86400 + remaining.seconds))
+
+    # a replica that hasn't caught up with the write that started this
+    # generation of keys would have its old rows cached until the next one
+    from routers import primary_reads
+    with primary_reads():
+        return caching.get_or_set('queries', key, evaluate, expires,
+                                  lambda results: 0 if limited else caching.STALE_TIMEOUT, local)
+
+def cached_query(queryset, timeout=QUERY_CACHE_TIMEOUT):
+    """
+    Evaluates a queryset, caching the results under a key made from its SQL and
+    parameters.  Cached results never outlive the next publish or expiration
+    boundary, and saving an article starts a new generation of keys.
+    """
+
+    # every replica shares the primary's results, so the database a router
+    # would pick isn't part of the key; only one asked for explicitly is
+    using = queryset._db or DEFAULT_DB
+    try:
+        sql, params = queryset.query.get_compiler(using).as_sql()
+    except EmptyResultSet:
+        return list(queryset)
+
+    key = sha1(('%s:%s:%r' % (using, sql, tuple(params))).encode('utf-8')).hexdigest()
+    return cached_results(key, lambda: list(queryset.all()), timeout)
+
+def expire_cached_queries():
+    """Makes every previously cached query result unreachable"""
+
+    caching.bump('queries')
+
+class TagManager(models.Manager):
+
+    def get_by_slug(self, slug, using=DEFAULT_DB):
+        """
+        Finds a tag by its slug, or by anything that cleans up to it, like its
+        name.  Tags are cached by slug, so the popular ones are usually found
+        without a query.  Raises ``Tag.DoesNotExist`` if there's no such tag.
+        """
+
+        slug = Tag.clean_tag(slug)
+
+        def load():
+            try:
+                return self.using(using).get(slug=slug)
+            except Tag.DoesNotExist:
+                return None
+
+        # remember missing tags too, but not for long
+        tag = caching.get_or_set('tags', '%s:%s' % (using, slug), load,
+                                 lambda tag: 3600 if tag else 60, local=True)
+        if tag is None:
+            raise Tag.DoesNotExist('No tag with the slug "%s"' % slug)
+
+        return tag
 
 class Tag(models.Model):
     name = models.CharField(max_length=64, unique=True)
     slug = models.CharField(max_length=64, unique=True, null=True, blank=True)
 
+    objects = TagManager()
+
     def __unicode__(self):
         return self.name
 
@@ -97,9 +210,14 @@ class Tag(models.Model):
         self.slug = Tag.clean_tag(self.name)
         super(Tag, self).save(*args, **kwargs)
 
-    @models.permalink
     def get_absolute_url(self):
-        return ('articles_display_tag', (self.cleaned,))
+        return permalinks.tag_url(tag=self.cleaned)
+
+    def get_rss_url(self):
+        return permalinks.tag_rss_url(slug=self.rss_name)
+
+    def get_atom_url(self):
+        return permalinks.tag_atom_url(slug=self.rss_name)
 
     @property
     def cleaned(self):
@@ -116,13 +234,27 @@ class Tag(models.Model):
 
 class ArticleStatusManager(models.Manager):
 
+    def registry(self, using=DEFAULT_DB):
+        """
+        Returns the default status and the IDs of the live statuses.  There
+        are only ever a handful of statuses, so they're loaded all at once and
+        cached until one of them changes.
+        """
+
+        def load():
+            statuses = list(self.using(using).all())
+            return {
+                'default': statuses and statuses[0] or None,
+                'live': frozenset(s.pk for s in statuses if s.is_live),
+            }
+
+        return caching.get_or_set('statuses', using, load, 3600, local=True)
+
     def default(self):
-        default = self.all()[:1]
+        return self.registry()['default']
 
-        if len(default) == 0:
-            return None
-        else:
-            return default[0]
+    def live_ids(self, using=DEFAULT_DB):
+        return self.registry(using)['live']
 
 class ArticleStatus(models.Model):
     name = models.CharField(max_length=50)
@@ -143,12 +275,51 @@ class ArticleStatus(models.Model):
 
 class ArticleManager(models.Manager):
 
+    def current_time(self):
+        """
+        Returns the time used to decide whether articles are published or
+        expired.  With ``ARTICLES_TIME_QUANTUM`` set, this is rounded down so
+        that identical queries share cache entries, unless a publish or
+        expiration boundary has passed since the rounded time, in which case
+        the exact time is used.
+        """
+
+        now = datetime.now()
+        if not TIME_QUANTUM:
+            return now
+
+        stamp = time.mktime(now.timetuple())
+        rounded = datetime.fromtimestamp(stamp - stamp % TIME_QUANTUM)
+
+        boundary = self.boundary_after(rounded)
+        if boundary is not None and boundary <= now:
+            return now
+
+        return rounded
+
+    def boundary_after(self, when):
+        """
+        Finds the next boundary after ``when``, caching the answer.  Without
+        ``ARTICLES_TIME_QUANTUM``, ``when`` is rounded down to the second so
+        that the calls made within a second share one lookup.
+        """
+
+        rounded = when if TIME_QUANTUM else when.replace(microsecond=0)
+        boundary = caching.get_or_set('boundaries', rounded.strftime('%Y%m%d%H%M%S.%f'),
+                                      lambda: self.next_transition(rounded), max(TIME_QUANTUM, 1), 0)
+
+        if boundary is not None and boundary <= when:
+            # it passed between the rounded time and ``when``
+            boundary = self.next_transition(when)
+
+        return boundary
+
     def active(self):
         """
         Retrieves all active articles which have been published and have not
         yet expired.
         """
-        now = datetime.now()
+        now = self.current_time()
         return self.get_query_set().filter(
                 Q(expiration_date__isnull=True) |
                 Q(expiration_date__gte=now),
@@ -164,8 +335,230 @@ class ArticleManager(models.Manager):
             # superusers get to see all articles
             return qs
         else:
-            # only show live articles to regular users
-            return qs.filter(status__is_live=True)
+            # only show live articles to regular users, without joining the
+            # status table
+            return qs.filter(status__in=ArticleStatus.objects.live_ids(qs.db))
+
+    def visible(self, site=None):
+        """
+        Retrieves all live articles for a site.  This relies on the
+        denormalized ``ArticleVisibility`` rows, so the database can answer it
+        with a range scan over the ``(site, publish_date)`` index instead of
+        checking the article and status tables.
+
+        Visibility rows only exist for articles that have been published and
+        have not yet expired, so there are no time predicates here and the
+        query stays the same until the next publish or expiration boundary.
+        The articles are sorted on the visibility rows' copy of the publish
+        date, so that the same index serves the ``ORDER BY``.
+        """
+
+        if site is None:
+            site = settings.SITE_ID
+
+        self.process_due_transitions()
+        return self.get_query_set().filter(visibility__site=site).order_by('-visibility__publish_date', 'title')
+
+    def listed(self, user=None, site=None):
+        """
+        Retrieves the articles that belong in public listings.  Superusers
+        still see every active article, while everyone else gets the cheaper
+        per-site visibility lookup.
+        """
+
+        if user is not None and user.is_superuser:
+            return self.live(user=user)
+
+        return self.visible(site)
+
+    def refresh_visibility(self, article_ids, using=DEFAULT_DB, now=None):
+        """
+        Rebuilds the visibility rows for the specified articles.  An article
+        is visible on each of its sites while it is active, has a live status,
+        has been published and has not expired.
+        """
+
+        article_ids = list(article_ids)
+        if not len(article_ids):
+            return
+
+        now = now or datetime.now()
+        log.debug('Refreshing visibility for %s articles' % len(article_ids))
+        ArticleVisibility.objects.using(using).filter(article__in=article_ids).delete()
+
+        rows = self.model.sites.through.objects.using(using).filter(
+                article__in=article_ids,
+                article__is_active=True,
+                article__status__in=ArticleStatus.objects.live_ids(using),
+                article__publish_date__lte=now).exclude(
+                article__expiration_date__lte=now).values_list(
+                    'article', 'site', 'article__publish_date',
+                    'article__expiration_date')
+
+        ArticleVisibility.objects.using(using).bulk_create([
+            ArticleVisibility(article_id=article_id, site_id=site_id,
+                              publish_date=publish_date,
+                              expiration_date=expiration_date)
+            for article_id, site_id, publish_date, expiration_date in rows])
+
+    def add_tags(self, article_ids, tags, using=DEFAULT_DB):
+        """
+        Applies tags to many articles at once by inserting the missing
+        article/tag rows in bulk.  Articles are not saved or re-rendered.
+
+        Returns the number of rows that were added.
+        """
+
+        article_ids = list(article_ids)
+        tag_ids = [t.pk for t in tags]
+        through = self.model.tags.through
+
+        existing = set(through.objects.using(using).filter(
+                article__in=article_ids, tag__in=tag_ids).values_list('article', 'tag'))
+
+        rows = [through(article_id=article_id, tag_id=tag_id)
+                for article_id in article_ids
+                for tag_id in tag_ids
+                if (article_id, tag_id) not in existing]
+
+        if not rows:
+            return 0
+
+        # bulk inserts don't send m2m_changed, so do what its listeners would
+        from autocomplete import tag_index
+        from dependencies import affected_urls, snapshots
+        from related import mark_stale
+        from search import index_articles
+        from signals import pages_affected
+
+        tagged = set(row.article_id for row in rows)
+        if pages_affected.receivers:
+            before = snapshots(tagged, using)
+
+        log.debug('Adding %s tag rows for %s articles' % (len(rows), len(article_ids)))
+        through.objects.using(using).bulk_create(rows)
+
+        caching.bump('tag_cloud', 'feeds', 'queries')
+
+        # the tags are part of what gets searched, and of what makes articles related
+        index_articles(self.model.objects.using(using).filter(id__in=tagged), using)
+        mark_stale(tagged)
+        tag_index.adjust(Counter(row.tag_id for row in rows))
+
+        if pages_affected.receivers:
+            urls = affected_urls(before, snapshots(tagged, using), using)
+            if urls is None or urls:
+                pages_affected.send(sender=self.model, urls=urls)
+
+        return len(rows)
+
+    def bulk_import(self, articles, chunk_size=500, processes=1, using=DEFAULT_DB):
+        """
+        Creates many articles at once, much faster than saving them one by
+        one.  See ``articles.importing.bulk_import``.
+        """
+
+        from importing import bulk_import
+        return bulk_import(articles, chunk_size, processes, using)
+
+    def next_transition(self, now=None):
+        """
+        Finds the next moment at which an active article is published or
+        expires.  Returns ``None`` if nothing is scheduled.
+        """
+
+        # replicas may not have caught up with newly scheduled articles
+        now = now or datetime.now()
+        qs = self.get_query_set().using(DEFAULT_DB).filter(is_active=True)
+
+        boundaries = [
+            qs.filter(publish_date__gt=now).aggregate(d=Min('publish_date'))['d'],
+            qs.filter(expiration_date__gt=now).aggregate(d=Min('expiration_date'))['d'],
+        ]
+        boundaries = [b for b in boundaries if b is not None]
+
+        if len(boundaries):
+            return min(boundaries)
+
+        return None
+
+    @logtime
+    def process_transitions(self, since=None, now=None):
+        """
+        Applies any publish and expiration transitions that have happened
+        between ``since`` and ``now``.  Expired articles are marked inactive in
+        bulk, newly published articles get their visibility rows, and the
+        ``articles_transitioned`` signal is sent so caches can be cleared.
+
+        When ``since`` is unknown, every published article without visibility
+        rows is considered.
+
+        Returns a tuple of the published and expired article IDs.
+        """
+
+        now = now or datetime.now()
+        qs = self.get_query_set().using(DEFAULT_DB).filter(is_active=True)
+
+        expired = list(qs.filter(expiration_date__lte=now).values_list('id', flat=True))
+        if len(expired):
+            log.debug('Expiring articles: %s' % (expired,))
+            self.get_query_set().using(DEFAULT_DB).filter(id__in=expired).update(is_active=False)
+            ArticleVisibility.objects.using(DEFAULT_DB).filter(article__in=expired).delete()
+
+        published = qs.filter(publish_date__lte=now, status__in=ArticleStatus.objects.live_ids(qs.db))
+        if since is not None:
+            published = published.filter(publish_date__gt=since)
+        else:
+            published = published.filter(visibility__isnull=True)
+        published = list(published.values_list('id', flat=True).distinct())
+
+        if len(published):
+            log.debug('Publishing articles: %s' % (published,))
+            self.refresh_visibility(published, now=now)
+
+        cache.set(TRANSITION_KEY, (now, self.next_transition(now)), TRANSITION_TIMEOUT)
+
+        if len(published) or len(expired):
+            articles_transitioned.send(sender=self.model,
+                                       published=published,
+                                       expired=expired)
+
+        return published, expired
+
+    def process_due_transitions(self):
+        """
+        Processes transitions if the next known boundary has passed.  This
+        normally costs a single cache lookup; the ``run_article_scheduler``
+        command keeps things moving without relying on incoming requests.
+        """
+
+        window = cache.get(TRANSITION_KEY)
+        now = datetime.now()
+
+        if window is not None and (window[1] is None or now < window[1]):
+            return
+
+        if not cache.add(TRANSITION_LOCK_KEY, True, 60):
+            # somebody else is already on it
+            return
+
+        try:
+            self.process_transitions(window and window[0], now)
+        finally:
+            cache.delete(TRANSITION_LOCK_KEY)
+
+    def note_transition(self, when):
+        """Makes sure a newly scheduled boundary is not missed"""
+
+        # boundaries looked up before it was scheduled don't know about it
+        caching.bump('boundaries')
+
+        window = cache.get(TRANSITION_KEY)
+        if window is None or when is None or when <= window[0]:
+            return
+
+        if window[1] is None or when < window[1]:
+            cache.set(TRANSITION_KEY, (window[0], when), TRANSITION_TIMEOUT)
 
 MARKUP_HELP = _("""Select the type of markup you are using in this article.
 <ul>
@@ -193,8 +586,8 @@ class Article(models.Model):
     followup_for = models.ManyToManyField('self', symmetrical=False, blank=True, help_text=_('Select any other articles that this article follows up on.'), related_name='followups')
     related_articles = models.ManyToManyField('self', blank=True)
 
-    publish_date = models.DateTimeField(default=datetime.now, help_text=_('The date and time this article shall appear online.'))
-    expiration_date = models.DateTimeField(blank=True, null=True, help_text=_('Leave blank if the article does not expire.'))
+    publish_date = models.DateTimeField(default=datetime.now, db_index=True, help_text=_('The date and time this article shall appear online.'))
+    expiration_date = models.DateTimeField(blank=True, null=True, db_index=True, help_text=_('Leave blank if the article does not expire.'))
 
     is_active = models.BooleanField(default=True, blank=True)
     login_required = models.BooleanField(blank=True, help_text=_('Enable this if users must login before they can read this article.'))
@@ -205,64 +598,147 @@ class Article(models.Model):
 
     objects = ArticleManager()
 
+    # the stages of saving an article, each with the fields it depends on;
+    # "tags" and "sites" stand for the many-to-many relations
+    SAVE_STAGES = (
+        ('do_render_markup', ('markup', 'content')),
+        ('do_addthis_button', ('use_addthis_button', 'addthis_use_author', 'addthis_username', 'author_id')),
+        ('do_meta_description', ('description', 'markup', 'content')),
+        ('do_unique_slug', ('slug', 'title', 'publish_date')),
+        ('do_auto_tag', ('auto_tag', 'title', 'content', 'description', 'keywords')),
+        ('do_tags_to_keywords', ('keywords', 'tags')),
+        ('do_default_site', ('sites',)),
+    )
+    VISIBILITY_FIELDS = ('is_active', 'status_id', 'publish_date', 'expiration_date')
+
+    # what listings and feeds show of an article, besides its tags
+    LISTED_FIELDS = ('title', 'slug', 'author_id', 'description', 'rendered_content')
+
     def __init__(self, *args, **kwargs):
-        """Makes sure that we have some rendered content to use"""
+        """Starts tracking changes, and retires articles that have expired"""
 
         super(Article, self).__init__(*args, **kwargs)
 
         self._next = None
         self._previous = None
         self._teaser = None
+        self._related = None
+        self.saved_fields = None
+        self.save_timings = []
+        self.reset_changes()
 
         if self.id:
-            # mark the article as inactive if it's expired and still active
+            # mark the article as inactive if it's expired and still active;
+            # the scheduler takes care of saving that
             if self.expiration_date and self.expiration_date <= datetime.now() and self.is_active:
                 self.is_active = False
-                self.save()
 
-            if not self.rendered_content or not len(self.rendered_content.strip()):
-                self.save()
+            # articles whose rendered content went missing are rendered again
+            # by the scheduler or ``rerender_articles``, not on every load
 
     def __unicode__(self):
         return self.title
 
+    def field_values(self):
+        return dict((f.attname, getattr(self, f.attname)) for f in self._meta.local_fields)
+
+    def reset_changes(self):
+        """Starts tracking changes from the article's current state"""
+
+        self._loaded = self.field_values()
+        self._marked = set()
+        self._pending = {}
+
+    def mark_changed(self, name):
+        """Notes a change the field values can't show, like new tags"""
+
+        self._marked.add(name)
+
+    def changed_fields(self):
+        """The names of the fields that changed since the article was loaded or saved"""
+
+        current = self.field_values()
+        return set(name for name, value in current.items() if self._loaded.get(name) != value)
+
+    def fields_saved(self, fields):
+        """Whether the last save wrote any of ``fields``"""
+
+        return self.saved_fields is None or bool(self.saved_fields & set(fields))
+
     def save(self, *args, **kwargs):
-        """Renders the article using the appropriate markup language."""
+        """
+        Saves the article in stages.  Only the stages whose fields changed
+        since the article was loaded are run, and existing articles are
+        written with a single ``UPDATE`` of the columns that changed.  How
+        long each stage took is kept in ``save_timings``.
+        """
 
-        using = kwargs.get('using', DEFAULT_DB)
+        # the fix-ups below read from the database being written to
+        using = kwargs.get('using') or router.db_for_write(Article, instance=self)
+        creating = kwargs.get('force_insert') or not self.pk or (
+                self._state.adding and not Article.objects.using(using).filter(pk=self.pk).exists())
+
+        self.save_timings = []
+        changed = self.changed_fields() | self._marked
+        for name, inputs in self.SAVE_STAGES:
+            if creating or changed.intersection(inputs):
+                self.run_stage(name, using)
+                changed = self.changed_fields() | self._marked
+
+        if creating or kwargs.get('force_update'):
+            self.saved_fields = None
+            self.run_stage('write', using, lambda: super(Article, self).save(*args, **kwargs))
+        else:
+            self.run_stage('write', using, lambda: self.save_changes(using))
+
+        for field, items in self._pending.items():
+            getattr(self, field).add(*items)
+
+        if creating or changed.intersection(self.VISIBILITY_FIELDS):
+            self.run_stage('do_visibility', using)
+
+        log.debug('Saved article %s: %s' % (self.pk, ', '.join('%s %.4fs' % t for t in self.save_timings)))
+        self.reset_changes()
+
+    def run_stage(self, name, using, stage=None):
+        start = time.time()
+        if stage is None:
+            getattr(self, name)(using)
+        else:
+            stage()
+        self.save_timings.append((name, time.time() - start))
 
-        self.do_render_markup()
-        self.do_addthis_button()
-        self.do_meta_description()
-        self.do_unique_slug(using)
+    def save_changes(self, using):
+        """
+        Writes just the changed columns of an existing article, sending the
+        same signals a full save would.
+        """
 
-        super(Article, self).save(*args, **kwargs)
+        models.signals.pre_save.send(sender=Article, instance=self, raw=False, using=using)
 
-        # do some things that require an ID first
-        requires_save = self.do_auto_tag(using)
-        requires_save |= self.do_tags_to_keywords()
-        requires_save |= self.do_default_site(using)
+        fields = self.changed_fields()
+        self.saved_fields = fields
+        if fields:
+            names = dict((f.attname, f.name) for f in self._meta.local_fields)
+            values = dict((names[attname], getattr(self, attname)) for attname in fields)
+            if not Article.objects.using(using).filter(pk=self.pk).update(**values):
+                # the row is gone; put it back
+                self.saved_fields = None
+                super(Article, self).save(force_insert=True, using=using)
+                return
 
-        if requires_save:
-            # bypass the other processing
-            super(Article, self).save()
+        self._state.db = using
+        models.signals.post_save.send(sender=Article, instance=self, created=False, raw=False, using=using)
 
-    def do_render_markup(self):
+    def do_render_markup(self, using=DEFAULT_DB):
         """Turns any markup into HTML"""
 
         original = self.rendered_content
-        if self.markup == MARKUP_MARKDOWN:
-            self.rendered_content = markup.markdown(self.content)
-        elif self.markup == MARKUP_REST:
-            self.rendered_content = markup.restructuredtext(self.content)
-        elif self.markup == MARKUP_TEXTILE:
-            self.rendered_content = markup.textile(self.content)
-        else:
-            self.rendered_content = self.content
+        self.rendered_content = render_markup(self.markup, self.content)
 
         return (self.rendered_content != original)
 
-    def do_addthis_button(self):
+    def do_addthis_button(self, using=DEFAULT_DB):
         """Sets the AddThis username for this post"""
 
         # if the author wishes to have an "AddThis" button on this article,
@@ -289,7 +765,7 @@ class Article(models.Model):
 
         return False
 
-    def do_tags_to_keywords(self):
+    def do_tags_to_keywords(self, using=DEFAULT_DB):
         """
         If meta keywords is empty, sets them using the article tags.
 
@@ -297,12 +773,15 @@ class Article(models.Model):
         """
 
         if len(self.keywords.strip()) == 0:
-            self.keywords = ', '.join([t.name for t in self.tags.all()])
+            tags = list(self._pending.get('tags', []))
+            if self.pk:
+                tags[:0] = self.tags.using(using).all()
+            self.keywords = ', '.join([t.name for t in tags])
             return True
 
         return False
 
-    def do_meta_description(self):
+    def do_meta_description(self, using=DEFAULT_DB):
         """
         If meta description is empty, sets it to the article's teaser.
 
@@ -316,10 +795,10 @@ class Article(models.Model):
         return False
 
     @logtime
-    @once_per_instance
     def do_auto_tag(self, using=DEFAULT_DB):
         """
-        Performs the auto-tagging work if necessary.
+        Performs the auto-tagging work if necessary.  Tags found for an
+        article that hasn't been saved yet are added once it has been.
 
         Returns True if an additional save is required, False otherwise.
         """
@@ -329,24 +808,36 @@ class Article(models.Model):
             return False
 
         # don't clobber any existing tags!
-        existing_ids = [t.id for t in self.tags.all()]
+        existing_ids = []
+        if self.pk and not self._state.adding:
+            existing_ids = [t.id for t in self.tags.using(using).all()]
         log.debug('Article %s already has these tags: %s' % (self.pk, existing_ids))
 
-        unused = Tag.objects.all()
-        if hasattr(unused, 'using'):
-            unused = unused.using(using)
-        unused = unused.exclude(id__in=existing_ids)
+        unused = Tag.objects.using(using).exclude(id__in=existing_ids)
+        found = self.matching_tags(unused)
+        if not found:
+            return False
+
+        log.debug('Applying Tags %s to Article %s' % (found, self.pk))
+        if self.pk and not self._state.adding:
+            self.tags.add(*found)
+        else:
+            self._pending.setdefault('tags', []).extend(found)
+
+        self.mark_changed('tags')
+        return True
+
+    def matching_tags(self, tags):
+        """Returns the tags whose names appear as whole words in this article"""
 
-        found = False
         to_search = (self.content, self.title, self.description, self.keywords)
-        for tag in unused:
+        matches = []
+        for tag in tags:
             regex = re.compile(r'\b%s\b' % tag.name, re.I)
             if any(regex.search(text) for text in to_search):
-                log.debug('Applying Tag "%s" (%s) to Article %s' % (tag, tag.pk, self.pk))
-                self.tags.add(tag)
-                found = True
+                matches.append(tag)
 
-        return found
+        return matches
 
     def do_default_site(self, using=DEFAULT_DB):
         """
@@ -356,14 +847,23 @@ class Article(models.Model):
         Returns True if an additional save is required, False otherwise.
         """
 
-        if not len(self.sites.all()):
-            sites = Site.objects.all()
-            if hasattr(sites, 'using'):
-                sites = sites.using(using)
-            self.sites.add(sites.get(pk=settings.SITE_ID))
-            return True
+        if self.pk and self.sites.using(using).exists():
+            return False
 
-        return False
+        # added once the article has been written
+        self._pending['sites'] = [settings.SITE_ID]
+        return True
+
+    def do_visibility(self, using=DEFAULT_DB):
+        """Keeps the denormalized visibility rows in sync with this article"""
+
+        Article.objects.refresh_visibility([self.pk], using)
+
+        # let the scheduler know if this article publishes or expires later
+        now = datetime.now()
+        for when in (self.publish_date, self.expiration_date):
+            if isinstance(when, datetime) and when > now:
+                Article.objects.note_transition(when)
 
     def get_unique_slug(self, slug, using=DEFAULT_DB):
         """Iterates until a unique slug is found"""
@@ -380,9 +880,7 @@ class Article(models.Model):
             not_unique = Article.objects.all()
             if hasattr(not_unique, 'using'):
                 not_unique = not_unique.using(using)
-            not_unique = not_unique.filter(publish_date__year=year, slug=slug)
-
-            if len(not_unique) == 0:
+            if not not_unique.filter(slug=slug, **published_in(year)).exists():
                 return slug
 
             slug = '%s-%s' % (orig_slug, counter)
@@ -405,34 +903,32 @@ class Article(models.Model):
         for link in LINK_RE.finditer(self.rendered_content):
             url = link.group(1)
             log.debug('Do we have a title for "%s"?' % (url,))
-            key = 'href_title_' + sha1(url).hexdigest()
 
-            # look in the cache for the link target's title
-            title = cache.get(key)
-            if title is None:
+            def lookup(url=url, title=link.group(2)):
                 log.debug('Nope... Getting it and caching it.')
-                title = link.group(2)
-
-                if LOOKUP_LINK_TITLE:
-                    try:
-                        log.debug('Looking up title for URL: %s' % (url,))
-                        # open the URL
-                        c = urllib.urlopen(url)
-                        html = c.read()
-                        c.close()
-
-                        # try to determine the title of the target
-                        title_m = TITLE_RE.search(html)
-                        if title_m:
-                            title = title_m.group(1)
-                            log.debug('Found title: %s' % (title,))
-                    except:
-                        # if anything goes wrong (ie IOError), use the link's text
-                        log.warn('Failed to retrieve the title for "%s"; using link text "%s"' % (url, title))
-
-                # cache the page title for a week
-                log.debug('Using "%s" as title for "%s"' % (title, url))
-                cache.set(key, title, 604800)
+                if not LOOKUP_LINK_TITLE:
+                    return title
+
+                try:
+                    log.debug('Looking up title for URL: %s' % (url,))
+                    # open the URL
+                    c = urllib.urlopen(url)
+                    html = c.read()
+                    c.close()
+
+                    # try to determine the title of the target
+                    title_m = TITLE_RE.search(html)
+                    if title_m:
+                        title = title_m.group(1)
+                        log.debug('Found title: %s' % (title,))
+                except:
+                    # if anything goes wrong (ie IOError), use the link's text
+                    log.warn('Failed to retrieve the title for "%s"; using link text "%s"' % (url, title))
+
+                return title
+
+            # cache the page title for a week
+            title = caching.get_or_set('link_titles', sha1(url).hexdigest(), lookup, 604800)
 
             # add it to the list of links and titles
             if url not in (l[0] for l in links):
@@ -447,9 +943,11 @@ class Article(models.Model):
         return len(striptags(self.rendered_content).split(' '))
     word_count = property(_get_word_count)
 
-    @models.permalink
     def get_absolute_url(self):
-        return ('articles_display_article', (self.publish_date.year, self.slug))
+        return permalinks.article_url(year=self.publish_date.year, slug=self.slug)
+
+    def get_author_url(self):
+        return permalinks.author_url(username=self.author.username)
 
     def _get_teaser(self):
         """
@@ -470,7 +968,7 @@ class Article(models.Model):
         if not self._next:
             try:
                 qs = Article.objects.live().exclude(id__exact=self.id)
-                article = qs.filter(publish_date__gte=self.publish_date).order_by('publish_date')[0]
+                article = cached_query(qs.filter(publish_date__gte=self.publish_date).order_by('publish_date')[:1])[0]
             except (Article.DoesNotExist, IndexError):
                 article = None
             self._next = article
@@ -483,17 +981,146 @@ class Article(models.Model):
         if not self._previous:
             try:
                 qs = Article.objects.live().exclude(id__exact=self.id)
-                article = qs.filter(publish_date__lte=self.publish_date).order_by('-publish_date')[0]
+                article = cached_query(qs.filter(publish_date__lte=self.publish_date).order_by('-publish_date')[:1])[0]
             except (Article.DoesNotExist, IndexError):
                 article = None
             self._previous = article
 
         return self._previous
 
+    def get_related_articles(self):
+        """Visible recommended articles, hand-picked ones first"""
+
+        if self._related is None:
+            qs = Article.objects.visible().filter(recommended_for__article=self)
+            self._related = cached_query(qs.order_by('-recommended_for__score', '-publish_date'))
+
+        return self._related
+
+    def get_followups(self):
+        """Visible articles that follow up on this one"""
+
+        return cached_query(self.followups.visible())
+
+    def get_followed_up(self):
+        """Visible articles that this one follows up on"""
+
+        return cached_query(self.followup_for.visible())
+
     class Meta:
         ordering = ('-publish_date', 'title')
         get_latest_by = 'publish_date'
 
+class ArticleSummary(namedtuple('ArticleSummary', 'id title slug publish_date description')):
+    """
+    The few columns of an article that short listings, like the ones in a
+    sidebar, show.  These are small enough to cache, unlike whole articles.
+    """
+
+    __slots__ = ()
+
+    @property
+    def pk(self):
+        return self.id
+
+    def get_absolute_url(self):
+        return permalinks.article_url(year=self.publish_date.year, slug=self.slug)
+
+    @classmethod
+    def fetch(cls, queryset):
+        return [cls(*row) for row in queryset.values_list(*cls._fields)]
+
+class ArticleVisibility(models.Model):
+    """
+    One row for each site on which an active, live article may be displayed.
+    The publish and expiration dates are copied from the article so that
+    listings only need to look at this table.  Rows are maintained whenever an
+    article, its sites, or its status change, when scheduled articles are
+    published or expire, and by the ``sweep_article_visibility`` command.
+    """
+
+    article = models.ForeignKey(Article, related_name='visibility')
+    site = models.ForeignKey(Site)
+    publish_date = models.DateTimeField()
+    expiration_date = models.DateTimeField(blank=True, null=True)
+
+    class Meta:
+        unique_together = (('article', 'site'),)
+
+    def __unicode__(self):
+        return u'%s on %s' % (self.article_id, self.site_id)
+
+class ArticleSearchTerm(models.Model):
+    """
+    One row for each distinct word in an article, weighted by where the word
+    appears and how often.  This is the inverted index used to search
+    articles on databases without a full-text search engine of their own; see
+    ``articles.search``.
+    """
+
+    article = models.ForeignKey(Article, related_name='search_terms')
+    term = models.CharField(max_length=64, db_index=True)
+    weight = models.FloatField()
+
+    class Meta:
+        unique_together = (('term', 'article'),)
+
+    def __unicode__(self):
+        return u'%s in %s' % (self.term, self.article_id)
+
+class RelatedArticle(models.Model):
+    """
+    A recommended article to display alongside another one.  Hand-picked
+    ``related_articles`` are copied here as soon as they're chosen; the rest
+    are the most similar articles found by ``articles.related``.
+    """
+
+    article = models.ForeignKey(Article, related_name='recommendations')
+    related = models.ForeignKey(Article, related_name='recommended_for')
+    score = models.FloatField()
+    curated = models.BooleanField(default=False)
+
+    class Meta:
+        unique_together = (('article', 'related'),)
+        ordering = ('article', '-score')
+
+    def __unicode__(self):
+        return u'%s -> %s (%.3f)' % (self.article_id, self.related_id, self.score)
+
+class ArticleTask(models.Model):
+    """
+    A job for the background workers started by ``run_article_worker``.  See
+    ``articles.tasks``.
+    """
+
+    PENDING = 'p'
+    RUNNING = 'r'
+    FAILED = 'f'
+    STATUS_CHOICES = (
+        (PENDING, _('Pending')),
+        (RUNNING, _('Running')),
+        (FAILED, _('Failed')),
+    )
+
+    name = models.CharField(max_length=100)
+    arguments = models.TextField(default='[]')
+    key = models.CharField(max_length=40, db_index=True)
+    priority = models.IntegerField(default=0)
+    status = models.CharField(max_length=1, choices=STATUS_CHOICES, default=PENDING, db_index=True)
+    attempts = models.PositiveIntegerField(default=0)
+    max_attempts = models.PositiveIntegerField(default=5)
+    run_after = models.DateTimeField(default=datetime.now)
+    claimed_by = models.CharField(max_length=100, blank=True)
+    claimed_at = models.DateTimeField(blank=True, null=True)
+    last_error = models.TextField(blank=True)
+    created = models.DateTimeField(default=datetime.now)
+
+    class Meta:
+        ordering = ('-priority', 'run_after', 'id')
+
+    def __unicode__(self):
+        return u'%s%s' % (self.name, self.arguments)
+
 class Attachment(models.Model):
     upload_to = lambda inst, fn: 'attach/%s/%s/%s' % (datetime.now().year, inst.article.slug, fn)
 
@@ -0,0 +1,111 @@
+"""
+Builds the URLs of the articles application without going through
+``reverse`` each time.
+
+``reverse`` searches every pattern with the name it's given, fills one in and
+checks the result against the pattern's regular expression, on every call.
+Listings, feeds and article pages build dozens of URLs each, so each route is
+looked up once here, using the same table ``reverse`` does (which includes the
+prefixes of any ``include`` the application's URLs are under), and URLs are
+then built by plain string formatting and checked against the route's
+pattern, as ``reverse`` does.
+"""
+
+import re
+
+from django.conf import settings
+from django.core.urlresolvers import NoReverseMatch, get_resolver, get_script_prefix, get_urlconf
+from django.utils.encoding import force_unicode, iri_to_uri
+
+class URLBuilder(object):
+    """Builds the URL of one named route from keyword arguments"""
+
+    def __init__(self, name, *params):
+        self.name = name
+        self.params = sorted(params)
+        self._routes = {}
+
+    def routes(self):
+        """
+        The route as format strings, each with the pattern its URLs have to
+        match, looked up once for each URLconf
+        """
+
+        urlconf = get_urlconf() or settings.ROOT_URLCONF
+        try:
+            return self._routes[urlconf]
+        except KeyError:
+            pass
+
+        routes = [(result, re.compile(u'^%s' % pattern, re.UNICODE))
+                  for possibility, pattern, defaults in get_resolver(urlconf).reverse_dict.getlist(self.name)
+                  for result, params in possibility
+                  if sorted(params) == self.params and not defaults]
+        if not routes:
+            raise NoReverseMatch("Reverse for '%s' with arguments %s not found." % (self.name, self.params))
+
+        self._routes[urlconf] = routes
+        return routes
+
+    def fill(self, **kwargs):
+        """Fills in the route without checking the result against its pattern"""
+
+        url = self.routes()[0][0] % dict((k, force_unicode(v)) for k, v in kwargs.items())
+        return iri_to_uri(get_script_prefix() + url)
+
+    def __call__(self, **kwargs):
+        kwargs = dict((k, force_unicode(v)) for k, v in kwargs.items())
+
+        # like ``reverse``, only build URLs that the route would match
+        for result, pattern in self.routes():
+            url = result % kwargs
+            if pattern.search(url):
+                return iri_to_uri(get_script_prefix() + url)
+
+        raise NoReverseMatch("Reverse for '%s' with keyword arguments %s not found." % (self.name, kwargs))
+
+_builders = {}
+
+def builder(name, *params):
+    """The ``URLBuilder`` for a named route taking ``params``, made once"""
+
+    key = (name, tuple(sorted(params)))
+    found = _builders.get(key)
+    if found is None:
+        found = _builders[key] = URLBuilder(name, *params)
+
+    return found
+
+def build(name, **kwargs):
+    """Builds the URL of any named route, like ``reverse(name, kwargs=kwargs)``"""
+
+    return builder(name, *kwargs)(**kwargs)
+
+article_url = URLBuilder('articles_display_article', 'year', 'slug')
+author_url = URLBuilder('articles_by_author', 'username')
+tag_url = URLBuilder('articles_display_tag', 'tag')
+tag_rss_url = URLBuilder('articles_rss_feed_tag', 'slug')
+tag_atom_url = URLBuilder('articles_atom_feed_tag', 'slug')
+
+class PageURLs(object):
+    """
+    Builds the URLs of the pages of one listing.  The listing's routes are
+    filled in once, leaving a gap for the page number, so a page's URL is a
+    matter of joining three strings.  The first page is the listing's own URL.
+    """
+
+    MARKER = u'__page__'
+
+    def __init__(self, name, **kwargs):
+        self.first = build(name, **kwargs)
+
+        # the marker isn't a page number, so the route's pattern can't check it
+        page = builder(name + '_page', 'page', *kwargs)
+        self.head, self.tail = page.fill(page=self.MARKER, **kwargs).rsplit(self.MARKER, 1)
+
+    def url(self, page):
+        page = int(page)
+        if page == 1:
+            return self.first
+
+        return '%s%d%s' % (self.head, page, self.tail)
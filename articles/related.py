@@ -0,0 +1,245 @@
+"""
+Finds related articles automatically.
+
+Each article is turned into a sparse vector of tf-idf weighted words from its
+title, tags and text, and compared with every other article by cosine
+similarity.  The share of tags two articles have in common is blended in.
+Rather than comparing every pair of articles, the vectors are stored as
+posting lists (the columns of the term matrix), so an article's scores are
+accumulated from just the articles that share at least one of its words.
+Words that appear in nearly every article, or in only one, can't tell
+articles apart and are left out of the matrix entirely.
+
+The best matches for each article are stored as ``RelatedArticle`` rows by the
+``compute_related_articles`` management command, so displaying them is a
+single (cached) query.  Articles that change are remembered, and
+``compute_related_articles --stale`` only recomputes the articles they affect.
+"""
+
+from collections import defaultdict
+import heapq
+import logging
+import math
+from operator import itemgetter
+
+from django.conf import settings
+from django.core.cache import cache
+
+from models import Article, RelatedArticle, DEFAULT_DB, expire_cached_queries
+from search import weigh_terms
+
+RELATED_COUNT = getattr(settings, 'ARTICLES_RELATED_COUNT', 5)
+TAG_SHARE = getattr(settings, 'ARTICLES_RELATED_TAG_SHARE', 0.3)
+
+# words in more than this fraction of articles are ignored, once there are
+# enough articles for that to mean something
+MAX_DOCUMENT_FREQUENCY = 0.2
+MIN_PRUNED_ARTICLES = 100
+
+# only an article's most telling words are used to look for similar ones
+QUERY_TERMS = 25
+
+# hand-picked related articles always come first
+CURATED_SCORE = 2.0
+
+TERMS_KEY = 'related_terms_%s'
+TERMS_TIMEOUT = 86400
+STALE_KEY = 'related_articles_stale'
+
+log = logging.getLogger('articles.related')
+
+def article_terms(article_ids, using=DEFAULT_DB, chunk_size=500):
+    """
+    Returns the weighted words and the tag IDs of each article, keyed by
+    article ID.  These are cached until the article changes.
+    """
+
+    keys = dict((TERMS_KEY % pk, pk) for pk in article_ids)
+    result = dict((keys[key], terms) for key, terms in cache.get_many(keys.keys()).items())
+
+    missing = [pk for pk in article_ids if pk not in result]
+    for start in range(0, len(missing), chunk_size):
+        chunk = missing[start:start + chunk_size]
+        weighed = {}
+        for article in Article.objects.using(using).filter(id__in=chunk).prefetch_related('tags'):
+            weighed[TERMS_KEY % article.pk] = result[article.pk] = (
+                weigh_terms(article), frozenset(t.pk for t in article.tags.all()))
+
+        cache.set_many(weighed, TERMS_TIMEOUT)
+
+    log.debug('Weighed the words of %s of %s articles' % (len(missing), len(keys)))
+    return result
+
+def forget_terms(article_ids):
+    """Drops the cached words for articles that have changed"""
+
+    cache.delete_many([TERMS_KEY % pk for pk in article_ids])
+
+class TermMatrix(object):
+    """Sparse, normalized tf-idf vectors for a set of articles"""
+
+    def __init__(self, terms):
+        total = len(terms)
+        frequency = defaultdict(int)
+        for words, tags in terms.values():
+            for word in words:
+                frequency[word] += 1
+
+        # words in every article have no weight at all
+        limit = total - 1
+        if total >= MIN_PRUNED_ARTICLES:
+            limit = int(total * MAX_DOCUMENT_FREQUENCY)
+        idf = dict((word, math.log(float(total) / count))
+                   for word, count in frequency.items() if 1 < count <= limit)
+
+        self.rows = {}
+        self.tags = {}
+        self.postings = defaultdict(list)
+        self.tag_postings = defaultdict(list)
+
+        for pk, (words, tags) in terms.items():
+            row = [(word, weight * idf[word]) for word, weight in words.items() if word in idf]
+            norm = math.sqrt(sum(w * w for word, w in row)) or 1.0
+            row = sorted(((word, w / norm) for word, w in row), key=itemgetter(1), reverse=True)
+
+            self.rows[pk] = row
+            for word, w in row:
+                self.postings[word].append((pk, w))
+
+            self.tags[pk] = tags
+            for tag in tags:
+                self.tag_postings[tag].append(pk)
+
+        log.debug('Built a %s x %s term matrix' % (len(self.rows), len(self.postings)))
+
+    def similar(self, pk, count=RELATED_COUNT, exclude=()):
+        """
+        Returns the ``(score, id)`` of the articles most like ``pk``.  Scores
+        are the dot products of the article's row with every row that shares
+        a word, found by walking the posting lists of its best words.
+        """
+
+        scores = defaultdict(float)
+        text_share = 1.0 - TAG_SHARE
+
+        for word, weight in self.rows.get(pk, ())[:QUERY_TERMS]:
+            for other, other_weight in self.postings[word]:
+                scores[other] += text_share * weight * other_weight
+
+        tags = self.tags.get(pk, ())
+        if tags:
+            shared = defaultdict(int)
+            for tag in tags:
+                for other in self.tag_postings[tag]:
+                    shared[other] += 1
+
+            for other, both in shared.items():
+                either = len(tags) + len(self.tags[other]) - both
+                scores[other] += TAG_SHARE * both / float(either)
+
+        scores.pop(pk, None)
+        for other in exclude:
+            scores.pop(other, None)
+
+        best = heapq.nlargest(count, scores.iteritems(), key=itemgetter(1))
+        return [(score, other) for other, score in best]
+
+def build_matrix(using=DEFAULT_DB):
+    """Builds the term matrix for every active article"""
+
+    ids = list(Article.objects.using(using).filter(is_active=True).values_list('id', flat=True).order_by())
+    return TermMatrix(article_terms(ids, using))
+
+def store(matrix, article_ids, using=DEFAULT_DB, count=RELATED_COUNT):
+    """Recomputes and saves the related articles of some articles"""
+
+    article_ids = list(article_ids)
+    curated = defaultdict(set)
+    for article_id, related_id in RelatedArticle.objects.using(using).filter(
+            article__in=article_ids, curated=True).values_list('article', 'related'):
+        curated[article_id].add(related_id)
+
+    rows = []
+    for article_id in article_ids:
+        for score, related_id in matrix.similar(article_id, count, curated[article_id]):
+            rows.append(RelatedArticle(article_id=article_id, related_id=related_id, score=score))
+
+    RelatedArticle.objects.using(using).filter(article__in=article_ids, curated=False).delete()
+    RelatedArticle.objects.using(using).bulk_create(rows)
+    log.debug('Stored %s related articles for %s articles' % (len(rows), len(article_ids)))
+
+def rebuild(using=DEFAULT_DB, batch_size=500, count=RELATED_COUNT):
+    """Recomputes the related articles of every article"""
+
+    cache.delete(STALE_KEY)
+    matrix = build_matrix(using)
+    ids = sorted(matrix.rows)
+
+    for start in range(0, len(ids), batch_size):
+        store(matrix, ids[start:start + batch_size], using, count)
+
+    expire_cached_queries()
+    return len(ids)
+
+def mark_stale(article_ids):
+    """Remembers articles whose related articles need to be recomputed"""
+
+    article_ids = set(article_ids)
+    forget_terms(article_ids)
+
+    # this can lose an update if two processes race; a full rebuild takes care
+    # of anything that slips through
+    stale = cache.get(STALE_KEY) or set()
+    cache.set(STALE_KEY, stale | article_ids, TERMS_TIMEOUT)
+
+def update_stale(using=DEFAULT_DB, batch_size=500, count=RELATED_COUNT):
+    """
+    Recomputes the related articles of changed articles, of the articles that
+    currently recommend them, and of their new best matches.  Everything else
+    is left alone.
+    """
+
+    stale = cache.get(STALE_KEY)
+    if not stale:
+        return 0
+
+    cache.delete(STALE_KEY)
+    matrix = build_matrix(using)
+
+    affected = set(pk for pk in stale if pk in matrix.rows)
+    for pk in list(affected):
+        affected.update(other for score, other in matrix.similar(pk, count))
+
+    recommending = RelatedArticle.objects.using(using).filter(related__in=list(stale), curated=False)
+    affected.update(recommending.values_list('article', flat=True))
+    affected &= set(matrix.rows)
+
+    ids = sorted(affected)
+    for start in range(0, len(ids), batch_size):
+        store(matrix, ids[start:start + batch_size], using, count)
+
+    expire_cached_queries()
+    return len(ids)
+
+def curate(article_id, related_ids, using=DEFAULT_DB):
+    """Copies hand-picked related articles, which go both ways"""
+
+    related_ids = set(related_ids) - set([article_id])
+    pairs = set()
+    for related_id in related_ids:
+        pairs.add((article_id, related_id))
+        pairs.add((related_id, article_id))
+
+    uncurate(article_id, related_ids, using)
+    RelatedArticle.objects.using(using).bulk_create([
+        RelatedArticle(article_id=a, related_id=b, score=CURATED_SCORE, curated=True)
+        for a, b in pairs])
+    expire_cached_queries()
+
+def uncurate(article_id, related_ids, using=DEFAULT_DB):
+    """Forgets hand-picked related articles, along with any computed ones for the same pairs"""
+
+    related_ids = list(related_ids)
+    RelatedArticle.objects.using(using).filter(article=article_id, related__in=related_ids).delete()
+    RelatedArticle.objects.using(using).filter(article__in=related_ids, related=article_id).delete()
+    expire_cached_queries()
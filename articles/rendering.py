@@ -0,0 +1,151 @@
+"""
+Renders the markup of many articles at once.
+
+``Article.save`` renders one article at a time, in the process handling the
+request.  Imports and re-renders go through thousands, so here the markup is
+handed to a pool of processes, and re-rendered articles are written back with
+one ``UPDATE`` per batch that only touches the rendered content and the
+description derived from it.
+"""
+
+from multiprocessing import Pool
+import logging
+
+from django.db import connections, transaction
+from django.utils.text import truncate_html_words
+
+import caching
+from models import Article, WORD_LIMIT, render_markup
+from related import mark_stale
+from search import index_articles
+from signals import pages_affected
+
+# how many articles to write back in one statement; SQLite refuses statements
+# with more than 999 parameters
+UPDATE_BATCH = 100
+
+log = logging.getLogger('articles.rendering')
+
+def start_pool(processes):
+    """Starts a pool of processes to render with, or returns ``None`` for one"""
+
+    if processes <= 1:
+        return None
+
+    # each process needs its own database connection
+    for connection in connections.all():
+        connection.close()
+
+    return Pool(processes)
+
+def stop_pool(pool):
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+def render(args):
+    return render_markup(*args)
+
+def render_many(jobs, pool=None):
+    """Renders a list of ``(markup, content)`` pairs, in other processes if there's a pool"""
+
+    if pool is None:
+        return map(render, jobs)
+
+    return pool.map(render, jobs, chunksize=max(1, len(jobs) // 20))
+
+def render_all(articles, pool=None):
+    """Renders the markup of many articles"""
+
+    rendered = render_many([(a.markup, a.content) for a in articles], pool)
+    for article, html in zip(articles, rendered):
+        article.rendered_content = html
+
+def update_rows(model, rows, using):
+    """
+    Writes new values to many rows with one ``UPDATE`` per batch.  ``rows``
+    is a list of ``(pk, values)`` pairs, where ``values`` maps column names to
+    values.  Every row must set the same columns.
+    """
+
+    if not rows:
+        return
+
+    connection = connections[using]
+    qn = connection.ops.quote_name
+    columns = sorted(rows[0][1])
+
+    for start in range(0, len(rows), UPDATE_BATCH):
+        batch = rows[start:start + UPDATE_BATCH]
+
+        sets = []
+        params = []
+        for column in columns:
+            sets.append('%s = CASE %s %s END' % (qn(column), qn(model._meta.pk.column),
+                                                 ' '.join(['WHEN %s THEN %s'] * len(batch))))
+            for pk, values in batch:
+                params.extend([pk, values[column]])
+
+        params.extend(pk for pk, values in batch)
+        sql = 'UPDATE %s SET %s WHERE %s IN (%s)' % (
+                qn(model._meta.db_table), ', '.join(sets), qn(model._meta.pk.column),
+                ', '.join(['%s'] * len(batch)))
+
+        connection.cursor().execute(sql, params)
+        transaction.set_dirty(using=using)
+
+def rerender(queryset, chunk_size=500, processes=1, dry_run=False):
+    """
+    Renders the articles in ``queryset`` again, reading them ``chunk_size`` at
+    a time in order of ID.  Only articles whose rendered content comes out
+    differently are written back, along with their description when it was
+    derived from the old rendered content.  With ``dry_run`` nothing is
+    written.  Returns the number of articles checked and the IDs of those that
+    changed.
+    """
+
+    using = queryset.db
+    rows = queryset.order_by('id').values_list('id', 'markup', 'content', 'rendered_content', 'description')
+
+    pool = start_pool(processes)
+    checked = 0
+    changed = []
+    last = 0
+    try:
+        while True:
+            chunk = list(rows.filter(id__gt=last)[:chunk_size])
+            if not chunk:
+                break
+
+            last = chunk[-1][0]
+            checked += len(chunk)
+
+            updates = []
+            for (pk, markup, content, old, description), html in zip(
+                    chunk, render_many([(row[1], row[2]) for row in chunk], pool)):
+                if html == old:
+                    continue
+
+                # the description was filled in from the teaser when it was saved
+                if description == truncate_html_words(old, WORD_LIMIT):
+                    description = truncate_html_words(html, WORD_LIMIT)
+                updates.append((pk, {'rendered_content': html, 'description': description}))
+
+            log.debug('%s of %s articles through %s render differently' % (len(updates), len(chunk), last))
+            changed.extend(pk for pk, values in updates)
+            if dry_run or not updates:
+                continue
+
+            with transaction.commit_on_success(using=using):
+                update_rows(Article, updates, using)
+                index_articles(Article.objects.using(using).filter(id__in=[pk for pk, values in updates]), using)
+    finally:
+        stop_pool(pool)
+
+    if changed and not dry_run:
+        mark_stale(changed)
+        caching.bump('feeds', 'queries')
+        if pages_affected.receivers:
+            pages_affected.send(sender=Article, urls=None)
+
+    return checked, changed
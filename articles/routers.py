@@ -0,0 +1,129 @@
+"""
+Sends reads of the articles application to read replicas.
+
+Add the router and the middleware to your settings, and list the replicas::
+
+    DATABASE_ROUTERS = ['articles.routers.ReplicaRouter']
+    MIDDLEWARE_CLASSES += ('articles.routers.PinPrimaryMiddleware',)
+    ARTICLES_READ_DBS = ['replica1', 'replica2']
+
+Writes always go to ``ARTICLES_DEFAULT_DB``.  Once something has been written,
+the rest of the request reads from there too, so the fix-ups that follow a
+save never see a replica that hasn't caught up yet.  The middleware then sets
+a short-lived cookie so the same visitor keeps reading from the primary for a
+few seconds, long enough for an editor to see their own changes after being
+redirected.  Results that are cached for everyone (see ``cached_query``) are
+always worked out on the primary, so a lagging replica can't fill the cache
+with rows from before the write that invalidated it.
+"""
+
+from contextlib import contextmanager
+import logging
+import random
+import threading
+
+from django.conf import settings
+from django.core.signals import request_started
+
+from models import DEFAULT_DB
+
+READ_DBS = getattr(settings, 'ARTICLES_READ_DBS', [])
+PIN_PRIMARY_SECONDS = getattr(settings, 'ARTICLES_PIN_PRIMARY_SECONDS', 15)
+PIN_COOKIE = 'articles_primary'
+
+log = logging.getLogger('articles.routers')
+
+_state = threading.local()
+
+def pin_primary():
+    """Reads from the primary database for the rest of this thread or request"""
+
+    _state.pinned = True
+
+@contextmanager
+def primary_reads():
+    """Reads from the primary database inside the block"""
+
+    pinned = is_pinned()
+    pin_primary()
+    try:
+        yield
+    finally:
+        _state.pinned = pinned
+
+def unpin_primary():
+    _state.pinned = False
+    _state.wrote = False
+
+def reset_pin(sender, **kwargs):
+    """Every request starts out reading from the replicas"""
+
+    unpin_primary()
+
+request_started.connect(reset_pin)
+
+def is_pinned():
+    return getattr(_state, 'pinned', False)
+
+def has_written():
+    return getattr(_state, 'wrote', False)
+
+class ReplicaRouter(object):
+    """Reads articles from the replicas, and writes them to the primary"""
+
+    app_label = 'articles'
+
+    def __init__(self, replicas=None, primary=None):
+        self.replicas = list(READ_DBS if replicas is None else replicas)
+        self.primary = primary or DEFAULT_DB
+
+    def handles(self, model):
+        return model._meta.app_label == self.app_label
+
+    def db_for_read(self, model, **hints):
+        if not self.handles(model):
+            return None
+
+        if is_pinned() or not self.replicas:
+            return self.primary
+
+        # related objects come from wherever their instance did
+        instance = hints.get('instance')
+        if instance is not None and instance._state.db:
+            return instance._state.db
+
+        return random.choice(self.replicas)
+
+    def db_for_write(self, model, **hints):
+        if not self.handles(model):
+            return None
+
+        _state.wrote = True
+        pin_primary()
+        return self.primary
+
+    def allow_relation(self, obj1, obj2, **hints):
+        aliases = set([self.primary] + self.replicas)
+        if obj1._state.db in aliases and obj2._state.db in aliases:
+            return True
+
+        return None
+
+    def allow_syncdb(self, db, model):
+        return None
+
+class PinPrimaryMiddleware(object):
+    """Keeps a visitor reading from the primary for a while after they write"""
+
+    def process_request(self, request):
+        unpin_primary()
+        if PIN_COOKIE in request.COOKIES or request.method not in ('GET', 'HEAD'):
+            pin_primary()
+
+    def process_response(self, request, response):
+        if has_written():
+            log.debug('Reading from the primary for %s seconds' % PIN_PRIMARY_SECONDS)
+            response.set_cookie(PIN_COOKIE, '1', max_age=PIN_PRIMARY_SECONDS)
+
+        unpin_primary()
+        return response
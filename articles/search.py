@@ -0,0 +1,296 @@
+"""
+Full-text search for articles.
+
+Articles are indexed from their titles, tags, descriptions and the plain text
+of their rendered content, with words in the title counting the most.  The
+index is updated whenever an article or its tags change, and the whole thing
+can be rebuilt with the ``rebuild_search_index`` management command.
+
+On PostgreSQL, each article is stored as a weighted ``tsvector`` and searched
+with ``ts_rank``.  Every other database uses a plain inverted index of
+``ArticleSearchTerm`` rows, ranked by term weight and rarity (tf-idf).  Set
+``ARTICLES_SEARCH_BACKEND`` to ``'postgresql'`` or ``'inverted'`` to pick one
+instead of letting the database engine decide.
+"""
+
+from collections import defaultdict
+from contextlib import contextmanager
+import logging
+import math
+import re
+import threading
+
+from django.conf import settings
+from django.db import connections, transaction
+from django.db.models import Count
+from django.utils.html import strip_tags
+
+from models import Article, ArticleSearchTerm, DEFAULT_DB
+
+SEARCH_BACKEND = getattr(settings, 'ARTICLES_SEARCH_BACKEND', 'auto')
+SEARCH_CONFIG = getattr(settings, 'ARTICLES_SEARCH_CONFIG', 'english')
+SEARCH_LIMIT = getattr(settings, 'ARTICLES_SEARCH_LIMIT', 1000)
+
+# the article fields that make up its document, along with its tags
+INDEXED_FIELDS = ('title', 'description', 'keywords', 'rendered_content')
+
+TITLE_WEIGHT = 3.0
+TAG_WEIGHT = 2.0
+TEXT_WEIGHT = 1.0
+
+WORD_RE = re.compile(r'\w+', re.U)
+MAX_TERM_LENGTH = 64
+STOP_WORDS = frozenset("""
+a an and are as at be but by for from has have if in into is it its of on or
+that the their then there these they this to was were will with
+""".split())
+
+log = logging.getLogger('articles.search')
+
+_deferred = threading.local()
+
+# the databases whose PostgreSQL document table is known to exist
+_installed = set()
+
+def tokenize(text):
+    """Splits some text into lowercase words worth searching for"""
+
+    return [word[:MAX_TERM_LENGTH] for word in WORD_RE.findall(text.lower())
+            if len(word) > 1 and word not in STOP_WORDS]
+
+def document(article):
+    """Returns the ``(weight, text)`` pairs that make up an article"""
+
+    tags = u' '.join(t.name for t in article.tags.all())
+    text = u' '.join((article.description, article.keywords, strip_tags(article.rendered_content)))
+
+    return (
+        (TITLE_WEIGHT, article.title),
+        (TAG_WEIGHT, tags),
+        (TEXT_WEIGHT, text),
+    )
+
+def weigh_terms(article):
+    """Weighs each word in an article by where and how often it appears"""
+
+    counts = defaultdict(float)
+    for weight, text in document(article):
+        for word in tokenize(text):
+            counts[word] += weight
+
+    # repeating a word over and over only helps so much
+    return dict((word, 1.0 + math.log(count)) for word, count in counts.items())
+
+class InvertedIndexBackend(object):
+    """Searches ``ArticleSearchTerm`` rows with plain database queries"""
+
+    def __init__(self, using=DEFAULT_DB):
+        self.using = using
+
+    def index(self, articles):
+        articles = list(articles)
+        rows = []
+        for article in articles:
+            rows.extend(ArticleSearchTerm(article_id=article.pk, term=term, weight=weight)
+                        for term, weight in weigh_terms(article).items())
+
+        self.remove([a.pk for a in articles])
+        ArticleSearchTerm.objects.using(self.using).bulk_create(rows)
+        log.debug('Indexed %s terms for %s articles' % (len(rows), len(articles)))
+
+    def remove(self, article_ids):
+        ArticleSearchTerm.objects.using(self.using).filter(article__in=list(article_ids)).delete()
+
+    def filter(self, queryset, query):
+        """Limits ``queryset`` to the articles containing every word in ``query``"""
+
+        terms = set(tokenize(query))
+        if not terms:
+            return queryset.none()
+
+        for term in terms:
+            matching = ArticleSearchTerm.objects.using(self.using).filter(term=term)
+            queryset = queryset.filter(id__in=matching.values('article'))
+
+        return queryset
+
+    def rank(self, queryset, query, limit=SEARCH_LIMIT):
+        """Returns the IDs of the best matches for ``query`` in ``queryset``"""
+
+        terms = set(tokenize(query))
+        if not terms:
+            return []
+
+        rows = ArticleSearchTerm.objects.using(self.using).filter(term__in=terms)
+        total = Article.objects.using(self.using).count()
+        frequency = dict(rows.values_list('term').annotate(Count('article')).order_by())
+        if len(frequency) < len(terms):
+            # some word doesn't appear anywhere
+            return []
+
+        idf = dict((term, math.log(1.0 + float(total) / count)) for term, count in frequency.items())
+
+        scores = defaultdict(float)
+        matched = defaultdict(int)
+        candidates = rows.filter(article__in=queryset.values('id'))
+        for article_id, term, weight in candidates.values_list('article', 'term', 'weight').iterator():
+            scores[article_id] += weight * idf[term]
+            matched[article_id] += 1
+
+        ranked = sorted((-score, article_id) for article_id, score in scores.items()
+                        if matched[article_id] == len(terms))
+
+        return [article_id for score, article_id in ranked[:limit]]
+
+class PostgresBackend(object):
+    """Searches weighted ``tsvector`` documents with PostgreSQL's full-text engine"""
+
+    table = 'articles_searchdocument'
+
+    def __init__(self, using=DEFAULT_DB):
+        self.using = using
+
+    def execute(self, sql, params=()):
+        cursor = connections[self.using].cursor()
+        cursor.execute(sql, params)
+        return cursor
+
+    def ensure_installed(self):
+        """
+        Creates the document table the first time it's needed, so databases
+        upgraded without running ``rebuild_search_index`` keep working.
+        """
+
+        if self.using in _installed:
+            return
+
+        if self.execute('SELECT 1 FROM pg_class WHERE relname = %s', [self.table]).fetchone():
+            _installed.add(self.using)
+        else:
+            log.warning('Creating %s; run rebuild_search_index to index existing articles' % self.table)
+            self.install()
+
+    def install(self):
+        """Creates the document table and its index if they're missing"""
+
+        self.execute("""
+            CREATE TABLE IF NOT EXISTS %s (
+                article_id integer PRIMARY KEY REFERENCES articles_article (id) ON DELETE CASCADE,
+                document tsvector NOT NULL
+            )""" % self.table)
+
+        index = '%s_document' % self.table
+        if not self.execute('SELECT 1 FROM pg_class WHERE relname = %s', [index]).fetchone():
+            self.execute('CREATE INDEX %s ON %s USING gin(document)' % (index, self.table))
+
+        transaction.commit_unless_managed(using=self.using)
+
+    def index(self, articles):
+        self.ensure_installed()
+        articles = list(articles)
+        self.remove([a.pk for a in articles])
+
+        for article in articles:
+            (title_weight, title), (tag_weight, tags), (text_weight, text) = document(article)
+            self.execute("""
+                INSERT INTO %s (article_id, document) VALUES (%%s,
+                    setweight(to_tsvector(%%s, %%s), 'A') ||
+                    setweight(to_tsvector(%%s, %%s), 'B') ||
+                    setweight(to_tsvector(%%s, %%s), 'C'))""" % self.table,
+                [article.pk, SEARCH_CONFIG, title, SEARCH_CONFIG, tags, SEARCH_CONFIG, text])
+
+        transaction.commit_unless_managed(using=self.using)
+        log.debug('Indexed %s articles' % len(articles))
+
+    def remove(self, article_ids):
+        article_ids = list(article_ids)
+        if article_ids:
+            self.ensure_installed()
+            self.execute('DELETE FROM %s WHERE article_id IN (%s)' % (self.table, ', '.join(['%s'] * len(article_ids))), article_ids)
+            transaction.commit_unless_managed(using=self.using)
+
+    def filter(self, queryset, query):
+        self.ensure_installed()
+        return queryset.extra(
+            where=['%s.id IN (SELECT article_id FROM %s WHERE document @@ plainto_tsquery(%%s, %%s))' % (
+                Article._meta.db_table, self.table)],
+            params=[SEARCH_CONFIG, query])
+
+    def rank(self, queryset, query, limit=SEARCH_LIMIT):
+        self.ensure_installed()
+        sql, params = queryset.values('id').query.sql_with_params()
+        cursor = self.execute("""
+            SELECT article_id FROM %s, plainto_tsquery(%%s, %%s) query
+            WHERE document @@ query AND article_id IN (%s)
+            ORDER BY ts_rank(document, query) DESC, article_id
+            LIMIT %%s""" % (self.table, sql),
+            [SEARCH_CONFIG, query] + list(params) + [limit])
+
+        return [row[0] for row in cursor.fetchall()]
+
+BACKENDS = {
+    'inverted': InvertedIndexBackend,
+    'postgresql': PostgresBackend,
+}
+
+def get_backend(using=DEFAULT_DB):
+    """Returns the search backend for a database"""
+
+    name = SEARCH_BACKEND
+    if name == 'auto':
+        engine = connections[using].settings_dict['ENGINE']
+        name = 'postgresql' if 'postgresql' in engine else 'inverted'
+
+    return BACKENDS[name](using)
+
+def index_articles(articles, using=DEFAULT_DB):
+    """Adds or updates articles in the search index"""
+
+    pending = getattr(_deferred, 'pending', None)
+    if pending is not None:
+        pending.setdefault(using, {}).update((a.pk, a) for a in articles)
+    else:
+        get_backend(using).index(articles)
+
+@contextmanager
+def deferred_indexing():
+    """
+    Holds on to index updates until the end of the block, so that an article
+    changed several times is only indexed once.
+    """
+
+    if getattr(_deferred, 'pending', None) is not None:
+        # an outer block will take care of it
+        yield
+        return
+
+    _deferred.pending = {}
+    try:
+        yield
+        pending = _deferred.pending
+    finally:
+        _deferred.pending = None
+
+    for using, articles in pending.items():
+        get_backend(using).index(articles.values())
+
+def unindex_articles(article_ids, using=DEFAULT_DB):
+    """Removes articles from the search index"""
+
+    get_backend(using).remove(article_ids)
+
+def search(query, queryset=None, limit=SEARCH_LIMIT, using=DEFAULT_DB):
+    """
+    Returns the IDs of the articles in ``queryset`` that best match ``query``,
+    most relevant first.
+    """
+
+    if queryset is None:
+        queryset = Article.objects.using(using).all()
+
+    return get_backend(using).rank(queryset.order_by(), query, limit)
+
+def filter_articles(queryset, query, using=DEFAULT_DB):
+    """Limits ``queryset`` to the articles matching ``query``, in any order"""
+
+    return get_backend(using).filter(queryset, query)
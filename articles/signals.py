@@ -0,0 +1,8 @@
+from django.dispatch import Signal
+
+# sent when scheduled articles are published or expired articles are retired
+articles_transitioned = Signal(providing_args=['published', 'expired'])
+
+# sent with the URLs of the pages that changed along with some articles or
+# tags, or None when every page did
+pages_affected = Signal(providing_args=['urls'])
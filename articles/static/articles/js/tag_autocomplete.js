@@ -1,7 +1,15 @@
 $(document).ready(function () {
     $('#id_tags').autocomplete(
         '/blog/ajax/tag/autocomplete/', // if your prefix for articles differs, fix this
-        {multiple: true, multipleSeparator: ' '}
+        {
+            multiple: true,
+            multipleSeparator: ' ',
+            dataType: 'json',
+            parse: function (names) {
+                return $.map(names, function (name) {
+                    return {data: [name], value: name, result: name};
+                });
+            }
+        }
     );
 });
-
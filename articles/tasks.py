@@ -0,0 +1,256 @@
+"""
+A small queue of background jobs kept in the database.
+
+Work that doesn't need to finish before a response goes out (tagging existing
+articles with a new tag, tagging many articles at once from the admin and
+looking up the titles of linked pages) is registered here as a task.  With
+``ARTICLES_ASYNC_TASKS`` enabled, ``dispatch`` stores the task as an
+``ArticleTask`` row and returns right away, and the ``run_article_worker``
+management command runs it later.  Otherwise tasks run inline, as if there
+were no queue at all.
+
+Any number of workers can run at once.  A worker claims a task with an
+``UPDATE`` that only succeeds while the task is still pending, inside a
+``SELECT ... FOR UPDATE`` where the database supports it, so each task runs
+once.  Tasks that fail are retried with an increasing delay, higher priority
+tasks go first, and a task that's already waiting with the same arguments
+isn't queued twice.
+"""
+
+from datetime import datetime, timedelta
+from hashlib import sha1
+import logging
+import os
+import socket
+import threading
+import traceback
+
+from django.conf import settings
+from django.db import connections, transaction
+from django.db.models import F, Q
+from django.utils import simplejson as json
+
+from models import Article, ArticleTask, Tag, DEFAULT_DB
+
+ASYNC_TASKS = getattr(settings, 'ARTICLES_ASYNC_TASKS', False)
+RETRY_DELAY = getattr(settings, 'ARTICLES_TASK_RETRY_DELAY', 30)
+
+# running tasks whose worker hasn't finished them by then are tried again
+CLAIM_TIMEOUT = getattr(settings, 'ARTICLES_TASK_CLAIM_TIMEOUT', 600)
+
+log = logging.getLogger('articles.tasks')
+
+registry = {}
+
+# the task this thread is running, if any
+_current = threading.local()
+
+def task(func):
+    """Registers a function as a task under its name"""
+
+    registry[func.__name__] = func
+    return func
+
+def task_key(name, args):
+    """Identifies a task and its arguments, so the same one isn't queued twice"""
+
+    return sha1('%s:%s' % (name, json.dumps(args))).hexdigest()
+
+def enqueue(name, args=(), priority=0, delay=0, using=DEFAULT_DB):
+    """
+    Queues a task, unless the same task is already waiting, in which case
+    that one's priority is raised if need be.  Returns the task.
+    """
+
+    if name not in registry:
+        raise KeyError('Unknown task: %s' % name)
+
+    args = list(args)
+    key = task_key(name, args)
+    waiting = ArticleTask.objects.using(using).filter(key=key, status=ArticleTask.PENDING)
+
+    for existing in waiting[:1]:
+        log.debug('%s is already queued' % existing)
+        if priority > existing.priority:
+            waiting.filter(pk=existing.pk).update(priority=priority)
+        return existing
+
+    return ArticleTask.objects.using(using).create(
+            name=name, arguments=json.dumps(args), key=key, priority=priority,
+            run_after=datetime.now() + timedelta(seconds=delay))
+
+def dispatch(name, *args, **kwargs):
+    """
+    Queues a task if tasks run in the background, or runs it right away
+    otherwise.  Returns whether it was queued.
+    """
+
+    if ASYNC_TASKS:
+        enqueue(name, args, **kwargs)
+        return True
+
+    registry[name](*args)
+    return False
+
+def worker_name():
+    return '%s:%s' % (socket.gethostname(), os.getpid())
+
+def reclaim(using=DEFAULT_DB, now=None):
+    """
+    Puts tasks claimed by workers that seem to have died back in the queue,
+    or marks them as failed when they've used up their attempts.  Returns how
+    many were queued again.
+    """
+
+    now = now or datetime.now()
+    timed_out = ArticleTask.objects.using(using).filter(
+            status=ArticleTask.RUNNING,
+            claimed_at__lt=now - timedelta(seconds=CLAIM_TIMEOUT))
+
+    failed = timed_out.filter(attempts__gte=F('max_attempts')).update(
+            status=ArticleTask.FAILED,
+            last_error='The worker did not finish the task within %s seconds' % CLAIM_TIMEOUT)
+    if failed:
+        log.error('%s tasks timed out on their last attempt' % failed)
+
+    return timed_out.update(status=ArticleTask.PENDING)
+
+def extend_claim():
+    """
+    Keeps the task this thread is running from being handed to another
+    worker.  Tasks that may take longer than ``CLAIM_TIMEOUT`` should call it
+    every so often; it does nothing outside of a worker.
+    """
+
+    claimed = getattr(_current, 'task', None)
+    if claimed is not None:
+        ArticleTask.objects.using(_current.using).filter(
+                pk=claimed.pk, status=ArticleTask.RUNNING).update(claimed_at=datetime.now())
+
+def claim(worker, limit=10, using=DEFAULT_DB, now=None):
+    """Claims up to ``limit`` tasks that are due, most important first"""
+
+    now = now or datetime.now()
+    due = ArticleTask.objects.using(using).filter(status=ArticleTask.PENDING, run_after__lte=now)
+
+    claimed = []
+    with transaction.commit_on_success(using=using):
+        if connections[using].features.has_select_for_update:
+            # hold the rows we look at until we've claimed them
+            due = due.select_for_update()
+
+        for pk in list(due.values_list('id', flat=True)[:limit * 2]):
+            # only one worker gets to change a pending task
+            won = ArticleTask.objects.using(using).filter(pk=pk, status=ArticleTask.PENDING).update(
+                    status=ArticleTask.RUNNING, claimed_by=worker, claimed_at=now,
+                    attempts=F('attempts') + 1)
+            if won:
+                claimed.append(pk)
+                if len(claimed) == limit:
+                    break
+
+    return list(ArticleTask.objects.using(using).filter(id__in=claimed))
+
+def run(claimed, using=DEFAULT_DB):
+    """Runs a claimed task, then forgets it, or schedules a retry if it failed"""
+
+    tasks = ArticleTask.objects.using(using).filter(pk=claimed.pk)
+    _current.task, _current.using = claimed, using
+
+    # inside a transaction, a failed task is only undone back to here
+    managed = transaction.is_managed(using=using)
+    sid = managed and transaction.savepoint(using=using)
+    try:
+        registry[claimed.name](*json.loads(claimed.arguments))
+        if managed:
+            transaction.savepoint_commit(sid, using=using)
+    except Exception:
+        error = traceback.format_exc()
+
+        # a database error leaves the transaction unusable until it's rolled
+        # back, and the failure still has to be recorded
+        if managed:
+            transaction.savepoint_rollback(sid, using=using)
+        else:
+            transaction.rollback_unless_managed(using=using)
+
+        log.error('Task %s failed (attempt %s of %s):\n%s' % (claimed, claimed.attempts, claimed.max_attempts, error))
+
+        if claimed.attempts >= claimed.max_attempts:
+            tasks.update(status=ArticleTask.FAILED, last_error=error)
+        else:
+            delay = RETRY_DELAY * 2 ** (claimed.attempts - 1)
+            tasks.update(status=ArticleTask.PENDING, last_error=error,
+                         run_after=datetime.now() + timedelta(seconds=delay))
+        return False
+    finally:
+        _current.task = None
+
+    tasks.delete()
+    return True
+
+def work(worker=None, limit=10, using=DEFAULT_DB):
+    """Claims and runs a batch of tasks; returns how many ran and how many failed"""
+
+    worker = worker or worker_name()
+    reclaim(using)
+
+    done = failed = 0
+    for claimed in claim(worker, limit, using):
+        if run(claimed, using):
+            done += 1
+        else:
+            failed += 1
+
+    return done, failed
+
+@task
+def apply_new_tag(tag_id):
+    """Applies a new tag to existing articles that are marked for auto-tagging"""
+
+    try:
+        tag = Tag.objects.get(pk=tag_id)
+    except Tag.DoesNotExist:
+        return
+
+    # attempt to find all articles that contain the new tag
+    # TODO: make sure this is standard enough... seems that both MySQL and
+    # PostgreSQL support it...
+    regex = r'[[:<:]]%s[[:>:]]' % tag.name
+
+    log.debug('Searching for auto-tag Articles using regex: %s' % (regex,))
+    applicable_articles = Article.objects.filter(
+        Q(auto_tag=True),
+        Q(content__iregex=regex) |
+        Q(title__iregex=regex) |
+        Q(description__iregex=regex) |
+        Q(keywords__iregex=regex)
+    )
+
+    log.debug('Found %s matches' % len(applicable_articles))
+    for i, article in enumerate(applicable_articles):
+        if i % 50 == 49:
+            # this can take a while on a large site
+            extend_claim()
+
+        log.debug('Applying Tag "%s" (%s) to Article "%s" (%s)' % (tag, tag.pk, article.title, article.pk))
+        article.tags.add(tag)
+        article.save()
+
+@task
+def add_tags(article_ids, tag_ids):
+    """Tags many articles at once"""
+
+    Article.objects.add_tags(article_ids, Tag.objects.filter(id__in=tag_ids))
+
+@task
+def lookup_link_titles(article_id):
+    """Looks up the titles of the pages an article links to, ahead of time"""
+
+    try:
+        article = Article.objects.get(pk=article_id)
+    except Article.DoesNotExist:
+        return
+
+    links = article.links
+    log.debug('Found the titles of %s links in %s' % (len(links), article))
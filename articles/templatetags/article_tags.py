@@ -1,13 +1,17 @@
 from django import template
-from django.core.cache import cache
 from django.core.urlresolvers import resolve, reverse, Resolver404
 from django.db.models import Count
-from articles.models import Article, Tag
+from django.conf import settings
+from articles import caching
+from articles.models import Article, ArticleSummary, Tag, cached_results
 from datetime import datetime
 import math
 
 register = template.Library()
 
+ARCHIVE_TIMEOUT = 300
+TAG_CLOUD_TIMEOUT = 300
+
 class GetCategoriesNode(template.Node):
     """
     Retrieves a list of live article tags and places it into the context
@@ -36,7 +40,8 @@ def get_article_tags(parser, token):
 
 class GetArticlesNode(template.Node):
     """
-    Retrieves a set of article objects.
+    Retrieves a set of articles, as ``ArticleSummary`` records with the
+    title, slug, publish date and description of each.
 
     Usage::
 
@@ -62,17 +67,27 @@ class GetArticlesNode(template.Node):
         else:
             order = 'publish_date'
 
-        user = context.get('user', None)
-
-        # get the live articles in the appropriate order
-        articles = Article.objects.live(user=user).order_by(order).select_related()
-
         if self.count:
             # if we have a number of articles to retrieve, pull the first of them
-            articles = articles[:int(self.count)]
+            start, end = 0, int(self.count)
         else:
             # get a range of articles
-            articles = articles[(int(self.start) - 1):int(self.end)]
+            start, end = int(self.start) - 1, int(self.end)
+
+        user = context.get('user', None)
+        superuser = user is not None and user.is_superuser
+
+        def load():
+            # listings come newest first, sorted on whichever table lets an
+            # index do the work
+            articles = Article.objects.listed(user=user)
+            if order == 'publish_date':
+                articles = articles.reverse()
+            return ArticleSummary.fetch(articles[start:end])
+
+        # superusers see every active article, so they get their own copy
+        key = 'get_articles:%s:%s:%s:%s' % (superuser and 'superuser' or settings.SITE_ID, order, start, end)
+        articles = cached_results(key, load, local=True)
 
         # don't send back a list when we really don't need/want one
         if len(articles) == 1 and not self.start and int(self.count) == 1:
@@ -116,14 +131,14 @@ class GetArticleArchivesNode(template.Node):
         self.varname = varname
 
     def render(self, context):
-        cache_key = 'article_archive_list'
-        dt_archives = cache.get(cache_key)
-        if dt_archives is None:
+        user = context.get('user', None)
+        superuser = user is not None and user.is_superuser
+
+        def archives_for():
             archives = {}
-            user = context.get('user', None)
 
             # iterate over all live articles
-            for article in Article.objects.live(user=user).select_related():
+            for article in Article.objects.listed(user=user).select_related():
                 pub = article.publish_date
 
                 # see if we already have an article in this year
@@ -155,7 +170,11 @@ class GetArticleArchivesNode(template.Node):
                 # append this list to our final collection
                 dt_archives.append( ( year, tuple(months) ) )
 
-            cache.set(cache_key, dt_archives)
+            return dt_archives
+
+        # superusers see every active article, so they get their own copy
+        dt_archives = caching.get_or_set('archives', superuser and 'superuser' or settings.SITE_ID,
+                                         archives_for, ARCHIVE_TIMEOUT, local=True)
 
         # put our collection into the context
         context[self.varname] = dt_archives
@@ -228,17 +247,22 @@ class GetPageURLNode(template.Node):
         # get the page number we're linking to from the context
         page_num = self.page_num.resolve(context)
 
-        try:
-            # determine what view we are using based upon the path of this page
-            view, args, kwargs = resolve(context['request'].path)
-        except (Resolver404, KeyError):
-            raise ValueError('Invalid pagination page.')
+        # the listing views work out the URLs of their pages ahead of time
+        page_urls = context.get('page_urls')
+        if page_urls is not None:
+            url = page_urls.url(page_num)
         else:
-            # set the page parameter for this view
-            kwargs['page'] = page_num
-
-            # get the new URL from Django
-            url = reverse(view, args=args, kwargs=kwargs)
+            try:
+                # determine what view we are using based upon the path of this page
+                view, args, kwargs = resolve(context['request'].path)
+            except (Resolver404, KeyError):
+                raise ValueError('Invalid pagination page.')
+            else:
+                # set the page parameter for this view
+                kwargs['page'] = page_num
+
+                # get the new URL from Django
+                url = reverse(view, args=args, kwargs=kwargs)
 
         if self.varname:
             # if we have a varname, put the URL into the context and return nothing
@@ -269,17 +293,14 @@ def get_page_url(parser, token):
 def tag_cloud():
     """Provides the tags with a "weight" attribute to build a tag cloud"""
 
-    cache_key = 'tag_cloud_tags'
-    tags = cache.get(cache_key)
-    if tags is None:
+    def weigh():
         MAX_WEIGHT = 7
-        tags = Tag.objects.annotate(count=Count('article'))
+        tags = list(Tag.objects.annotate(count=Count('article')))
 
         if len(tags) == 0:
-            # go no further
-            return {}
+            return tags
 
-        min_count = max_count = tags[0].article_set.count()
+        min_count = max_count = tags[0].count
         for tag in tags:
             if tag.count < min_count:
                 min_count = tag.count
@@ -295,7 +316,12 @@ def tag_cloud():
         for tag in tags:
             tag.weight = int(MAX_WEIGHT * (tag.count - min_count) / _range)
 
-        cache.set(cache_key, tags)
+        return tags
+
+    tags = caching.get_or_set('tag_cloud', 'tags', weigh, TAG_CLOUD_TIMEOUT, local=True)
+    if not tags:
+        # go no further
+        return {}
 
     return {'tags': tags}
 
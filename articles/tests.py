@@ -1,13 +1,46 @@
 # -*- coding: utf-8 -*-
 
 from datetime import datetime, timedelta
-
-from django.contrib.auth.models import User, Permission
-from django.core.urlresolvers import reverse
-from django.test import TestCase
-from django.test.client import Client
-
-from models import Article, ArticleStatus, Tag, get_name, MARKUP_HTML, MARKUP_MARKDOWN, MARKUP_REST, MARKUP_TEXTILE
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+from django.conf import settings
+from django.contrib.auth.models import AnonymousUser, User, Permission
+from django.contrib.sites.models import Site
+from django.core.management import call_command
+from django.core.cache import cache
+from django.core.paginator import Paginator
+from django.db import connection, connections, router as db_router, transaction
+from django.http import HttpResponse
+from django.template import Context, Template
+from django.template.loader import render_to_string
+from django.conf.urls.defaults import include, patterns
+from django.core.urlresolvers import get_script_prefix, NoReverseMatch, reverse, set_script_prefix, set_urlconf
+from django.test import TestCase, TransactionTestCase
+from django.test.client import Client, RequestFactory
+from django.utils import simplejson as json
+
+import caching
+import feeds
+import models
+import permalinks
+import routers
+import search as search_module
+import tasks
+from autocomplete import CHANGE_KEY, TagIndex, tag_index
+from dependencies import affected_urls, snapshots
+from export import export
+from importing import TagMatcher
+from forms import ArticleAdminForm, tags
+from related import STALE_KEY, TermMatrix, rebuild, update_stale
+from rendering import rerender
+from signals import pages_affected
+from search import search, tokenize
+from views import page_window
+from models import Article, ArticleSearchTerm, ArticleStatus, ArticleTask, ArticleVisibility, RelatedArticle, Tag, get_name, cached_query, MARKUP_HTML, MARKUP_MARKDOWN, MARKUP_REST, MARKUP_TEXTILE, TRANSITION_KEY
 
 class ArticleUtilMixin(object):
 
@@ -68,6 +101,1095 @@ class TagTestCase(TestCase):
         t = Tag.objects.create(name=name)
         self.assertEqual(t.get_absolute_url(), reverse('articles_display_tag', args=[Tag.clean_tag(name)]))
 
+    def test_get_by_slug(self):
+        cache.clear()
+        caching.local_cache.clear()
+        t = Tag.objects.create(name='Hi There')
+
+        self.assertEqual(Tag.objects.get_by_slug('hi-there'), t)
+        self.assertNumQueries(0, lambda: Tag.objects.get_by_slug('hi-there'))
+
+        # names and differently cased slugs find the same tag
+        self.assertEqual(Tag.objects.get_by_slug('Hi There'), t)
+        self.assertEqual(Tag.objects.get_by_slug('HI-THERE'), t)
+        self.assertEqual(self.client.get('/tag/Hi There/').status_code, 200)
+
+        self.assertRaises(Tag.DoesNotExist, Tag.objects.get_by_slug, 'bye')
+        self.assertEqual(self.client.get('/tag/bye/').status_code, 404)
+
+        # renamed tags aren't found by their old slugs
+        t.name = 'Bye'
+        t.save()
+        self.assertEqual(Tag.objects.get_by_slug('bye'), t)
+        self.assertRaises(Tag.DoesNotExist, Tag.objects.get_by_slug, 'hi-there')
+
+class TagAutocompleteTestCase(TestCase, ArticleUtilMixin):
+    fixtures = ['users']
+
+    def test_search(self):
+        """Popular tags come first and changes show up right away"""
+
+        python = Tag.objects.create(name='Python')
+        Tag.objects.create(name='pyramid')
+        Tag.objects.create(name='perl')
+        self.new_article('Snakes', 'Hiss', tags=[python])
+
+        tag_index.build()
+        self.assertEqual(tag_index.search('py'), ['Python', 'pyramid'])
+        self.assertEqual(tag_index.search('PYR'), ['pyramid'])
+
+        Tag.objects.create(name='pypy')
+        self.assertEqual(tag_index.search('pyp'), ['pypy'])
+
+        python.delete()
+        self.assertEqual(tag_index.search('py'), ['pypy', 'pyramid'])
+
+    def test_other_process(self):
+        """Other processes apply logged changes instead of rebuilding"""
+
+        cache.clear()
+        other = TagIndex()
+        python = Tag.objects.create(name='python')
+        pyramid = Tag.objects.create(name='pyramid')
+        other.ensure_fresh()
+        built = other._built
+        self.assertEqual(other.search('py'), ['pyramid', 'python'])
+
+        # tags change and articles get tagged in this process
+        Tag.objects.create(name='pypy')
+        pyramid.name = 'Pyramid'
+        pyramid.save()
+        a = self.new_article('Snakes', 'Hiss')
+        a.tags.add(python)
+
+        self.assertNumQueries(0, other.ensure_fresh)
+        self.assertEqual(other._built, built)
+        self.assertEqual(other.search('py'), ['python', 'pypy', 'Pyramid'])
+
+        a.delete()
+        python.delete()
+        other.ensure_fresh()
+        self.assertEqual(other.search('py'), ['pypy', 'Pyramid'])
+
+        # missing part of the log, it starts over
+        Tag.objects.create(name='pylons')
+        cache.delete(CHANGE_KEY % other.current_version())
+        other.ensure_fresh()
+        self.assertNotEqual(other._built, built)
+        self.assertEqual(other.search('pyl'), ['pylons'])
+
+    def test_view(self):
+        """The view sends back a small JSON list of names"""
+
+        Tag.objects.create(name='django')
+        res = self.client.get(reverse('articles_tag_autocomplete'), {'q': 'DJan'})
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(json.loads(res.content), ['django'])
+
+class SearchTestCase(TestCase, ArticleUtilMixin):
+    fixtures = ['users']
+
+    def test_tokenize(self):
+        self.assertEqual(tokenize(u'The <b>Quick</b>, quick fox!'), [u'quick', u'quick', u'fox'])
+
+    def test_ranking(self):
+        """Titles and tags count for more than the body, and every word must match"""
+
+        body = self.new_article('Gardening', 'Notes about python and ruby plants')
+        title = self.new_article('Python tricks', 'Some ruby notes too')
+        tagged = self.new_article('Snakes', 'Nothing to see', tags=tags(['python']))
+
+        self.assertEqual(search('python'), [title.id, tagged.id, body.id])
+        self.assertEqual(search('python ruby'), [title.id, body.id])
+        self.assertEqual(search('perl'), [])
+        self.assertEqual(search('the'), [])
+
+    def test_incremental_updates(self):
+        """Edits, tag changes and deletions are reflected right away"""
+
+        a = self.new_article('Sample', 'sample')
+        self.assertEqual(search('rewritten'), [])
+
+        a.content = 'rewritten'
+        a.save()
+        self.assertEqual(search('rewritten'), [a.id])
+
+        a.tags.add(*tags(['tagged']))
+        self.assertEqual(search('tagged'), [a.id])
+
+        a.delete()
+        self.assertEqual(search('rewritten'), [])
+        self.assertEqual(ArticleSearchTerm.objects.count(), 0)
+
+    def test_view(self):
+        """Only live articles are listed, a page at a time"""
+
+        live_status = ArticleStatus.objects.filter(is_live=True)[0]
+        for i in range(25):
+            self.new_article('Widget %s' % i, 'about widgets', status=live_status)
+        self.new_article('Widget draft', 'about widgets')
+
+        res = self.client.get(reverse('articles_search'), {'q': 'widgets'})
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.context['results'].count, 25)
+        self.assertEqual(len(res.context['results_page'].object_list), 20)
+
+        res = self.client.get(reverse('articles_search'), {'q': 'widgets', 'page': 2})
+        self.assertEqual(len(res.context['results_page'].object_list), 5)
+
+        res = self.client.get(reverse('articles_search'), {'q': 'widgets', 'page': 3})
+        self.assertEqual(res.status_code, 404)
+
+    def test_postgres_install(self):
+        """The document table is created the first time it's needed"""
+
+        class Cursor(list):
+            def fetchone(self):
+                return self and self[0] or None
+
+        class Backend(search_module.PostgresBackend):
+            tables = []
+            statements = []
+
+            def execute(self, sql, params=()):
+                self.statements.append(sql.split()[0])
+                if 'CREATE TABLE' in sql:
+                    self.tables.append(self.table)
+                return Cursor([(1,)] if params == [self.table] and self.tables else [])
+
+        backend = Backend()
+        try:
+            backend.remove([1])
+            self.assertEqual(Backend.statements, ['SELECT', 'CREATE', 'SELECT', 'CREATE', 'DELETE'])
+
+            del Backend.statements[:]
+            backend.remove([1])
+            backend.remove([1])
+            self.assertEqual(Backend.statements, ['SELECT', 'DELETE', 'DELETE'])
+        finally:
+            search_module._installed.discard('default')
+
+class RelatedArticleTestCase(TestCase, ArticleUtilMixin):
+    fixtures = ['users']
+
+    def setUp(self):
+        cache.clear()
+        self.live_status = ArticleStatus.objects.filter(is_live=True)[0]
+
+    def test_similarity(self):
+        """Shared rare words and shared tags both count"""
+
+        matrix = TermMatrix({
+            1: ({'python': 1.0, 'django': 1.0, 'common': 1.0}, frozenset([1])),
+            2: ({'python': 1.0, 'django': 1.0, 'common': 1.0}, frozenset()),
+            3: ({'python': 1.0, 'common': 1.0}, frozenset([1])),
+            4: ({'common': 1.0, 'other': 1.0}, frozenset()),
+        })
+
+        self.assertEqual([pk for score, pk in matrix.similar(1)], [2, 3])
+        self.assertEqual([pk for score, pk in matrix.similar(1, 1)], [2])
+        self.assertEqual(matrix.similar(4), [])
+
+    def test_rebuild_and_update(self):
+        """Changes only touch the articles they affect"""
+
+        a = self.new_article('Python web frameworks', 'django flask pyramid', status=self.live_status)
+        b = self.new_article('Django tips', 'django flask pyramid', status=self.live_status)
+        c = self.new_article('Gardening', 'tomatoes basil', status=self.live_status)
+        d = self.new_article('Herbs', 'tomatoes basil', status=self.live_status)
+
+        rebuild()
+        self.assertEqual(a.get_related_articles(), [b])
+        self.assertEqual(Article.objects.get(pk=c.pk).get_related_articles(), [d])
+
+        c.content = c.description = 'django flask pyramid'
+        c.save()
+        self.assertEqual(update_stale(), 4)
+        self.assertEqual(set(Article.objects.get(pk=a.pk).get_related_articles()), set([b, c]))
+        self.assertEqual(Article.objects.get(pk=d.pk).get_related_articles(), [])
+        self.assertEqual(update_stale(), 0)
+
+    def test_curated(self):
+        """Hand-picked related articles show up first and right away"""
+
+        a = self.new_article('Python', 'django', status=self.live_status)
+        b = self.new_article('Django', 'django', status=self.live_status)
+        c = self.new_article('Cooking', 'basil', status=self.live_status)
+
+        a.related_articles.add(c)
+        rebuild()
+        self.assertEqual(Article.objects.get(pk=a.pk).get_related_articles(), [c, b])
+        self.assertEqual(Article.objects.get(pk=c.pk).get_related_articles(), [a])
+
+        a.related_articles.clear()
+        self.assertEqual(Article.objects.get(pk=a.pk).get_related_articles(), [b])
+        self.assertEqual(RelatedArticle.objects.filter(curated=True).count(), 0)
+
+    def test_single_query(self):
+        a = self.new_article('Python', 'django', status=self.live_status)
+        self.new_article('Django', 'django', status=self.live_status)
+        rebuild()
+
+        Article.objects.get(pk=a.pk).get_related_articles()
+        a = Article.objects.get(pk=a.pk)
+        self.assertNumQueries(0, a.get_related_articles)
+
+class ExportTestCase(TestCase, ArticleUtilMixin):
+    fixtures = ['users']
+
+    def setUp(self):
+        cache.clear()
+        self.output = tempfile.mkdtemp()
+        self.live_status = ArticleStatus.objects.filter(is_live=True)[0]
+
+    def tearDown(self):
+        shutil.rmtree(self.output)
+
+    def path(self, *parts):
+        return os.path.join(self.output, *parts)
+
+    def test_export(self):
+        """Every public page is written, and later only what changed"""
+
+        year = str(datetime.now().year)
+        a = self.new_article('First', 'first', tags=tags(['django']), status=self.live_status)
+        b = self.new_article('Second', 'second', status=self.live_status)
+        self.new_article('Draft', 'draft')
+
+        rendered, removed = export(self.output)
+        self.assertTrue(os.path.exists(self.path('index.html')))
+        self.assertTrue(os.path.exists(self.path(year, 'first', 'index.html')))
+        self.assertTrue(os.path.exists(self.path('tag', 'django', 'index.html')))
+        self.assertTrue(os.path.exists(self.path('feeds', 'latest.rss')))
+        self.assertFalse(os.path.exists(self.path(year, 'draft')))
+        self.assertTrue('First' in open(self.path('tag', 'django', 'index.html')).read())
+
+        rendered, removed = export(self.output)
+        self.assertEqual(rendered, set())
+
+        b.title = 'Second Edition'
+        b.save()
+        rendered, removed = export(self.output)
+        self.assertTrue(b.get_absolute_url() in rendered)
+        self.assertFalse(reverse('articles_display_tag', args=['django']) in rendered)
+
+        a.tags.clear()
+        rendered, removed = export(self.output)
+        self.assertTrue(reverse('articles_display_tag', args=['django']) in removed)
+        self.assertFalse(os.path.exists(self.path('tag', 'django', 'index.html')))
+
+class DependencyTestCase(TestCase, ArticleUtilMixin):
+    fixtures = ['users']
+
+    def setUp(self):
+        cache.clear()
+        self.affected = []
+        pages_affected.connect(self.collect)
+        self.addCleanup(pages_affected.disconnect, self.collect)
+
+        live_status = ArticleStatus.objects.filter(is_live=True)[0]
+        self.articles = [self.new_article('Article %02d' % i, 'content', status=live_status,
+                                          publish_date=datetime(2010, 5, 1) + timedelta(hours=i))
+                         for i in range(30)]
+        self.affected = []
+
+    def collect(self, sender, urls, **kwargs):
+        self.affected.append(urls)
+
+    def affected_urls(self):
+        found = set()
+        for urls in self.affected:
+            found |= urls
+        return found
+
+    def test_add_tags(self):
+        """Tagging articles in bulk affects the tag's pages and marks them stale"""
+
+        cache.delete(STALE_KEY)
+        tag = Tag.objects.create(name='bulk')
+        self.affected = []
+
+        a, b = self.articles[3], self.articles[4]
+        self.assertEqual(Article.objects.add_tags([a.pk, b.pk], [tag]), 2)
+
+        urls = self.affected_urls()
+        self.assertTrue(reverse('articles_display_tag', args=['bulk']) in urls)
+        self.assertTrue(reverse('articles_rss_feed_tag', args=['bulk']) in urls)
+        self.assertEqual(cache.get(STALE_KEY), set([a.pk, b.pk]))
+
+        # nothing happens when they already have the tag
+        self.affected = []
+        self.assertEqual(Article.objects.add_tags([a.pk], [tag]), 0)
+        self.assertEqual(self.affected, [])
+
+    def test_content_change(self):
+        """Changing only the text affects only the article's own page"""
+
+        a = self.articles[10]
+        a.content = 'new content'
+        a.save()
+        self.assertEqual(self.affected_urls(), set([a.get_absolute_url()]))
+
+    def test_title_change(self):
+        """The listing pages from the article onwards and its neighbours change"""
+
+        a = self.articles[2]
+        a.title = 'Article 02 (updated)'
+        a.save()
+
+        urls = self.affected_urls()
+        self.assertTrue(reverse('articles_archive_page', args=[2]) in urls)
+        self.assertFalse(reverse('articles_archive') in urls)
+        self.assertTrue(reverse('articles_in_month_page', args=[2010, 5, 2]) in urls)
+        self.assertTrue(reverse('articles_by_author_page', args=[a.author.username, 2]) in urls)
+        self.assertTrue(self.articles[1].get_absolute_url() in urls)
+        self.assertTrue(self.articles[3].get_absolute_url() in urls)
+        self.assertFalse(self.articles[10].get_absolute_url() in urls)
+
+        # it's near the bottom of the list, far from the latest articles
+        self.assertFalse(reverse('articles_rss_feed_latest') in urls)
+
+    def test_new_month(self):
+        """A new month in the sidebar affects every page"""
+
+        self.new_article('Brand new', 'content', status=self.articles[0].status)
+        self.assertTrue(None in self.affected)
+
+    def test_tag_rename(self):
+        tag = tags(['python'])[0]
+        self.articles[0].tags.add(tag)
+        self.affected = []
+
+        tag.name = 'Python3'
+        tag.save()
+
+        urls = self.affected_urls()
+        self.assertTrue(reverse('articles_display_tag', args=['python']) in urls)
+        self.assertTrue(reverse('articles_display_tag', args=['python3']) in urls)
+        self.assertTrue(self.articles[0].get_absolute_url() in urls)
+
+    def test_api(self):
+        """The URLs can be computed without saving anything"""
+
+        a = self.articles[29]
+        before = snapshots([a.pk])
+        after = dict((pk, s._replace(visible=False)) for pk, s in before.items())
+
+        urls = affected_urls(before, after)
+        self.assertTrue(reverse('articles_archive') in urls)
+        self.assertTrue(reverse('articles_rss_feed_latest') in urls)
+        self.assertTrue(reverse('articles_archive_page', args=[2]) in urls)
+        self.assertFalse(self.articles[10].get_absolute_url() in urls)
+
+class CachingTestCase(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        caching.reset_stats()
+        self.computed = []
+
+    def compute(self, value):
+        def compute():
+            self.computed.append(value)
+            return value
+        return compute
+
+    def test_bump(self):
+        self.assertEqual(caching.get_or_set('test', 'key', self.compute(1), 60), 1)
+        self.assertEqual(caching.get_or_set('test', 'key', self.compute(2), 60), 1)
+        self.assertEqual(caching.get_or_set('other', 'key', self.compute(3), 60), 3)
+
+        caching.bump('test')
+        self.assertEqual(caching.get_or_set('test', 'key', self.compute(4), 60), 4)
+        self.assertEqual(caching.get_or_set('other', 'key', self.compute(5), 60), 3)
+        self.assertEqual(self.computed, [1, 3, 4])
+
+    def test_stale_while_revalidate(self):
+        key = caching.make_key('test', 'key')
+        cache.set(key, (time.time() - 1, 'old'), 60)
+
+        # somebody else is already recomputing it
+        cache.add(key + ':lock', True)
+        self.assertEqual(caching.get_or_set('test', 'key', self.compute('new'), 60), 'old')
+        self.assertEqual(self.computed, [])
+
+        cache.delete(key + ':lock')
+        self.assertEqual(caching.get_or_set('test', 'key', self.compute('new'), 60), 'new')
+        self.assertEqual(caching.get_or_set('test', 'key', self.compute('newer'), 60), 'new')
+        self.assertEqual(self.computed, ['new'])
+
+        counters = caching.stats()['test']
+        self.assertEqual((counters['stale'], counters['hits'], counters['recomputes']), (2, 1, 1))
+
+    def test_single_flight(self):
+        key = caching.make_key('test', 'key')
+        cache.add(key + ':lock', True)
+
+        # the process holding the lock finishes shortly
+        finish = threading.Timer(0.1, lambda: cache.set(key, (time.time() + 60, 'theirs'), 60))
+        finish.start()
+        self.addCleanup(finish.cancel)
+
+        self.assertEqual(caching.get_or_set('test', 'key', self.compute('ours'), 60), 'theirs')
+        self.assertEqual(self.computed, [])
+        self.assertEqual(caching.stats()['test']['waits'], 1)
+
+    def test_uncached(self):
+        self.assertEqual(caching.get_or_set('test', 'key', self.compute(1), 0), 1)
+        self.assertEqual(caching.get_or_set('test', 'key', self.compute(2), 0), 2)
+
+    def test_long_keys(self):
+        key = caching.make_key('test', u'caf\xe9 ' * 100)
+        self.assertTrue(len(key) < caching.MAX_KEY_LENGTH)
+        self.assertEqual(len(key.split()), 1)
+
+    def test_local_tier(self):
+        self.assertEqual(caching.get_or_set('test', 'key', self.compute(1), 60, local=True), 1)
+        self.assertEqual(caching.get_or_set('test', 'key', self.compute(2), 60, local=True), 1)
+
+        counters = caching.stats()['test']
+        self.assertEqual((counters['local_hits'], counters.get('hits', 0)), (1, 0))
+
+        # another process bumps the namespace
+        cache.set_many({caching.version_key('test'): 'theirs', caching.STAMP_KEY: 'theirs'})
+        self.assertEqual(caching.get_or_set('test', 'key', self.compute(3), 60, local=True), 1)
+
+        # and the next request notices
+        caching.local_cache.recheck()
+        self.assertEqual(caching.get_or_set('test', 'key', self.compute(4), 60, local=True), 4)
+        self.assertEqual(self.computed, [1, 4])
+
+    def test_local_tier_size(self):
+        local = caching.LocalCache(size=2)
+        local.set('a', 1)
+        local.set('b', 2)
+        self.assertEqual(local.get('a'), 1)
+
+        # 'b' is now the least recently used
+        local.set('c', 3)
+        self.assertEqual((local.get('a'), local.get('b'), local.get('c')), (1, None, 3))
+
+    def test_name_change(self):
+        user = User.objects.create_user('caching', 'caching@example.com')
+        self.assertEqual(get_name(user), 'caching')
+
+        user.first_name, user.last_name = 'Cached', 'Name'
+        user.save()
+        self.assertEqual(get_name(user), 'Cached Name')
+
+class RouterTestCase(TestCase, ArticleUtilMixin):
+    fixtures = ['users']
+
+    def setUp(self):
+        self.router = routers.ReplicaRouter(replicas=['replica'], primary='default')
+        db_router.routers.insert(0, self.router)
+        self.addCleanup(db_router.routers.remove, self.router)
+
+        routers.unpin_primary()
+        self.addCleanup(routers.unpin_primary)
+        self.factory = RequestFactory()
+        self.middleware = routers.PinPrimaryMiddleware()
+
+    def test_routing(self):
+        self.assertEqual(self.router.db_for_read(Article), 'replica')
+        self.assertEqual(self.router.db_for_read(Tag), 'replica')
+        self.assertEqual(self.router.db_for_read(User), None)
+        self.assertEqual(self.router.db_for_write(Article), 'default')
+
+        # everything else in this request reads what was just written
+        self.assertEqual(self.router.db_for_read(Article), 'default')
+
+    def test_read_your_writes(self):
+        request = self.factory.post('/admin/articles/article/add/')
+        self.middleware.process_request(request)
+        self.assertEqual(self.router.db_for_read(Article), 'default')
+
+        article = self.new_article('Routed', 'Saved on the primary')
+        self.assertEqual(article._state.db, 'default')
+
+        response = self.middleware.process_response(request, HttpResponse())
+        self.assertTrue(routers.PIN_COOKIE in response.cookies)
+        self.assertEqual(self.router.db_for_read(Article), 'replica')
+
+        # the editor is redirected and sees their own change
+        request = self.factory.get(article.get_absolute_url())
+        request.COOKIES[routers.PIN_COOKIE] = '1'
+        self.middleware.process_request(request)
+        self.assertEqual(self.router.db_for_read(Article), 'default')
+        response = self.middleware.process_response(request, HttpResponse())
+        self.assertFalse(routers.PIN_COOKIE in response.cookies)
+
+        # while everybody else reads from the replicas
+        request = self.factory.get(article.get_absolute_url())
+        self.middleware.process_request(request)
+        self.assertEqual(self.router.db_for_read(Article), 'replica')
+
+    def test_cached_queries_read_primary(self):
+        cache.clear()
+        caching.local_cache.clear()
+        self.new_article('Routed', 'Saved on the primary')
+        routers.unpin_primary()
+
+        # there is no replica database here, so this only works on the primary
+        self.assertEqual(len(cached_query(Article.objects.all())), 1)
+        self.assertEqual(models.cached_results('routed', lambda: self.router.db_for_read(Article)), 'default')
+        self.assertFalse(routers.is_pinned())
+
+class BulkImportTestCase(TestCase, ArticleUtilMixin):
+    fixtures = ['users']
+
+    def setUp(self):
+        cache.clear()
+        caching.local_cache.clear()
+        self.status = ArticleStatus.objects.filter(is_live=True)[0]
+
+    def item(self, title, content='Imported content', **kwargs):
+        return dict(title=title, content=content, author=self.superuser, status=self.status, **kwargs)
+
+    def test_import(self):
+        existing = self.new_article('Same Title', 'Already here', status=self.status)
+        python = Tag.objects.create(name='python')
+
+        count = Article.objects.bulk_import([
+            self.item('Same Title'),
+            self.item('Same Title', tags=['imported', python]),
+            self.item('Marked Up', '*Python* rocks', markup=MARKUP_MARKDOWN),
+            self.item('Not Tagged', 'Python again', auto_tag=False),
+        ], chunk_size=3)
+        self.assertEqual(count, 4)
+
+        slugs = Article.objects.exclude(pk=existing.pk).order_by('id').values_list('slug', flat=True)
+        self.assertEqual(list(slugs), ['same-title-1', 'same-title-2', 'marked-up', 'not-tagged'])
+
+        a = Article.objects.get(slug='same-title-2')
+        self.assertEqual(set(t.name for t in a.tags.all()), set(['imported', 'python']))
+        self.assertEqual(a.keywords, 'imported, python')
+        self.assertEqual(a.description, 'Imported content')
+        self.assertEqual(a.addthis_username, self.superuser.username)
+
+        a = Article.objects.get(slug='marked-up')
+        self.assertEqual(a.rendered_content, '<p><em>Python</em> rocks</p>')
+        self.assertEqual(list(a.tags.all()), [python])
+        self.assertEqual(Article.objects.get(slug='not-tagged').tags.count(), 0)
+
+        # imported articles are listed and searchable like any other
+        self.assertEqual(Article.objects.visible().count(), 5)
+        self.assertEqual(search('rocks'), [a.pk])
+
+    def test_chunk_queries(self):
+        items = lambda n: (self.item('Article %s' % i) for i in range(n))
+
+        def queries(n):
+            start = len(connection.queries)
+            Article.objects.bulk_import(items(n), chunk_size=n)
+            return len(connection.queries) - start
+
+        from django.conf import settings
+        settings.DEBUG = True
+        self.addCleanup(setattr, settings, 'DEBUG', False)
+
+        # the same number of queries however big the chunk
+        self.assertEqual(queries(5), queries(50))
+
+    def test_tag_matcher(self):
+        tags = [Tag(pk=i, name=name) for i, name in enumerate(['django', 'django-cms', 'c++', 'web framework', 'py'])]
+        article = Article(title='Django and django-cms', content='A web framework, not a Web  framework.',
+                          description='python', keywords='')
+
+        self.assertEqual(set(TagMatcher(tags).match(article)),
+                         set(t for t in tags if t.name in ('django', 'django-cms', 'web framework')))
+
+class RerenderTestCase(TestCase, ArticleUtilMixin):
+    fixtures = ['users']
+
+    def test_rerender(self):
+        derived = self.new_article('Derived', '*Old* renderer', markup=MARKUP_MARKDOWN)
+        explicit = self.new_article('Explicit', '*Old* renderer', markup=MARKUP_MARKDOWN, description='Hand written')
+        untouched = self.new_article('Untouched', 'Plain <b>HTML</b>')
+
+        # pretend the renderer used to do something else
+        Article.objects.filter(markup=MARKUP_MARKDOWN).update(
+                rendered_content='<p>*Old* renderer</p>', description='<p>*Old* renderer</p>')
+        Article.objects.filter(pk=explicit.pk).update(description='Hand written')
+
+        checked, changed = rerender(Article.objects.all(), dry_run=True)
+        self.assertEqual((checked, changed), (3, [derived.pk, explicit.pk]))
+        self.assertEqual(Article.objects.get(pk=derived.pk).rendered_content, '<p>*Old* renderer</p>')
+
+        checked, changed = rerender(Article.objects.all(), chunk_size=2)
+        self.assertEqual((checked, changed), (3, [derived.pk, explicit.pk]))
+
+        derived = Article.objects.get(pk=derived.pk)
+        self.assertEqual(derived.rendered_content, '<p><em>Old</em> renderer</p>')
+        self.assertEqual(derived.description, '<p><em>Old</em> renderer</p>')
+        self.assertEqual(Article.objects.get(pk=explicit.pk).description, 'Hand written')
+        self.assertEqual(Article.objects.get(pk=untouched.pk).rendered_content, 'Plain <b>HTML</b>')
+
+        # nothing left to do
+        self.assertEqual(rerender(Article.objects.all())[1], [])
+
+    def test_command(self):
+        a = self.new_article('Markdown', '*Hi*', markup=MARKUP_MARKDOWN)
+        b = self.new_article('HTML', 'Hi')
+        Article.objects.update(rendered_content='stale')
+
+        call_command('rerender_articles', markup=[MARKUP_HTML], processes=1, verbosity=0)
+        self.assertEqual(Article.objects.get(pk=a.pk).rendered_content, 'stale')
+        self.assertEqual(Article.objects.get(pk=b.pk).rendered_content, 'Hi')
+
+class PrefixedURLs(object):
+    urlpatterns = patterns('', (r'^blog/', include('articles.urls')))
+
+class PermalinkTestCase(TestCase, ArticleUtilMixin):
+    fixtures = ['users']
+
+    def assertReverses(self, url, name, **kwargs):
+        self.assertEqual(url, reverse(name, kwargs=kwargs))
+
+    def check_urls(self):
+        article = self.new_article(u'Caf\xe9 society', 'Hi')
+        tag = Tag.objects.create(name=u'Na\xefve things')
+
+        self.assertReverses(article.get_absolute_url(), 'articles_display_article',
+                            year=article.publish_date.year, slug=article.slug)
+        self.assertReverses(article.get_author_url(), 'articles_by_author', username=article.author.username)
+        self.assertReverses(tag.get_absolute_url(), 'articles_display_tag', tag=tag.cleaned)
+        self.assertReverses(tag.get_rss_url(), 'articles_rss_feed_tag', slug=tag.rss_name)
+        self.assertReverses(tag.get_atom_url(), 'articles_atom_feed_tag', slug=tag.rss_name)
+        self.assertReverses(permalinks.build('articles_in_month_page', year=2011, month=3, page=2),
+                            'articles_in_month_page', year=2011, month=3, page=2)
+        self.assertReverses(permalinks.build('articles_archive'), 'articles_archive')
+
+        return article
+
+    def test_urls(self):
+        article = self.check_urls()
+        self.assertEqual(article.get_absolute_url(), '/%s/%s/' % (article.publish_date.year, article.slug))
+
+    def test_script_prefix(self):
+        prefix = get_script_prefix()
+        set_script_prefix('/site/')
+        try:
+            article = self.check_urls()
+            self.assertTrue(article.get_absolute_url().startswith('/site/'))
+        finally:
+            set_script_prefix(prefix)
+
+    def test_include_prefix(self):
+        set_urlconf(PrefixedURLs)
+        try:
+            article = self.check_urls()
+            self.assertTrue(article.get_absolute_url().startswith('/blog/'))
+        finally:
+            set_urlconf(None)
+
+        # the default URLconf is still used everywhere else
+        self.assertFalse(article.get_absolute_url().startswith('/blog/'))
+
+    def test_unknown_route(self):
+        self.assertRaises(NoReverseMatch, permalinks.build, 'articles_display_tag', slug='nope')
+
+    def test_unmatched_arguments(self):
+        """URLs the route wouldn't match fail like ``reverse`` does"""
+
+        tag = Tag.objects.create(name='c++')
+        self.assertReverses(tag.get_absolute_url(), 'articles_display_tag', tag=tag.cleaned)
+        for get_url, name in ((tag.get_rss_url, 'articles_rss_feed_tag'), (tag.get_atom_url, 'articles_atom_feed_tag')):
+            self.assertRaises(NoReverseMatch, reverse, name, kwargs={'slug': tag.rss_name})
+            self.assertRaises(NoReverseMatch, get_url)
+
+    def test_page_urls(self):
+        urls = permalinks.PageURLs('articles_by_author', username='some one')
+        self.assertReverses(urls.url(1), 'articles_by_author', username='some one')
+        self.assertReverses(urls.url('12'), 'articles_by_author_page', username='some one', page=12)
+
+    def test_page_window(self):
+        paginator = Paginator(range(1000), 10)
+        self.assertEqual(page_window(paginator, 1, 3), [1, 2, 3, 4])
+        self.assertEqual(page_window(paginator, 50, 3), range(47, 54))
+        self.assertEqual(page_window(paginator, 100, 3), [97, 98, 99, 100])
+        self.assertEqual(page_window(Paginator(range(5), 10), 1, 3), [1])
+
+    def test_pagination_links(self):
+        cache.clear()
+        caching.local_cache.clear()
+        status = ArticleStatus.objects.filter(is_live=True)[0]
+        Article.objects.bulk_import(dict(title='Article %s' % i, content='Hi', author=self.superuser, status=status)
+                                    for i in range(50))
+
+        res = self.client.get(reverse('articles_archive_page', kwargs={'page': 2}))
+        self.assertEqual(res.context['page_range'], [1, 2, 3])
+        for url in (reverse('articles_archive'), reverse('articles_archive_page', kwargs={'page': 3})):
+            self.assertContains(res, 'href="%s"' % url)
+
+    def test_pagination_without_window(self):
+        # other views that extend the template only provide the paginator
+        paginator = Paginator(range(50), 20)
+        request = RequestFactory().get(reverse('articles_archive_page', kwargs={'page': 2}))
+        html = render_to_string('articles/base.html', {'request': request, 'paginator': paginator,
+                                                       'page_obj': paginator.page(2)})
+        self.assertTrue('class="current-page">2<' in html)
+        for url in (reverse('articles_archive'), reverse('articles_archive_page', kwargs={'page': 3})):
+            self.assertTrue('href="%s"' % url in html)
+
+calls = []
+
+@tasks.task
+def record_call(*args):
+    calls.append(args)
+
+@tasks.task
+def hold_claim():
+    tasks.extend_claim()
+    calls.append(tasks.reclaim())
+
+@tasks.task
+def always_fail():
+    raise ValueError('Nope')
+
+@tasks.task
+def duplicate_tag():
+    Tag.objects.create(name='twice')
+    Tag.objects.create(name='twice')
+
+class TaskTestCase(TestCase, ArticleUtilMixin):
+    fixtures = ['users']
+
+    def setUp(self):
+        del calls[:]
+        self.addCleanup(setattr, tasks, 'ASYNC_TASKS', tasks.ASYNC_TASKS)
+
+    def test_dispatch(self):
+        tasks.ASYNC_TASKS = False
+        self.assertFalse(tasks.dispatch('record_call', 1, 2))
+        self.assertEqual(calls, [(1, 2)])
+        self.assertEqual(ArticleTask.objects.count(), 0)
+
+        tasks.ASYNC_TASKS = True
+        self.assertTrue(tasks.dispatch('record_call', 3))
+        self.assertEqual(calls, [(1, 2)])
+        self.assertEqual(ArticleTask.objects.count(), 1)
+
+        self.assertEqual(tasks.work('worker'), (1, 0))
+        self.assertEqual(calls, [(1, 2), (3,)])
+        self.assertEqual(ArticleTask.objects.count(), 0)
+
+    def test_deduplication(self):
+        first = tasks.enqueue('record_call', [1])
+        self.assertEqual(tasks.enqueue('record_call', [1], priority=5).pk, first.pk)
+        tasks.enqueue('record_call', [2])
+
+        self.assertEqual(ArticleTask.objects.count(), 2)
+        self.assertEqual(ArticleTask.objects.get(pk=first.pk).priority, 5)
+        self.assertRaises(KeyError, tasks.enqueue, 'no_such_task')
+
+    def test_claim(self):
+        tasks.enqueue('record_call', ['low'])
+        tasks.enqueue('record_call', ['later'], priority=10, delay=60)
+        tasks.enqueue('record_call', ['high'], priority=5)
+
+        claimed = tasks.claim('one', limit=1)
+        self.assertEqual([json.loads(t.arguments) for t in claimed], [['high']])
+        self.assertEqual(claimed[0].status, ArticleTask.RUNNING)
+        self.assertEqual(claimed[0].attempts, 1)
+
+        # another worker doesn't get the same task, nor one that isn't due
+        claimed = tasks.claim('two')
+        self.assertEqual([json.loads(t.arguments) for t in claimed], [['low']])
+        self.assertEqual(tasks.claim('three'), [])
+
+        # a running task doesn't stop the same one being queued again
+        tasks.enqueue('record_call', ['low'])
+        self.assertEqual(ArticleTask.objects.filter(status=ArticleTask.PENDING).count(), 2)
+
+    def test_retries(self):
+        task = tasks.enqueue('always_fail')
+        ArticleTask.objects.filter(pk=task.pk).update(max_attempts=2)
+
+        self.assertEqual(tasks.work('worker'), (0, 1))
+        task = ArticleTask.objects.get(pk=task.pk)
+        self.assertEqual(task.status, ArticleTask.PENDING)
+        self.assertTrue('ValueError' in task.last_error)
+        self.assertTrue(task.run_after > datetime.now() + timedelta(seconds=tasks.RETRY_DELAY - 5))
+
+        # it waits before trying again
+        self.assertEqual(tasks.work('worker'), (0, 0))
+
+        later = datetime.now() + timedelta(seconds=tasks.RETRY_DELAY + 5)
+        for claimed in tasks.claim('worker', now=later):
+            self.assertFalse(tasks.run(claimed))
+        self.assertEqual(ArticleTask.objects.get(pk=task.pk).status, ArticleTask.FAILED)
+
+    def test_reclaim(self):
+        tasks.enqueue('record_call', [1])
+        claimed = tasks.claim('dead')
+        self.assertEqual(len(claimed), 1)
+
+        self.assertEqual(tasks.reclaim(), 0)
+        later = datetime.now() + timedelta(seconds=tasks.CLAIM_TIMEOUT + 1)
+        self.assertEqual(tasks.reclaim(now=later), 1)
+
+        self.assertEqual(tasks.work('alive'), (1, 0))
+        self.assertEqual(calls, [(1,)])
+
+    def test_reclaim_last_attempt(self):
+        task = tasks.enqueue('record_call', [2])
+        ArticleTask.objects.filter(pk=task.pk).update(max_attempts=1)
+        tasks.claim('dead')
+
+        later = datetime.now() + timedelta(seconds=tasks.CLAIM_TIMEOUT + 1)
+        self.assertEqual(tasks.reclaim(now=later), 0)
+        self.assertEqual(ArticleTask.objects.get(pk=task.pk).status, ArticleTask.FAILED)
+        self.assertEqual(tasks.work('alive'), (0, 0))
+
+    def test_database_error(self):
+        task = tasks.enqueue('duplicate_tag')
+        self.assertEqual(tasks.work('worker'), (0, 1))
+
+        # the failure is recorded and the task tried again later
+        task = ArticleTask.objects.get(pk=task.pk)
+        self.assertEqual(task.status, ArticleTask.PENDING)
+        self.assertTrue('IntegrityError' in task.last_error)
+        self.assertTrue(task.run_after > datetime.now())
+
+    def test_extend_claim(self):
+        # nothing to extend outside of a worker
+        tasks.extend_claim()
+
+        tasks.enqueue('hold_claim')
+        claimed = tasks.claim('worker')[0]
+        long_ago = datetime.now() - timedelta(seconds=tasks.CLAIM_TIMEOUT + 1)
+        ArticleTask.objects.filter(pk=claimed.pk).update(claimed_at=long_ago)
+
+        # the task's claim had timed out, but it held on to it while running
+        self.assertTrue(tasks.run(claimed))
+        self.assertEqual(calls, [0])
+
+    def test_add_tags(self):
+        tasks.ASYNC_TASKS = True
+        a = self.new_article('Queued', 'Tagged later')
+        tag = Tag.objects.create(name='later')
+
+        tasks.dispatch('add_tags', [a.pk], [tag.pk])
+        self.assertEqual(a.tags.count(), 0)
+
+        tasks.work('worker')
+        self.assertEqual(list(a.tags.all()), [tag])
+
+def full_scans(queryset):
+    """
+    Returns the tables the database reads from start to finish to answer a
+    query, according to its ``EXPLAIN`` output.
+    """
+
+    sql, params = queryset.query.get_compiler(queryset.db).as_sql()
+    connection = connections[queryset.db]
+    cursor = connection.cursor()
+    vendor = connection.vendor
+
+    if vendor == 'sqlite':
+        cursor.execute('EXPLAIN QUERY PLAN ' + sql, params)
+        scanned = set()
+        for row in cursor.fetchall():
+            # "SCAN TABLE t" or "SCAN t" in newer versions; walking an index
+            # in order, which stops at the limit, doesn't count
+            words = row[-1].split()
+            if words[0] == 'SCAN' and 'INDEX' not in words:
+                scanned.add(words[2] if words[1] == 'TABLE' else words[1])
+        return scanned
+
+    cursor.execute('EXPLAIN ' + sql, params)
+    if vendor == 'postgresql':
+        lines = [row[0] for row in cursor.fetchall()]
+        return set(line.split('Seq Scan on ')[1].split()[0] for line in lines if 'Seq Scan on ' in line)
+    if vendor == 'mysql':
+        columns = [c[0] for c in cursor.description]
+        return set(row[columns.index('table')] for row in cursor.fetchall() if row[columns.index('type')] == 'ALL')
+
+    return set()
+
+LIVE_INDEX = ['is_active', 'status_id', 'publish_date']
+SLUG_INDEX = ['slug', 'publish_date']
+VISIBILITY_INDEX = ['site_id', 'publish_date']
+
+def used_indexes(queryset):
+    """Returns the indexes a query reads, according to its ``EXPLAIN`` output"""
+
+    sql, params = queryset.query.get_compiler(queryset.db).as_sql()
+    connection = connections[queryset.db]
+    cursor = connection.cursor()
+    vendor = connection.vendor
+
+    if vendor == 'sqlite':
+        cursor.execute('EXPLAIN QUERY PLAN ' + sql, params)
+        used = set()
+        for row in cursor.fetchall():
+            # "SEARCH t USING INDEX i (...)" or "USING COVERING INDEX i"
+            words = row[-1].split()
+            if 'INDEX' in words and 'USING' in words:
+                used.add(words[words.index('INDEX') + 1])
+        return used
+
+    cursor.execute('EXPLAIN ' + sql, params)
+    if vendor == 'postgresql':
+        used = set()
+        for line in [row[0] for row in cursor.fetchall()]:
+            if ' using ' in line and 'Index' in line:
+                used.add(line.split(' using ')[1].split()[0])
+            elif 'Bitmap Index Scan on ' in line:
+                used.add(line.split('Bitmap Index Scan on ')[1].split()[0])
+        return used
+    if vendor == 'mysql':
+        columns = [c[0] for c in cursor.description]
+        return set(row[columns.index('key')] for row in cursor.fetchall() if row[columns.index('key')])
+
+    return set()
+
+def sorts_everything(queryset):
+    """Whether the database sorts every matching row to answer a query"""
+
+    sql, params = queryset.query.get_compiler(queryset.db).as_sql()
+    connection = connections[queryset.db]
+    cursor = connection.cursor()
+    vendor = connection.vendor
+
+    if vendor == 'sqlite':
+        # sorting rows that tie on an index's order is fine
+        cursor.execute('EXPLAIN QUERY PLAN ' + sql, params)
+        return any(row[-1] == 'USE TEMP B-TREE FOR ORDER BY' for row in cursor.fetchall())
+
+    cursor.execute('EXPLAIN ' + sql, params)
+    if vendor == 'postgresql':
+        return any(row[0].strip().startswith('Sort') for row in cursor.fetchall())
+    if vendor == 'mysql':
+        columns = [c[0] for c in cursor.description]
+        return any('filesort' in (row[columns.index('Extra')] or '') for row in cursor.fetchall())
+
+    return False
+
+def index_names(table, using='default'):
+    """Returns the names of the indexes on a table"""
+
+    connection = connections[using]
+    cursor = connection.cursor()
+    if connection.vendor == 'sqlite':
+        cursor.execute("SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = %s", [table])
+        return set(row[0] for row in cursor.fetchall())
+    if connection.vendor == 'postgresql':
+        cursor.execute('SELECT indexname FROM pg_indexes WHERE tablename = %s', [table])
+        return set(row[0] for row in cursor.fetchall())
+    if connection.vendor == 'mysql':
+        cursor.execute('SHOW INDEX FROM %s' % connection.ops.quote_name(table))
+        return set(row[2] for row in cursor.fetchall())
+
+    return set()
+
+def index_name(table, columns):
+    """The name South gives the index on ``columns``"""
+
+    from south.db import db
+    return db.create_index_name(table, columns)
+
+def migrate_indexes():
+    """
+    Adds the indexes that the migrations create and ``syncdb`` leaves out
+    when the tests don't run through South.
+    """
+
+    from django.utils.importlib import import_module
+    from south.db import db
+
+    if index_name('articles_article', LIVE_INDEX) not in index_names('articles_article'):
+        migration = import_module('articles.migrations.0013_add_article_composite_indexes')
+        migration.Migration().forwards(None)
+
+    # 0006 creates the table along with it
+    if index_name('articles_articlevisibility', VISIBILITY_INDEX) not in index_names('articles_articlevisibility'):
+        db.create_index('articles_articlevisibility', VISIBILITY_INDEX)
+
+    db.execute_deferred_sql()
+    transaction.commit_unless_managed()
+
+def analyze(using='default'):
+    """Lets the query planner see how many rows there are"""
+
+    # SQLite and MySQL would commit the test's transaction first, and their
+    # planners favour indexes without statistics anyway
+    connection = connections[using]
+    if connection.vendor == 'postgresql':
+        connection.cursor().execute('ANALYZE')
+
+class QueryPlanTestCase(TransactionTestCase, ArticleUtilMixin):
+    """
+    Makes sure the queries behind the busiest pages use indexes, including the
+    ones the migrations add.  SQLite commits before running ``EXPLAIN``, so
+    the tables are emptied before each test instead of rolling back after it.
+    """
+
+    fixtures = ['users']
+    count = 2000
+
+    def setUp(self):
+        cache.clear()
+        caching.local_cache.clear()
+        migrate_indexes()
+
+        statuses = list(ArticleStatus.objects.all())
+        now = datetime.now()
+        Article.objects.bulk_create([
+            Article(title='Article %s' % i, slug='article-%s' % i, author=self.superuser,
+                    status=statuses[i % len(statuses)], content='Content', rendered_content='Content',
+                    addthis_username='', is_active=i % 10 != 0,
+                    publish_date=now - timedelta(days=i % 1000 - 10),
+                    expiration_date=now + timedelta(days=i % 50) if i % 7 == 0 else None)
+            for i in range(self.count)])
+
+        ids = list(Article.objects.values_list('id', flat=True))
+        Article.sites.through.objects.bulk_create([Article.sites.through(article_id=pk, site_id=1) for pk in ids])
+        Article.objects.refresh_visibility(ids)
+
+        self.tag = Tag.objects.create(name='common')
+        Article.tags.through.objects.bulk_create([Article.tags.through(article_id=pk, tag=self.tag) for pk in ids[::20]])
+        analyze()
+
+    def assertIndexed(self, queryset):
+        scans = full_scans(queryset)
+        self.assertFalse(scans & set(['articles_article', 'articles_articlevisibility']),
+                         'Full scan of %s for %s' % (', '.join(scans), queryset.query))
+
+    def assertUsesIndex(self, queryset, columns, table='articles_article'):
+        name = index_name(table, columns)
+        used = used_indexes(queryset)
+        self.assertTrue(name in used, '%s not used for %s (used %s)' % (name, queryset.query, ', '.join(used)))
+
+    def test_full_scans(self):
+        # titles aren't indexed
+        self.assertEqual(full_scans(Article.objects.filter(title='Article 5').order_by()), set(['articles_article']))
+
+    def test_listings(self):
+        self.assertIndexed(Article.objects.live()[:20])
+        self.assertUsesIndex(Article.objects.live()[:20], LIVE_INDEX)
+        self.assertIndexed(Article.objects.visible()[:20])
+
+    def test_article_page(self):
+        article = Article.objects.live().filter(slug='article-5', **models.published_in(datetime.now().year))
+        self.assertIndexed(article)
+        self.assertUsesIndex(article, SLUG_INDEX)
+
+    def test_feeds(self):
+        self.assertIndexed(Article.objects.visible()[:15])
+        self.assertIndexed(self.tag.article_set.visible())
+
+    def test_visible_order(self):
+        # the visibility rows are read in order, not sorted afterwards
+        for queryset in (Article.objects.visible()[:20], Article.objects.visible().reverse()[:20]):
+            self.assertUsesIndex(queryset, VISIBILITY_INDEX, 'articles_articlevisibility')
+            self.assertFalse(sorts_everything(queryset), 'Sorted every row for %s' % queryset.query)
+
+    def test_scheduler(self):
+        self.assertIndexed(Article.objects.filter(is_active=True, expiration_date__lte=datetime.now()))
+
+
 class ArticleStatusTestCase(TestCase):
 
     def setUp(self):
@@ -80,6 +1202,25 @@ class ArticleStatusTestCase(TestCase):
         _as.is_live = False
         self.assertEqual(unicode(_as), u'Fake')
 
+    def test_registry(self):
+        live = set(ArticleStatus.objects.filter(is_live=True).values_list('id', flat=True))
+        self.assertEqual(ArticleStatus.objects.live_ids(), live)
+        self.assertEqual(ArticleStatus.objects.default(), ArticleStatus.objects.all()[0])
+
+        # it's cached
+        self.assertNumQueries(0, ArticleStatus.objects.live_ids)
+        self.assertNumQueries(0, lambda: Article(title='No query'))
+
+        status = ArticleStatus.objects.create(name='Also live', is_live=True)
+        self.assertEqual(ArticleStatus.objects.live_ids(), live | set([status.pk]))
+
+        status.delete()
+        self.assertEqual(ArticleStatus.objects.live_ids(), live)
+
+    def test_live_without_join(self):
+        sql = str(Article.objects.live().query)
+        self.assertFalse('articles_articlestatus' in sql)
+
 class ArticleTestCase(TestCase, ArticleUtilMixin):
     fixtures = ['users']
 
@@ -94,6 +1235,105 @@ class ArticleTestCase(TestCase, ArticleUtilMixin):
 
         self.assertNotEqual(a1.slug, a2.slug)
 
+        # slugs only need to be unique within a year
+        a3 = self.new_article('Same Slug', 'Next year', publish_date=datetime(a1.publish_date.year + 1, 1, 1))
+        self.assertEqual(a3.slug, a1.slug)
+
+    def test_published_in(self):
+        self.assertEqual(models.published_in('2010', '12'), {
+            'publish_date__gte': datetime(2010, 12, 1),
+            'publish_date__lt': datetime(2011, 1, 1),
+        })
+
+        status = ArticleStatus.objects.filter(is_live=True)[0]
+        last = self.new_article('Last', 'Last second of May', status=status, publish_date=datetime(2010, 5, 31, 23, 59, 59))
+        self.new_article('First', 'First of June', status=status, publish_date=datetime(2010, 6, 1))
+
+        res = self.client.get(reverse('articles_in_month', args=[2010, 5]))
+        self.assertEqual(list(res.context['page_obj'].object_list), [last])
+        self.assertEqual(self.client.get(reverse('articles_in_month', args=[2010, 13])).status_code, 404)
+
+        res = self.client.get(last.get_absolute_url())
+        self.assertEqual(res.context['article'], last)
+        self.assertEqual(self.client.get(reverse('articles_display_article', args=[9999, 'last'])).status_code, 404)
+        self.assertEqual(self.client.get('/9999/may/31/last/').status_code, 404)
+
+    def test_get_articles(self):
+        cache.clear()
+        caching.local_cache.clear()
+        status = ArticleStatus.objects.filter(is_live=True)[0]
+        old = self.new_article('Old', 'Old news', status=status, publish_date=datetime(2010, 1, 1))
+        new = self.new_article('New', 'New news', status=status, publish_date=datetime(2010, 2, 1))
+        self.new_article('Draft', 'Not yet', status=ArticleStatus.objects.filter(is_live=False)[0])
+
+        sidebar = Template('{% load article_tags %}{% get_articles 5 as recent %}'
+                           '{% for a in recent %}<a href="{{ a.get_absolute_url }}">{{ a.title }}</a>{% endfor %}')
+        context = lambda: Context({'user': AnonymousUser()})
+
+        expected = ''.join('<a href="%s">%s</a>' % (a.get_absolute_url(), a.title) for a in (new, old))
+        self.assertEqual(sidebar.render(context()), expected)
+
+        # a warm cache costs no queries at all
+        self.assertNumQueries(0, sidebar.render, context())
+
+        # and it's emptied when an article changes
+        old.title = 'Older'
+        old.save()
+        self.assertTrue('>Older<' in sidebar.render(context()))
+
+        c = Context({'user': self.superuser})
+        Template('{% load article_tags %}{% get_articles 1 to 3 as recent asc %}{% get_articles 1 as latest %}').render(c)
+        self.assertEqual([a.title for a in c['recent']], ['Older', 'New', 'Draft'])
+        self.assertEqual(c['latest'].pk, Article.objects.order_by('-publish_date')[0].pk)
+
+    def saved_queries(self, article):
+        """Returns the SQL of the statements it takes to save an article"""
+
+        connection.use_debug_cursor = True
+        connection.queries = []
+        try:
+            article.save()
+            return [q['sql'] for q in connection.queries]
+        finally:
+            connection.use_debug_cursor = False
+
+    def test_status_edit(self):
+        """Changing just the status writes just the status"""
+
+        a = self.new_article('Status Edit', 'Some content')
+        a = Article.objects.get(pk=a.pk)
+        a.status = ArticleStatus.objects.filter(is_live=True)[0]
+
+        updates = [sql for sql in self.saved_queries(a) if sql.startswith('UPDATE "articles_article"')]
+        self.assertEqual(len(updates), 1)
+        self.assertTrue(updates[0].startswith('UPDATE "articles_article" SET "status_id" = '))
+        self.assertEqual([name for name, seconds in a.save_timings], ['write', 'do_visibility'])
+
+    def test_unchanged_save(self):
+        """Saving an unchanged article runs no stages and writes nothing"""
+
+        a = self.new_article('Unchanged', 'Some content')
+        a = Article.objects.get(pk=a.pk)
+
+        self.assertEqual(self.saved_queries(a), [])
+        self.assertEqual(a.saved_fields, set())
+
+    def test_content_edit(self):
+        """Only the stages that depend on the content run again"""
+
+        Tag.objects.create(name='mentioned')
+        a = self.new_article('Content Edit', 'Some content')
+        a.content = 'Now it mentioned a tag'
+        a.save()
+
+        stages = [name for name, seconds in a.save_timings]
+        self.assertEqual(stages, ['do_render_markup', 'do_meta_description', 'do_auto_tag',
+                                  'do_tags_to_keywords', 'write'])
+        self.assertEqual(list(a.tags.values_list('name', flat=True)), ['mentioned'])
+
+        saved = Article.objects.get(pk=a.pk)
+        self.assertEqual((saved.rendered_content, saved.keywords), ('Now it mentioned a tag', 'mentioned'))
+
     def test_active_articles(self):
         """Active articles"""
 
@@ -143,6 +1383,134 @@ class ArticleTestCase(TestCase, ArticleUtilMixin):
         self.assertEquals(Article.objects.live().count(), 2)
         self.assertEquals(Article.objects.live(self.superuser).count(), 3)
 
+    def test_visible_articles(self):
+        """Visibility rows follow status, activity and sites"""
+
+        draft = ArticleStatus.objects.filter(is_live=False)[0]
+        live_status = ArticleStatus.objects.filter(is_live=True)[0]
+        a1 = self.new_article('Draft', 'This is a draft', status=draft)
+        a2 = self.new_article('Live', 'This is live', status=live_status)
+        a3 = self.new_article('Inactive', 'This is inactive', status=live_status, is_active=False)
+
+        self.assertEqual(list(Article.objects.visible()), [a2])
+        self.assertEqual(Article.objects.visible(site=2).count(), 0)
+
+        a1.status = live_status
+        a1.save()
+        self.assertEqual(Article.objects.visible().count(), 2)
+
+        a2.sites.clear()
+        self.assertEqual(list(Article.objects.visible()), [a1])
+
+        live_status.is_live = False
+        live_status.save()
+        self.assertEqual(Article.objects.visible().count(), 0)
+
+    def test_scheduled_transitions(self):
+        """Scheduled articles appear and expired articles disappear on time"""
+
+        live_status = ArticleStatus.objects.filter(is_live=True)[0]
+        soon = datetime.now() + timedelta(hours=1)
+        a1 = self.new_article('Scheduled', 'Not yet', status=live_status, publish_date=soon)
+        a2 = self.new_article('Expiring', 'Almost gone', status=live_status, expiration_date=soon)
+
+        self.assertEqual(list(Article.objects.visible()), [a2])
+        self.assertEqual(Article.objects.next_transition(), soon)
+
+        published, expired = Article.objects.process_transitions(now=soon)
+        self.assertEqual(published, [a1.id])
+        self.assertEqual(expired, [a2.id])
+
+        self.assertEqual(list(Article.objects.visible()), [a1])
+        self.assertFalse(Article.objects.get(pk=a2.pk).is_active)
+
+        cache.delete(TRANSITION_KEY)
+
+    def test_load_keeps_sites(self):
+        """Loading an article with no rendered content doesn't change it"""
+
+        other = Site.objects.create(domain='other.example.com', name='Other')
+        a = self.new_article('Elsewhere', '*Somewhere* else', markup=MARKUP_MARKDOWN)
+        a.sites = [other]
+        Article.objects.filter(pk=a.pk).update(rendered_content='')
+
+        a = Article.objects.get(pk=a.pk)
+        self.assertEqual([s.pk for s in a.sites.all()], [other.pk])
+        self.assertEqual(a.rendered_content, '')
+
+        # saving an article that has sites leaves them alone too
+        a.title = 'Still elsewhere'
+        a.save()
+        self.assertEqual([s.pk for s in a.sites.all()], [other.pk])
+
+        call_command('run_article_scheduler', verbosity=0)
+        self.assertEqual(Article.objects.get(pk=a.pk).rendered_content, '<p><em>Somewhere</em> else</p>')
+
+    def test_time_quantum(self):
+        """Rounded times make identical queries for the same minute"""
+
+        models.TIME_QUANTUM = 60
+        try:
+            now = Article.objects.current_time()
+            self.assertEqual((now.second, now.microsecond), (0, 0))
+            self.assertEqual(str(Article.objects.live().query), str(Article.objects.live().query))
+        finally:
+            models.TIME_QUANTUM = 0
+
+    def test_boundary_lookups(self):
+        """Boundaries are looked up once a second when times aren't rounded"""
+
+        when = (datetime.now() + timedelta(seconds=2)).replace(microsecond=0)
+        try:
+            Article.objects.boundary_after(when)
+            for microsecond in (1, 500000, 999999):
+                self.assertNumQueries(0, lambda: Article.objects.boundary_after(when.replace(microsecond=microsecond)))
+
+            # scheduling an article replaces what was looked up, and one that
+            # passes within the second isn't returned
+            a = self.new_article('Soon', 'Published mid-second', publish_date=when + timedelta(microseconds=500000))
+            self.assertEqual(Article.objects.boundary_after(when), a.publish_date)
+            self.assertEqual(Article.objects.boundary_after(when.replace(microsecond=999999)), None)
+        finally:
+            # the article is rolled back, but not what was cached about it
+            caching.bump('boundaries')
+
+    def test_listing_caches(self):
+        """Feeds and archives are cleared when what they show changes"""
+
+        draft = ArticleStatus.objects.filter(is_live=False)[0]
+        a = self.new_article('Draft', 'Not yet', status=draft)
+        feeds = lambda: caching.get_version('feeds')
+
+        version = feeds()
+        a.keywords = 'hidden'
+        a.save()
+        self.assertEqual(feeds(), version)
+
+        for field, value in (('status', ArticleStatus.objects.filter(is_live=True)[0]), ('title', 'Published')):
+            version = feeds()
+            time.sleep(0.001)
+            setattr(a, field, value)
+            a.save()
+            self.assertNotEqual(feeds(), version)
+
+        version = caching.get_version('tag_cloud')
+        time.sleep(0.001)
+        a.tags.add(Tag.objects.create(name='listed'))
+        self.assertNotEqual(caching.get_version('tag_cloud'), version)
+
+    def test_cached_query(self):
+        """Query results are cached until an article changes"""
+
+        self.new_article('First', 'First article')
+        qs = Article.objects.all().order_by('id')
+
+        self.assertEqual(len(cached_query(qs)), 1)
+        self.assertNumQueries(0, lambda: cached_query(qs))
+
+        self.new_article('Second', 'Second article')
+        self.assertEqual(len(cached_query(qs)), 2)
+
     def test_auto_expire(self):
         """
         Makes sure that articles set to expire will actually be marked inactive
@@ -280,16 +1648,99 @@ class ArticleAdminTestCase(TestCase, ArticleUtilMixin):
         # make sure we have articles with the default status
         self.assertEqual(Article.objects.filter(status=default_status).count(), 2)
 
+        # the action asks which status to use first
+        res = self.client.post(reverse('admin:articles_article_changelist'), {
+            '_selected_action': Article.objects.all().values_list('id', flat=True),
+            'index': 0,
+            'action': 'set_status',
+        })
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(Article.objects.filter(status=default_status).count(), 2)
+
         # mark them with the other status
         self.client.post(reverse('admin:articles_article_changelist'), {
             '_selected_action': Article.objects.all().values_list('id', flat=True),
             'index': 0,
-            'action': 'mark_status_%s' % (other_status.id,),
+            'action': 'set_status',
+            'status': other_status.id,
+            'apply': 'Apply',
         })
 
         # make sure we have articles with the other status
         self.assertEqual(Article.objects.filter(status=other_status).count(), 2)
 
+    def test_apply_tags(self):
+        """Applies tags to multiple articles without saving each of them"""
+
+        a1 = self.new_article('An Article', 'Some content')
+        a2 = self.new_article('Another Article', 'Some content')
+        a1.tags.add(Tag.objects.create(name='existing'))
+
+        self.client.post(reverse('admin:articles_article_changelist'), {
+            '_selected_action': [a1.id, a2.id],
+            'index': 0,
+            'action': 'apply_tags',
+            'tags': 'existing fresh',
+            'apply': 'Apply',
+        })
+
+        self.assertEqual(a1.tags.count(), 2)
+        self.assertEqual(a2.tags.count(), 2)
+
+    def test_actions_with_many_tags(self):
+        """The changelist doesn't grow an action for every tag"""
+
+        Tag.objects.bulk_create([Tag(name='tag%s' % i, slug='tag%s' % i) for i in range(10000)])
+
+        res = self.client.get(reverse('admin:articles_article_changelist'))
+        self.assertEqual(res.status_code, 200)
+        self.assertFalse('apply_tag_' in res.content)
+
+    def count_queries(self, url):
+        """Returns the number of queries it takes to load a page"""
+
+        connection.use_debug_cursor = True
+        try:
+            # the query log is reset at the start of each request
+            self.assertEqual(self.client.get(url).status_code, 200)
+            return len(connection.queries)
+        finally:
+            connection.use_debug_cursor = False
+
+    def test_changelist_queries(self):
+        """Changelists take the same number of queries however many rows there are"""
+
+        tags = [Tag.objects.create(name='tag%s' % i) for i in range(3)]
+        self.new_article('An Article', 'Some content', tags=tags)
+
+        article_url = reverse('admin:articles_article_changelist')
+        tag_url = reverse('admin:articles_tag_changelist')
+
+        # warm up anything that gets cached on the first request
+        self.count_queries(article_url)
+        article_queries = self.count_queries(article_url)
+        tag_queries = self.count_queries(tag_url)
+
+        for i in range(10):
+            self.new_article('Article %s' % i, 'Some content', tags=tags)
+            Tag.objects.create(name='other%s' % i)
+
+        self.assertEqual(self.count_queries(article_url), article_queries)
+        self.assertEqual(self.count_queries(tag_url), tag_queries)
+
+        # sorting by the counts works too
+        self.assertEqual(self.client.get(article_url + '?o=2').status_code, 200)
+        self.assertEqual(self.client.get(tag_url + '?o=2').status_code, 200)
+
+    def test_changelist_search(self):
+        """Admin searches go through the search index"""
+
+        self.new_article('Python tricks', 'content')
+        self.new_article('Ruby tricks', 'content')
+
+        res = self.client.get(reverse('admin:articles_article_changelist'), {'q': 'python'})
+        self.assertEqual([a.title for a in res.context['cl'].result_list], ['Python tricks'])
+
     def test_automatic_author(self):
         """
         Makes sure the author of an article will be set automatically based on
@@ -313,6 +1764,28 @@ class ArticleAdminTestCase(TestCase, ArticleUtilMixin):
         self.assertRedirects(res, reverse('admin:articles_article_changelist'))
         self.assertEqual(Article.objects.filter(author__username='admin').count(), 1)
 
+    def test_default_site(self):
+        """Articles saved without a site are listed on the current one"""
+
+        res = self.client.post(reverse('admin:articles_article_add'), {
+            'title': 'No site picked',
+            'slug': 'no-site',
+            'content': 'Some content',
+            'status': ArticleStatus.objects.filter(is_live=True)[0].id,
+            'markup': MARKUP_HTML,
+            'is_active': 'on',
+            'publish_date_0': '2011-08-15',
+            'publish_date_1': '09:00:00',
+            'attachments-TOTAL_FORMS': 5,
+            'attachments-INITIAL_FORMS': 0,
+            'attachments-MAX_NUM_FORMS': 15,
+        })
+
+        self.assertRedirects(res, reverse('admin:articles_article_changelist'))
+        article = Article.objects.get(slug='no-site')
+        self.assertEqual([s.pk for s in article.sites.all()], [settings.SITE_ID])
+        self.assertEqual(list(Article.objects.listed()), [article])
+
     def test_non_superuser(self):
         """Makes sure that non-superuser users can only see articles they posted"""
 
@@ -373,6 +1846,28 @@ class FeedTestCase(TestCase, ArticleUtilMixin):
         res = self.client.get(reverse('articles_atom_feed_tag', args=['demox']))
         self.assertEqual(res.status_code, 404)
 
+    def test_sites(self):
+        """Sites sharing a cache don't get each other's feeds or archives"""
+
+        cache.clear()
+        caching.local_cache.clear()
+        tag = Tag.objects.get(slug='demo')
+        archives = Template('{% load article_tags %}{% get_article_archives as archives %}{{ archives|length }}')
+
+        self.assertEqual(len(feeds.LatestEntries().items()), 1)
+        self.assertEqual(len(feeds.TagFeed().items(tag)), 1)
+        self.assertEqual(archives.render(Context({})), '1')
+
+        other = Site.objects.create(domain='other.example.com', name='Other')
+        site_id = settings.SITE_ID
+        settings.SITE_ID = other.pk
+        try:
+            self.assertEqual(feeds.LatestEntries().items(), [])
+            self.assertEqual(feeds.TagFeed().items(tag), [])
+            self.assertEqual(archives.render(Context({})), '0')
+        finally:
+            settings.SITE_ID = site_id
+
 class FormTestCase(TestCase, ArticleUtilMixin):
     fixtures = ['users',]
 
@@ -392,6 +1887,28 @@ class FormTestCase(TestCase, ArticleUtilMixin):
         res = self.client.get(reverse('admin:articles_article_change', args=[a.id]))
         self.assertEqual(res.status_code, 200)
 
+    def test_tag_resolution(self):
+        """Tags are looked up in one query and missing ones are created"""
+
+        existing = Tag.objects.create(name='existing')
+        resolved = tags(['new', 'Existing', 'new', 'another'])
+
+        self.assertEqual([t.slug for t in resolved], ['new', 'existing', 'another'])
+        self.assertEqual(resolved[1], existing)
+        self.assertNumQueries(1, lambda: tags(['new', 'existing', 'another']))
+
+    def test_save_tags(self):
+        """Only tag changes are written when an article is edited"""
+
+        tag_list = tags(['tag%s' % i for i in range(50)])
+        a = self.new_article('Sample', 'sample', tags=tag_list)
+
+        form = ArticleAdminForm(instance=a)
+        wanted = tag_list[5:] + tags(['brand-new'])
+        # five for the tags and four to reindex the article once
+        self.assertNumQueries(9, lambda: form.save_tags(a, wanted))
+        self.assertEqual(set(a.tags.all()), set(wanted))
+
 class ListenerTestCase(TestCase, ArticleUtilMixin):
     fixtures = ['users', 'tags']
 
@@ -24,6 +24,8 @@ urlpatterns += patterns('',
     url(r'^author/(?P<username>.*)/page/(?P<page>\d+)/$', views.display_blog_page, name='articles_by_author_page'),
     url(r'^author/(?P<username>.*)/$', views.display_blog_page, name='articles_by_author'),
 
+    url(r'^search/$', views.search, name='articles_search'),
+
     url(r'^(?P<year>\d{4})/(?P<slug>.*)/$', views.display_article, name='articles_display_article'),
 
     # AJAX
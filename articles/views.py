@@ -2,19 +2,29 @@ import logging
 
 from django.conf import settings
 from django.contrib.auth.models import User
-from django.core.cache import cache
 from django.core.paginator import Paginator, EmptyPage
 from django.core.urlresolvers import reverse
 from django.http import HttpResponsePermanentRedirect, Http404, HttpResponseRedirect, HttpResponse
 from django.shortcuts import render_to_response, get_object_or_404
 from django.template import RequestContext
-from articles.models import Article, Tag
-from datetime import datetime
+from django.utils import simplejson as json
+from articles import caching, permalinks
+from articles.autocomplete import tag_index
+from articles.models import Article, Tag, published_in
+from articles.search import search as search_articles
 
 ARTICLE_PAGINATION = getattr(settings, 'ARTICLE_PAGINATION', 20)
 
+# how many page links to show on either side of the current page
+PAGE_WINDOW = getattr(settings, 'ARTICLES_PAGE_WINDOW', 5)
+
 log = logging.getLogger('articles.views')
 
+def page_window(paginator, number, size=PAGE_WINDOW):
+    """The numbers of the pages around page ``number``, at most ``size`` on either side"""
+
+    return range(max(1, number - size), min(paginator.num_pages, number + size) + 1)
+
 def display_blog_page(request, tag=None, username=None, year=None, month=None, page=1):
     """
     Handles all of the magic behind the pages that list articles in any way.
@@ -25,34 +35,41 @@ def display_blog_page(request, tag=None, username=None, year=None, month=None, p
     context = {'request': request}
     if tag:
         try:
-            tag = get_object_or_404(Tag, slug__iexact=tag)
-        except Http404:
-            # for backwards-compatibility
-            tag = get_object_or_404(Tag, name__iexact=tag)
+            # tag names, as used in older URLs, clean up to their slugs
+            tag = Tag.objects.get_by_slug(tag)
+        except Tag.DoesNotExist:
+            raise Http404
 
-        articles = tag.article_set.live(user=request.user).select_related()
+        articles = tag.article_set.listed(user=request.user).select_related()
         template = 'articles/display_tag.html'
         context['tag'] = tag
+        listing = ('articles_display_tag', {'tag': tag.cleaned})
 
     elif username:
         # listing articles by a particular author
         user = get_object_or_404(User, username=username)
-        articles = user.article_set.live(user=request.user)
+        articles = user.article_set.listed(user=request.user)
         template = 'articles/by_author.html'
         context['author'] = user
+        listing = ('articles_by_author', {'username': username})
 
     elif year and month:
         # listing articles in a given month and year
-        year = int(year)
-        month = int(month)
-        articles = Article.objects.live(user=request.user).select_related().filter(publish_date__year=year, publish_date__month=month)
+        try:
+            in_month = published_in(year, month)
+        except ValueError:
+            raise Http404
+
+        articles = Article.objects.listed(user=request.user).select_related().filter(**in_month)
         template = 'articles/in_month.html'
-        context['month'] = datetime(year, month, 1)
+        context['month'] = in_month['publish_date__gte']
+        listing = ('articles_in_month', {'year': year, 'month': month})
 
     else:
         # listing articles with no particular filtering
-        articles = Article.objects.live(user=request.user)
+        articles = Article.objects.listed(user=request.user)
         template = 'articles/article_list.html'
+        listing = ('articles_archive', {})
 
     # paginate the articles
     paginator = Paginator(articles, ARTICLE_PAGINATION,
@@ -62,19 +79,57 @@ def display_blog_page(request, tag=None, username=None, year=None, month=None, p
     except EmptyPage:
         raise Http404
 
+    # the page links all share one URL, worked out here rather than per link
+    name, kwargs = listing
     context.update({'paginator': paginator,
-                    'page_obj': page})
+                    'page_obj': page,
+                    'page_range': page_window(paginator, page.number),
+                    'page_urls': permalinks.PageURLs(name, **kwargs)})
     variables = RequestContext(request, context)
     response = render_to_response(template, variables)
 
     return response
 
+def search(request, template='articles/search.html'):
+    """Lists the live articles that best match a search, most relevant first"""
+
+    query = request.GET.get('q', '').strip()
+    try:
+        page_number = int(request.GET.get('page', 1))
+    except ValueError:
+        raise Http404
+
+    ids = []
+    if query:
+        ids = search_articles(query, Article.objects.listed(user=request.user))
+
+    # only the articles on the requested page need to be loaded
+    paginator = Paginator(ids, ARTICLE_PAGINATION)
+    try:
+        page = paginator.page(page_number)
+    except EmptyPage:
+        raise Http404
+
+    articles = Article.objects.select_related('author').in_bulk(page.object_list)
+    page.object_list = [articles[pk] for pk in page.object_list if pk in articles]
+
+    variables = RequestContext(request, {
+        'query': query,
+        'results': paginator,
+        'results_page': page,
+        'page_range': page_window(paginator, page.number),
+    })
+    response = render_to_response(template, variables)
+
+    return response
+
 def display_article(request, year, slug, template='articles/article_detail.html'):
     """Displays a single article."""
 
     try:
-        article = Article.objects.live(user=request.user).get(publish_date__year=year, slug=slug)
-    except Article.DoesNotExist:
+        article = Article.objects.live(user=request.user).get(slug=slug, **published_in(year))
+    except (Article.DoesNotExist, ValueError):
+        # the last year has no next one to end its range
         raise Http404
 
     # make sure the user is logged in if the article requires it
@@ -91,7 +146,12 @@ def display_article(request, year, slug, template='articles/article_detail.html'
 
 def redirect_to_article(request, year, month, day, slug):
     # this is a little snippet to handle URLs that are formatted the old way.
-    article = get_object_or_404(Article, publish_date__year=year, slug=slug)
+    try:
+        in_year = published_in(year)
+    except ValueError:
+        raise Http404
+
+    article = get_object_or_404(Article, slug=slug, **in_year)
     return HttpResponsePermanentRedirect(article.get_absolute_url())
 
 def ajax_tag_autocomplete(request):
@@ -99,17 +159,10 @@ def ajax_tag_autocomplete(request):
 
     if 'q' in request.GET:
         q = request.GET['q']
-        key = 'ajax_tag_auto_%s' % q
-        response = cache.get(key)
+        version = tag_index.ensure_fresh()
+        content = caching.get_or_set('autocomplete', u'%s:%s' % (version, q),
+                                     lambda: json.dumps(tag_index.search(q)), 300)
 
-        if response is not None:
-            return response
-
-        tags = list(Tag.objects.filter(name__istartswith=q)[:10])
-        response = HttpResponse(u'\n'.join(tag.name for tag in tags))
-        cache.set(key, response, 300)
-
-        return response
+        return HttpResponse(content, mimetype='application/json')
 
     return HttpResponse()
-